@@ -0,0 +1,184 @@
+"""
+Write-behind buffering of votes.
+
+Votes for fields declared with ``buffered=True`` are validated and queued in
+memory instead of being written right away. Votes cast by the same voter on
+the same object are coalesced, and the queue is written with
+``Vote.objects.bulk_add`` whenever it holds ``RATINGS_BUFFER_SIZE`` votes,
+every ``RATINGS_BUFFER_INTERVAL`` seconds, and when the process exits.
+
+The queue never holds more than ``RATINGS_BUFFER_SIZE`` votes. When a flush
+fails, the votes are requeued up to that size, and a full buffer drops new
+votes rather than flushing again until ``RATINGS_BUFFER_RETRY_DELAY`` seconds
+(doubled on every consecutive failure) have passed.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from models import Vote
+from default_settings import RATINGS_BUFFER_SIZE, RATINGS_BUFFER_INTERVAL, RATINGS_BUFFER_RETRY_DELAY
+
+__all__ = ('VoteBuffer', 'vote_buffer')
+
+logger = logging.getLogger('djangoratings')
+
+# longest wait before a full buffer tries to flush again after failures
+MAX_RETRY_DELAY = 60
+
+class VoteBuffer(object):
+    def __init__(self, max_size=None, interval=None):
+        self.max_size = max_size
+        self.interval = interval
+        self.votes = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.failures = 0
+        self.retry_after = 0
+        self.counters = dict(
+            flushes     = 0,
+            flushed     = 0,
+            rejected    = 0,
+            errors      = 0,
+            dropped     = 0,
+            last_flush_latency  = None,
+            max_flush_latency   = None,
+        )
+
+    def get_max_size(self):
+        if self.max_size is None:
+            return getattr(settings, 'RATINGS_BUFFER_SIZE', RATINGS_BUFFER_SIZE)
+        return self.max_size
+
+    def get_interval(self):
+        if self.interval is None:
+            return getattr(settings, 'RATINGS_BUFFER_INTERVAL', RATINGS_BUFFER_INTERVAL)
+        return self.interval
+
+    def get_retry_delay(self):
+        delay = getattr(settings, 'RATINGS_BUFFER_RETRY_DELAY', RATINGS_BUFFER_RETRY_DELAY)
+        return min(delay * 2 ** max(self.failures - 1, 0), MAX_RETRY_DELAY)
+
+    def put(self, instance, field_name, user, ip_address, cookie, score):
+        """put(instance, field_name, user, ip_address, cookie, score)
+
+        Queues a vote, replacing any vote still queued for the same voter and
+        object. The calling thread flushes the buffer once it is full, unless a
+        flush failed recently, in which case votes which do not fit are dropped."""
+        field = getattr(instance.__class__, field_name)
+        user_id = user and user.pk
+        key = (instance.__class__, instance.pk, field_name, user_id, user_id is None and ip_address or None, cookie)
+        vote = (instance, field_name, user, ip_address, cookie, score)
+
+        self.start()
+        max_size = self.get_max_size()
+        backing_off = time.time() < self.retry_after
+        self.lock.acquire()
+        try:
+            if key not in self.votes and backing_off and len(self.votes) >= max_size:
+                self.counters['dropped'] += 1
+                return
+            # a vote which cannot be changed keeps its first value
+            if field.can_change_vote or key not in self.votes:
+                self.votes[key] = vote
+            size = len(self.votes)
+        finally:
+            self.lock.release()
+
+        if size >= max_size and not backing_off:
+            self.flush()
+
+    def flush(self):
+        """Writes every queued vote to the database."""
+        self.flush_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                votes, self.votes = self.votes, {}
+            finally:
+                self.lock.release()
+            if not votes:
+                return
+
+            started = time.time()
+            try:
+                result = Vote.objects.bulk_add(votes.values(), fail_silently=True)
+            except Exception:
+                logger.exception('Unable to flush %d buffered votes', len(votes))
+                self.counters['errors'] += 1
+                self.failures += 1
+                self.retry_after = time.time() + self.get_retry_delay()
+                # requeue as many votes as fit, unless a newer vote was cast in
+                # the meantime
+                max_size = self.get_max_size()
+                self.lock.acquire()
+                try:
+                    for key, vote in votes.iteritems():
+                        if key in self.votes:
+                            continue
+                        if len(self.votes) >= max_size:
+                            self.counters['dropped'] += 1
+                        else:
+                            self.votes[key] = vote
+                finally:
+                    self.lock.release()
+                return
+
+            self.failures = 0
+            self.retry_after = 0
+
+            latency = time.time() - started
+            self.counters['flushes'] += 1
+            self.counters['flushed'] += result['added'] + result['changed'] + result['deleted']
+            self.counters['rejected'] += len(result['rejected'])
+            self.counters['last_flush_latency'] = latency
+            self.counters['max_flush_latency'] = max(latency, self.counters['max_flush_latency'])
+        finally:
+            self.flush_lock.release()
+
+    def stats(self):
+        """Returns the buffer's counters, including the number of votes which
+        did not fit in the buffer as ``dropped``, along with the number of votes
+        waiting to be written as ``backlog``."""
+        stats = dict(self.counters)
+        stats['backlog'] = len(self.votes)
+        return stats
+
+    def start(self):
+        """Starts the background flusher, unless it is running or disabled by a
+        ``RATINGS_BUFFER_INTERVAL`` of 0."""
+        if self.thread is not None or not self.get_interval():
+            return
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.wakeup.clear()
+                self.thread = threading.Thread(target=self.run, name='djangoratings-buffer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Stops the background flusher and writes the remaining votes."""
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            self.wakeup.set()
+            thread.join()
+        self.flush()
+
+    def run(self):
+        while not self.wakeup.isSet():
+            self.wakeup.wait(self.get_interval())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Unable to flush buffered votes')
+
+vote_buffer = VoteBuffer()
+atexit.register(vote_buffer.stop)
@@ -0,0 +1,68 @@
+"""
+Helpers shared by the parts of djangoratings which keep data in Django's
+cache framework.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from default_settings import RATINGS_CACHE_TIMEOUT
+
+__all__ = ('cache', 'get_cache_key', 'get_cache_timeout', 'lock', 'unlock', 'get_generations', 'bump_generations')
+
+def get_cache_key(*bits):
+    """get_cache_key(*bits)
+
+    Returns the cache key made of ``bits``, e.g. ``djangoratings:ip:12:3:<key>:127.0.0.1``."""
+    return 'djangoratings:%s' % (':'.join([str(bit) for bit in bits]),)
+
+def get_cache_timeout():
+    return getattr(settings, 'RATINGS_CACHE_TIMEOUT', RATINGS_CACHE_TIMEOUT)
+
+def lock(cache_key, attempts=5):
+    """lock(cache_key, attempts=5)
+
+    Takes the lock guarding ``cache_key``, waiting a little while for it, and
+    returns whether it was taken."""
+    for i in xrange(attempts):
+        if cache.add(cache_key + ':lock', 1, 10):
+            return True
+        if i + 1 < attempts:
+            time.sleep(0.01)
+    return False
+
+def unlock(cache_key):
+    cache.delete(cache_key + ':lock')
+
+def _new_generation():
+    # counters start from the current time, so that an evicted counter never
+    # goes back to a value it had before
+    return int(time.time() * 1000)
+
+def get_generations(cache_keys):
+    """get_generations(cache_keys)
+
+    Returns the values of the generation counters kept under ``cache_keys``,
+    using a single cache lookup unless some are missing. Cached values whose
+    keys include these generations are invalidated by ``bump_generations``."""
+    values = cache.get_many(cache_keys)
+    generations = []
+    for cache_key in cache_keys:
+        value = values.get(cache_key)
+        if value is None:
+            value = _new_generation()
+            if not cache.add(cache_key, value, get_cache_timeout() * 2):
+                value = cache.get(cache_key, value)
+        generations.append(value)
+    return generations
+
+def bump_generations(cache_keys):
+    """bump_generations(cache_keys)
+
+    Increments the generation counters kept under ``cache_keys``."""
+    for cache_key in cache_keys:
+        try:
+            cache.incr(cache_key)
+        except ValueError:
+            cache.set(cache_key, _new_generation(), get_cache_timeout() * 2)
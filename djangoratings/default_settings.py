@@ -2,4 +2,69 @@ from django.conf import settings
 
 # Used to limit the number of unique IPs that can vote on a single object+field.
 #   useful if you're getting rating spam by users registering multiple accounts
-RATINGS_VOTES_PER_IP = 3
\ No newline at end of file
+RATINGS_VOTES_PER_IP = 3
+
+# Number of queued votes which triggers a flush of the vote buffer, used by
+#   fields declared with ``buffered=True``
+RATINGS_BUFFER_SIZE = 1000
+
+# Seconds between two flushes of the vote buffer by its background thread;
+#   0 disables the thread, so the buffer is only flushed when full or on exit
+RATINGS_BUFFER_INTERVAL = 5
+
+# Seconds during which a full vote buffer drops new votes instead of flushing
+#   again after a failed flush; doubled on every consecutive failure
+RATINGS_BUFFER_RETRY_DELAY = 1
+
+# Keep the number of votes per object+field+IP used by ``RATINGS_VOTES_PER_IP``
+#   in the cache, so the votes table is only counted on a cache miss. One of:
+#   None     - always count votes in the database
+#   'strict' - trust cached counts to reject a vote, but check the database
+#              before accepting one, so an IP never goes over its limit
+#   'fast'   - trust cached counts both ways
+RATINGS_VOTES_PER_IP_CACHE = None
+
+# Lifetime, in seconds, of the values djangoratings stores in the cache
+RATINGS_CACHE_TIMEOUT = 60 * 60
+
+# Number of objects kept in the leaderboards of fields declared with
+#   ``leaderboard=True``
+RATINGS_LEADERBOARD_SIZE = 100
+
+# Minimum ratio of the objects two users gave the same score to over the ones
+#   they disagreed on, for them to be considered similar
+RATINGS_MIN_AGREEMENT = 3
+
+# Measure of the similarity between users stored in ``SimilarUser.similarity``:
+#   None (users are similar according to ``RATINGS_MIN_AGREEMENT``),
+#   'distance', 'pearson' or 'cosine', see ``djangoratings.similarity``
+RATINGS_SIMILARITY_METRIC = None
+
+# Minimum similarity, by ``RATINGS_SIMILARITY_METRIC``, for two users to be
+#   considered similar
+RATINGS_MIN_SIMILARITY = 0.5
+
+# Number of bands, and of rows per band, of the MinHash signatures used by
+#   ``update_recommendations --approximate``, see ``djangoratings.lsh``
+RATINGS_LSH_BANDS = 50
+RATINGS_LSH_ROWS = 2
+
+# Keep ``SimilarUser`` up to date as votes are cast, instead of only through
+#   full rebuilds. One of:
+#   None       - only ``update_recommendations`` rebuilds the similarities
+#   'inline'   - every vote adjusts the similarities with its co-voters
+#   'deferred' - voters are queued, and ``update_recommendations --stale``
+#                recomputes their similarities
+RATINGS_SIMILAR_USERS_UPDATE = None
+
+# Serve ``SimilarUser.objects.get_recommendations`` from the ``Recommendation``
+#   table, filled by ``update_recommendations``, instead of querying the votes
+#   of similar users on every call
+RATINGS_MATERIALIZED_RECOMMENDATIONS = False
+
+# Number of objects kept in the ``Recommendation`` table for each user and model
+RATINGS_RECOMMENDATIONS_SIZE = 100
+
+# Number of similar objects kept for each object and rating field by
+#   ``update_similar_objects``
+RATINGS_SIMILAR_OBJECTS_SIZE = 20
@@ -1,11 +1,14 @@
-from django.db.models import IntegerField, PositiveIntegerField
+from django.db.models import IntegerField, PositiveIntegerField, FloatField, F, Q, Sum, Count
 from django.conf import settings
 
 import forms
 import itertools
+import math
 from datetime import datetime
 
-from models import Vote, Score
+from models import Vote, Score, ScoreHistogram, SimilarUser
+from buffer import vote_buffer
+import leaderboards
 from default_settings import RATINGS_VOTES_PER_IP
 from exceptions import *
 
@@ -35,13 +38,21 @@ class Rating(object):
         self.votes = votes
 
 class RatingManager(object):
+    __slots__ = ('instance', 'field')
+
     def __init__(self, instance, field):
-        self.content_type = None
         self.instance = instance
         self.field = field
-        
-        self.votes_field_name = "%s_votes" % (self.field.name,)
-        self.score_field_name = "%s_score" % (self.field.name,)
+
+    def __getstate__(self):
+        return (self.instance, self.field.name)
+
+    def __setstate__(self, state):
+        self.instance, name = state
+        self.field = getattr(self.instance.__class__, name)
+
+    votes_field_name = property(lambda self: self.field.votes_field_name)
+    score_field_name = property(lambda self: self.field.score_field_name)
     
     def get_percent(self):
         """get_percent()
@@ -69,10 +80,28 @@ class RatingManager(object):
         """get_rating()
         
         Returns the weighted average rating."""
-        if not (self.votes and self.score):
-            return 0
-        return float(self.score)/(self.votes+self.field.weight)
+        return self.field.get_weighted_rating(self.score, self.votes)
     
+    def get_bayesian_rating(self):
+        """get_bayesian_rating()
+        
+        Returns the average rating pulled towards the mean rating of all objects,
+        the less votes the stronger."""
+        return self.field.get_bayesian_rating(self.get_content_type(), self.score, self.votes)
+
+    def get_wilson_score(self):
+        """get_wilson_score()
+        
+        Returns the lower bound of the Wilson score interval of the share of
+        positive votes (only for fields with a range of 2)."""
+        return self.field.get_wilson_score(self.score, self.votes)
+
+    def get_distribution(self):
+        """get_distribution()
+        
+        Returns the number of votes at each score as a ``{score: count}`` dict."""
+        return ScoreHistogram.objects.get_distributions([self.instance], self.field.name)[self.instance.pk]
+
     def get_opinion_percent(self):
         """get_opinion_percent()
         
@@ -107,8 +136,7 @@ class RatingManager(object):
         
         use_cookies = (self.field.allow_anonymous and self.field.use_cookies)
         if use_cookies:
-            # TODO: move 'vote-%d.%d.%s' to settings or something
-            cookie_name = 'vote-%d.%d.%s' % (kwargs['content_type'].pk, kwargs['object_id'], kwargs['key'][:6],) # -> md5_hexdigest?
+            cookie_name = self.field.get_cookie_name(kwargs['content_type'], kwargs['object_id'])
             cookie = cookies.get(cookie_name)
             if cookie:    
                 kwargs['cookie'] = cookie
@@ -131,25 +159,7 @@ class RatingManager(object):
         """add(score, user, ip_address)
         
         Used to add a rating to an object."""
-        try:
-            score = int(score)
-        except (ValueError, TypeError):
-            raise InvalidRating("%s is not a valid choice for %s" % (score, self.field.name))
-        
-        delete = (score == 0)
-        if delete and not self.field.allow_delete:
-            raise CannotDeleteVote("you are not allowed to delete votes for %s" % (self.field.name,))
-            # ... you're also can't delete your vote if you haven't permissions to change it. I leave this case for CannotChangeVote
-        
-        if score < 0 or score > self.field.range:
-            raise InvalidRating("%s is not a valid choice for %s" % (score, self.field.name))
-
-        is_anonymous = (user is None or not user.is_authenticated())
-        if is_anonymous and not self.field.allow_anonymous:
-            raise AuthRequired("user must be a user, not '%r'" % (user,))
-        
-        if is_anonymous:
-            user = None
+        score, user, delete = self.field.clean_vote(score, user)
         
         defaults = dict(
             score = score,
@@ -168,26 +178,43 @@ class RatingManager(object):
         use_cookies = (self.field.allow_anonymous and self.field.use_cookies)
         if use_cookies:
             defaults['cookie'] = now().strftime('%Y%m%d%H%M%S%f') # -> md5_hexdigest?
-            # TODO: move 'vote-%d.%d.%s' to settings or something
-            cookie_name = 'vote-%d.%d.%s' % (kwargs['content_type'].pk, kwargs['object_id'], kwargs['key'][:6],) # -> md5_hexdigest?
+            cookie_name = self.field.get_cookie_name(kwargs['content_type'], kwargs['object_id'])
             cookie = cookies.get(cookie_name) # try to get existent cookie value
             if not cookie:
                 kwargs['cookie__isnull'] = True
             kwargs['cookie'] = cookie
 
-        try:
-            rating, created = Vote.objects.get(**kwargs), False
-        except Vote.DoesNotExist:
+        if self.field.buffered:
+            # the vote is written later on, see djangoratings.buffer
+            if use_cookies and not cookie:
+                cookie = defaults['cookie']
+            vote_buffer.put(self.instance, self.field.name, user, ip_address, use_cookies and cookie or None, score)
+            adds = {}
+            if use_cookies:
+                adds['cookie_name'] = cookie_name
+                adds['cookie'] = cookie
+            if delete:
+                adds['deleted'] = True
+            return adds
+
+        votes_per_ip = getattr(settings, 'RATINGS_VOTES_PER_IP', RATINGS_VOTES_PER_IP)
+        if self.field.atomic_updates:
+            rating, num_votes = self._get_vote_and_ip_count(kwargs, ip_address, votes_per_ip)
+        else:
+            try:
+                rating, num_votes = Vote.objects.get(**kwargs), None
+            except Vote.DoesNotExist:
+                rating, num_votes = None, None
+
+        created = False
+        if rating is None:
             if delete:
                 raise CannotDeleteVote("attempt to find and delete your vote for %s is failed" % (self.field.name,))
-            if getattr(settings, 'RATINGS_VOTES_PER_IP', RATINGS_VOTES_PER_IP):
-                num_votes = Vote.objects.filter(
-                    content_type=kwargs['content_type'],
-                    object_id=kwargs['object_id'],
-                    key=kwargs['key'],
-                    ip_address=ip_address,
-                ).count()
-                if num_votes >= getattr(settings, 'RATINGS_VOTES_PER_IP', RATINGS_VOTES_PER_IP):
+            if votes_per_ip:
+                if num_votes is None:
+                    num_votes = Vote.objects.count_for_ip(kwargs['content_type'], kwargs['object_id'],
+                                                          kwargs['key'], ip_address, votes_per_ip)
+                if num_votes >= votes_per_ip:
                     raise IPLimitReached()
             kwargs.update(defaults)
             if use_cookies:
@@ -195,51 +222,74 @@ class RatingManager(object):
                 cookie = defaults['cookie'] # ... thus we need to replace old cookie (if presented) with new one
                 kwargs.pop('cookie__isnull', '') # ... and remove 'cookie__isnull' (if presented) from .create()'s **kwargs
             rating, created = Vote.objects.create(**kwargs), True
+            Vote.objects.adjust_count_for_ip(kwargs['content_type'], kwargs['object_id'], kwargs['key'], ip_address, 1)
             
+        old_score = not created and rating.score or None
         has_changed = False
         if not created:
             if self.field.can_change_vote:
                 has_changed = True
-                self.score -= rating.score
+                score_delta, votes_delta = -rating.score, 0
                 # you can delete your vote only if you have permission to change your vote
                 if not delete:
                     rating.score = score
-                    rating.save()
+                    if self.field.atomic_updates:
+                        Vote.objects.filter(pk=rating.pk).update(score=score, date_changed=now())
+                    else:
+                        rating.save()
                 else:
-                    self.votes -= 1
+                    votes_delta = -1
                     rating.delete()
+                    Vote.objects.adjust_count_for_ip(rating.content_type_id, rating.object_id, rating.key, rating.ip_address, -1)
             else:
                 raise CannotChangeVote()
         else:
             has_changed = True
-            self.votes += 1
+            score_delta, votes_delta = 0, 1
         if has_changed:
             if not delete:
-                self.score += rating.score
-            if commit:
-                self.instance.save()
-            #setattr(self.instance, self.field.name, Rating(score=self.score, votes=self.votes))
-            
-            defaults = dict(
-                score   = self.score,
-                votes   = self.votes,
-            )
-            
-            kwargs = dict(
-                content_type    = self.get_content_type(),
-                object_id       = self.instance.pk,
-                key             = self.field.key,
-            )
-            
-            try:
-                score, created = Score.objects.get(**kwargs), False
-            except Score.DoesNotExist:
-                kwargs.update(defaults)
-                score, created = Score.objects.create(**kwargs), True
-            
-            if not created:
-                score.__dict__.update(defaults)
-                score.save()
+                score_delta += rating.score
+            new_score = not delete and rating.score or None
+            if self.field.histogram:
+                ScoreHistogram.objects.adjust(self.get_content_type(), self.instance.pk, self.field.key,
+                                              old_score, new_score)
+            SimilarUser.objects.vote_changed(user, self.get_content_type(), self.instance.pk, self.field.key,
+                                             old_score, new_score)
+            if self.field.atomic_updates:
+                self._increment(score_delta, votes_delta)
+            else:
+                self.score += score_delta
+                self.votes += votes_delta
+                self._set_stored_ratings()
+                if commit:
+                    self.instance.save()
+                #setattr(self.instance, self.field.name, Rating(score=self.score, votes=self.votes))
+
+                defaults = dict(
+                    score   = self.score,
+                    votes   = self.votes,
+                )
+
+                kwargs = dict(
+                    content_type    = self.get_content_type(),
+                    object_id       = self.instance.pk,
+                    key             = self.field.key,
+                )
+
+                try:
+                    score, created = Score.objects.get(**kwargs), False
+                except Score.DoesNotExist:
+                    kwargs.update(defaults)
+                    score, created = Score.objects.create(**kwargs), True
+
+                if not created:
+                    score.__dict__.update(defaults)
+                    score.save()
+            if self.field.atomic_updates and not self.field.needs_tallies():
+                # the tallies were incremented without being read back
+                self.field.tallies_updated(self.instance.pk)
+            else:
+                self.field.tallies_updated(self.instance.pk, self.score, self.votes)
         
         # return value
         adds = {}
@@ -254,35 +304,87 @@ class RatingManager(object):
         return self.add(0, user, ip_address, cookies, commit)
     
     def _get_votes(self, default=None):
-        return getattr(self.instance, self.votes_field_name, default)
+        return getattr(self.instance, self.field.votes_field_name, default)
     
     def _set_votes(self, value):
-        return setattr(self.instance, self.votes_field_name, value)
+        return setattr(self.instance, self.field.votes_field_name, value)
         
     votes = property(_get_votes, _set_votes)
 
     def _get_score(self, default=None):
-        return getattr(self.instance, self.score_field_name, default)
+        return getattr(self.instance, self.field.score_field_name, default)
     
     def _set_score(self, value):
-        return setattr(self.instance, self.score_field_name, value)
+        return setattr(self.instance, self.field.score_field_name, value)
         
     score = property(_get_score, _set_score)
 
+    def _get_vote_and_ip_count(self, kwargs, ip_address, votes_per_ip):
+        """Returns the vote matching ``kwargs`` (or ``None``) along with the number
+        of votes cast from ``ip_address``, fetching both with a single query."""
+        lookup = Q(**kwargs)
+        if votes_per_ip:
+            lookup |= Q(ip_address=ip_address)
+        votes = list(Vote.objects.filter(
+            content_type    = kwargs['content_type'],
+            object_id       = kwargs['object_id'],
+            key             = kwargs['key'],
+        ).filter(lookup))
+
+        user = kwargs['user']
+        rating = None
+        for vote in votes:
+            if vote.user_id != (user and user.pk):
+                continue
+            if not user and vote.ip_address != ip_address:
+                continue
+            if 'cookie' in kwargs and vote.cookie != kwargs['cookie']:
+                continue
+            rating = vote
+            break
+        num_votes = len([v for v in votes if v.ip_address == ip_address])
+        return rating, num_votes
+
+    def _increment(self, score, votes):
+        """Applies ``score`` and ``votes`` deltas as database-side increments.
+
+        Only the ``<field>_score`` and ``<field>_votes`` columns and the matching
+        ``Score`` row are written, so concurrent voters never overwrite each
+        other's tallies."""
+        qs = self.instance.__class__._default_manager.filter(pk=self.instance.pk)
+        qs.update(**{
+            self.field.score_field_name: F(self.field.score_field_name) + score,
+            self.field.votes_field_name: F(self.field.votes_field_name) + votes,
+        })
+        if self.field.needs_tallies():
+            # rankings are computed from the tallies as they are now
+            self.score, self.votes = qs.values_list(self.field.score_field_name, self.field.votes_field_name)[0]
+            qs.update(**self._set_stored_ratings())
+        else:
+            self.score += score
+            self.votes += votes
+
+        Score.objects.increment(self.get_content_type(), self.instance.pk, self.field.key, score, votes)
+
+    def _set_stored_ratings(self):
+        """Updates the instance's stored ranking columns from its tallies, and returns their values."""
+        values = self.field.get_stored_ratings(self.get_content_type(), self.score, self.votes)
+        for name, value in values.iteritems():
+            setattr(self.instance, name, value)
+        return values
+
     def get_content_type(self):
-        if self.content_type is None:
-            self.content_type = ContentType.objects.get_for_model(self.instance)
-        return self.content_type
+        return self.field.get_content_type(self.instance.__class__)
     
     def _update(self, commit=False):
         """Forces an update of this rating (useful for when Vote objects are removed)."""
-        votes = Vote.objects.filter(
+        totals = Vote.objects.filter(
             content_type    = self.get_content_type(),
             object_id       = self.instance.pk,
             key             = self.field.key,
-        )
-        obj_score = sum([v.score for v in votes])
-        obj_votes = len(votes)
+        ).aggregate(total_score=Sum('score'), total_votes=Count('id'))
+        obj_score = totals['total_score'] or 0
+        obj_votes = totals['total_votes']
 
         score, created = Score.objects.get_or_create(
             content_type    = self.get_content_type(),
@@ -297,27 +399,30 @@ class RatingManager(object):
             score.score = obj_score
             score.votes = obj_votes
             score.save()
+        if self.field.histogram:
+            ScoreHistogram.objects.recalculate(self.get_content_type(), [self.instance.pk], [self.field.key])
         self.score = obj_score
         self.votes = obj_votes
+        self._set_stored_ratings()
         if commit:
             self.instance.save()
+        self.field.tallies_updated(self.instance.pk, obj_score, obj_votes)
 
 class RatingCreator(object):
     def __init__(self, field):
         self.field = field
-        self.votes_field_name = "%s_votes" % (self.field.name,)
-        self.score_field_name = "%s_score" % (self.field.name,)
 
     def __get__(self, instance, type=None):
         if instance is None:
             return self.field
             #raise AttributeError('Can only be accessed via an instance.')
+        # not cached on the instance, which would keep it in a reference cycle
         return RatingManager(instance, self.field)
 
     def __set__(self, instance, value):
         if isinstance(value, Rating):
-            setattr(instance, self.votes_field_name, value.votes)
-            setattr(instance, self.score_field_name, value.score)
+            setattr(instance, self.field.votes_field_name, value.votes)
+            setattr(instance, self.field.score_field_name, value.score)
         else:
             raise TypeError("%s value must be a Rating instance, not '%r'" % (self.field.name, value))
 
@@ -334,6 +439,16 @@ class RatingField(IntegerField):
         self.allow_anonymous = kwargs.pop('allow_anonymous', False)
         self.use_cookies = kwargs.pop('use_cookies', False)
         self.allow_delete = kwargs.pop('allow_delete', False)
+        self.atomic_updates = kwargs.pop('atomic_updates', False)
+        self.buffered = kwargs.pop('buffered', False)
+        self.store_rating = kwargs.pop('store_rating', False)
+        self.store_bayesian = kwargs.pop('store_bayesian', False)
+        self.bayesian_weight = kwargs.pop('bayesian_weight', None)
+        self.store_wilson = kwargs.pop('store_wilson', False)
+        self.leaderboard = kwargs.pop('leaderboard', False)
+        self.histogram = kwargs.pop('histogram', False)
+        if self.store_wilson and self.range != 2:
+            raise TypeError("%s 'store_wilson' requires a range of 2" % (self.__class__.__name__,))
         kwargs['editable'] = False
         kwargs['default'] = 0
         kwargs['blank'] = True
@@ -341,16 +456,40 @@ class RatingField(IntegerField):
     
     def contribute_to_class(self, cls, name):
         self.name = name
+        self.model = cls
+        self.votes_field_name = "%s_votes" % (self.name,)
+        self.score_field_name = "%s_score" % (self.name,)
+        self._content_types = {}
 
         # Votes tally field
         self.votes_field = PositiveIntegerField(
             editable=False, default=0, blank=True)
-        cls.add_to_class("%s_votes" % (self.name,), self.votes_field)
+        cls.add_to_class(self.votes_field_name, self.votes_field)
 
         # Score sum field
         self.score_field = IntegerField(
             editable=False, default=0, blank=True)
-        cls.add_to_class("%s_score" % (self.name,), self.score_field)
+        cls.add_to_class(self.score_field_name, self.score_field)
+
+        # Weighted rating field, for ordering and filtering in the database
+        self.rating_field_name = "%s_rating" % (self.name,)
+        if self.store_rating:
+            self.rating_field = FloatField(
+                editable=False, default=0, blank=True, db_index=True)
+            cls.add_to_class(self.rating_field_name, self.rating_field)
+
+        # Confidence based ranking fields
+        self.bayesian_field_name = "%s_bayesian" % (self.name,)
+        if self.store_bayesian:
+            self.bayesian_field = FloatField(
+                editable=False, default=0, blank=True, db_index=True)
+            cls.add_to_class(self.bayesian_field_name, self.bayesian_field)
+
+        self.wilson_field_name = "%s_wilson" % (self.name,)
+        if self.store_wilson:
+            self.wilson_field = FloatField(
+                editable=False, default=0, blank=True, db_index=True)
+            cls.add_to_class(self.wilson_field_name, self.wilson_field)
 
         self.key = md5_hexdigest(self.name)
 
@@ -362,6 +501,148 @@ class RatingField(IntegerField):
 
         setattr(cls, name, field)
 
+    def get_content_type(self, model):
+        """get_content_type(model)
+
+        Returns the ContentType of ``model``, which is only looked up once per field."""
+        try:
+            return self._content_types[model]
+        except KeyError:
+            content_type = self._content_types[model] = ContentType.objects.get_for_model(model)
+            return content_type
+
+    def get_weighted_rating(self, score, votes):
+        """get_weighted_rating(score, votes)
+
+        Returns the weighted average rating of the given tallies."""
+        if not (votes and score):
+            return 0
+        return float(score)/(votes+self.weight)
+
+    def get_bayesian_rating(self, content_type, score, votes):
+        """get_bayesian_rating(content_type, score, votes)
+
+        Returns the Bayesian average of the given tallies: their average rating,
+        with ``bayesian_weight`` extra votes (by default the mean number of votes
+        per object) at the mean rating of every object of ``content_type``."""
+        mean, weight = Score.objects.get_prior(content_type, self.key)
+        if self.bayesian_weight is not None:
+            weight = self.bayesian_weight
+        if not (votes + weight):
+            return 0
+        return (weight * mean + score) / float(votes + weight)
+
+    def get_wilson_score(self, score, votes):
+        """get_wilson_score(score, votes)
+
+        Returns the lower bound of the Wilson score interval (at 95% confidence)
+        of the share of positive votes, a vote of 2 being positive and 1 negative."""
+        if not votes:
+            return 0
+        z = 1.96
+        positive = float(score - votes) / votes
+        return (positive + z*z/(2*votes) - z * math.sqrt((positive*(1-positive) + z*z/(4*votes))/votes)) / (1 + z*z/votes)
+
+    def get_stored_rating_algorithms(self):
+        """Returns the ranking columns this field stores on the model, keyed by algorithm."""
+        algorithms = {}
+        if self.store_rating:
+            algorithms['weighted'] = self.rating_field_name
+        if self.store_bayesian:
+            algorithms['bayesian'] = self.bayesian_field_name
+        if self.store_wilson:
+            algorithms['wilson'] = self.wilson_field_name
+        return algorithms
+
+    def get_stored_rating_names(self):
+        """Returns the names of the ranking columns this field stores on the model."""
+        return self.get_stored_rating_algorithms().values()
+
+    def get_stored_ratings(self, content_type, score, votes):
+        """get_stored_ratings(content_type, score, votes)
+
+        Returns the values of the stored ranking columns for the given tallies, keyed by column name."""
+        values = {}
+        if self.store_rating:
+            values[self.rating_field_name] = self.get_weighted_rating(score, votes)
+        if self.store_bayesian:
+            values[self.bayesian_field_name] = self.get_bayesian_rating(content_type, score, votes)
+        if self.store_wilson:
+            values[self.wilson_field_name] = self.get_wilson_score(score, votes)
+        return values
+
+    def needs_tallies(self):
+        """Whether writing a vote needs the object's up to date tallies, to maintain rankings."""
+        return bool(self.get_stored_rating_names() or self.leaderboard)
+
+    def tallies_updated(self, object_id, score=None, votes=None):
+        """tallies_updated(object_id, score=None, votes=None)
+
+        Called whenever the tallies of an object were written, along with their
+        new values unless they were incremented without being read back."""
+        content_type = self.get_content_type(self.model)
+        if votes is None:
+            Score.objects.invalidate_cached(content_type, object_id, self.key)
+        else:
+            Score.objects.set_cached(content_type, object_id, self.key, score, votes)
+        if self.leaderboard:
+            leaderboards.update_leaderboards(self, object_id, score, votes)
+
+    def tallies_updated_in_bulk(self, tallies):
+        """tallies_updated_in_bulk(tallies)
+
+        Like ``tallies_updated``, for the ``(score, votes)`` tallies of several
+        objects keyed by object id."""
+        Score.objects.set_cached_in_bulk(self.get_content_type(self.model), self.key, tallies)
+        if self.leaderboard:
+            for object_id, (score, votes) in tallies.iteritems():
+                leaderboards.update_leaderboards(self, object_id, score, votes)
+
+    def get_leaderboard(self, order='weighted', limit=None):
+        """get_leaderboard(order='weighted', limit=None)
+
+        Returns the best rated objects, by ``'weighted'`` rating or by ``'votes'``,
+        from the leaderboard kept in the cache (only for fields declared with
+        ``leaderboard=True``). ``limit`` defaults to ``RATINGS_LEADERBOARD_SIZE``."""
+        if not self.leaderboard:
+            raise TypeError("%s does not keep a leaderboard" % (self.name,))
+        entries = leaderboards.get_leaderboard(self, order, limit)
+        objects = self.model._default_manager.in_bulk([object_id for object_id, value in entries])
+        return [objects[object_id] for object_id, value in entries if object_id in objects]
+
+    def get_cookie_name(self, content_type, object_id):
+        """get_cookie_name(content_type, object_id)
+
+        Returns the name of the cookie identifying an anonymous vote on an object."""
+        # TODO: move 'vote-%d.%d.%s' to settings or something
+        return 'vote-%d.%d.%s' % (content_type.pk, object_id, self.key[:6],) # -> md5_hexdigest?
+
+    def clean_vote(self, score, user):
+        """clean_vote(score, user)
+
+        Validates a vote against the field's rules and returns a ``(score, user, delete)``
+        tuple, where ``user`` is ``None`` for anonymous voters."""
+        try:
+            score = int(score)
+        except (ValueError, TypeError):
+            raise InvalidRating("%s is not a valid choice for %s" % (score, self.name))
+        
+        delete = (score == 0)
+        if delete and not self.allow_delete:
+            raise CannotDeleteVote("you are not allowed to delete votes for %s" % (self.name,))
+            # ... you're also can't delete your vote if you haven't permissions to change it. I leave this case for CannotChangeVote
+        
+        if score < 0 or score > self.range:
+            raise InvalidRating("%s is not a valid choice for %s" % (score, self.name))
+
+        is_anonymous = (user is None or not user.is_authenticated())
+        if is_anonymous and not self.allow_anonymous:
+            raise AuthRequired("user must be a user, not '%r'" % (user,))
+        
+        if is_anonymous:
+            user = None
+        return score, user, delete
+
     def get_db_prep_save(self, value):
         # XXX: what happens here?
         pass
@@ -369,6 +650,7 @@ class RatingField(IntegerField):
     def get_db_prep_lookup(self, lookup_type, value):
         # TODO: hack in support for __score and __votes
         # TODO: order_by on this field should use the weighted algorithm
+        #       (for now, see RatedQuerySet.order_by_rating)
         raise NotImplementedError(self.get_db_prep_lookup)
         # if lookup_type in ('score', 'votes'):
         #     lookup_type = 
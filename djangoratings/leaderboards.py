@@ -0,0 +1,123 @@
+"""
+Leaderboards of the best rated objects, kept in the cache.
+
+Each leaderboard holds up to twice ``RATINGS_LEADERBOARD_SIZE`` ``(value,
+object_id)`` entries for a rating field, along with a ``floor``: no object
+missing from the leaderboard has a value above it. Entries are updated as
+the tallies of objects change; whenever the entries above the floor are not
+enough to answer a read, the leaderboard is rebuilt from the ``Score`` table.
+"""
+from django.conf import settings
+from django.db import connections
+
+from models import Score
+from default_settings import RATINGS_LEADERBOARD_SIZE
+from caching import cache, get_cache_key, get_cache_timeout, lock, unlock
+
+__all__ = ('get_leaderboard', 'update_leaderboards', 'rebuild_leaderboard', 'ORDERS')
+
+ORDERS = ('weighted', 'votes')
+
+def get_size():
+    return getattr(settings, 'RATINGS_LEADERBOARD_SIZE', RATINGS_LEADERBOARD_SIZE)
+
+def _get_cache_key(field, order):
+    return get_cache_key('leaderboard', field.get_content_type(field.model).pk, field.key, order)
+
+def _get_value(field, order, score, votes):
+    if order == 'votes':
+        return votes
+    return field.get_weighted_rating(score, votes)
+
+def _sort(entries):
+    entries.sort(key=lambda entry: (-entry[0], entry[1]))
+
+def _load_entries(field, order, count):
+    """Reads the ``count`` best ``(value, object_id)`` entries from the ``Score`` table."""
+    if order not in ORDERS:
+        raise ValueError("%r is not a valid leaderboard order" % (order,))
+    qs = Score.objects.filter(
+        content_type    = field.get_content_type(field.model),
+        key             = field.key,
+        votes__gt       = 0,
+    )
+    if order == 'votes':
+        qs = qs.order_by('-votes')
+    else:
+        qn = connections[qs.db].ops.quote_name
+        params = dict(score=qn('score'), votes=qn('votes'), weight=field.weight)
+        qs = qs.extra(select={
+            'weighted': 'CASE WHEN %(votes)s + %(weight)s > 0 THEN %(score)s * 1.0 / (%(votes)s + %(weight)s) ELSE 0 END' % params,
+        }).order_by('-weighted')
+    entries = [(_get_value(field, order, score.score, score.votes), score.object_id) for score in qs[:count]]
+    _sort(entries)
+    return entries
+
+def rebuild_leaderboard(field, order):
+    """rebuild_leaderboard(field, order)
+
+    Rebuilds a leaderboard from the ``Score`` table, and returns it."""
+    capacity = 2 * get_size()
+    entries = _load_entries(field, order, capacity)
+
+    # every object was loaded, unless the leaderboard is full
+    floor = None
+    if len(entries) == capacity:
+        floor = entries[-1][0]
+    board = dict(entries=entries, floor=floor)
+    cache_key = _get_cache_key(field, order)
+    if lock(cache_key, attempts=1):
+        try:
+            cache.set(cache_key, board, get_cache_timeout())
+        finally:
+            unlock(cache_key)
+    return board
+
+def get_leaderboard(field, order='weighted', limit=None):
+    """get_leaderboard(field, order='weighted', limit=None)
+
+    Returns the ``limit`` best rated objects of a rating field as a list of
+    ``(object_id, value)`` tuples, best first."""
+    if limit is None:
+        limit = get_size()
+    if limit > 2 * get_size():
+        # more than the leaderboard can hold
+        return [(object_id, value) for value, object_id in _load_entries(field, order, limit)]
+    board = cache.get(_get_cache_key(field, order))
+    for attempt in (1, 2):
+        if board is None:
+            board = rebuild_leaderboard(field, order)
+        floor = board['floor']
+        entries = [(object_id, value) for value, object_id in board['entries'] if floor is None or value >= floor]
+        if floor is None or len(entries) >= limit or attempt == 2:
+            break
+        board = None
+    return entries[:limit]
+
+def update_leaderboards(field, object_id, score, votes):
+    """update_leaderboards(field, object_id, score, votes)
+
+    Moves an object within the leaderboards of a rating field after its tallies changed."""
+    capacity = 2 * get_size()
+    for order in ORDERS:
+        cache_key = _get_cache_key(field, order)
+        if not lock(cache_key):
+            # we can't update it safely, it will be rebuilt on the next read
+            cache.delete(cache_key)
+            continue
+        try:
+            board = cache.get(cache_key)
+            if board is None:
+                continue
+            floor = board['floor']
+            value = _get_value(field, order, score, votes)
+            entries = [entry for entry in board['entries'] if entry[1] != object_id]
+            if votes and (floor is None or value > floor):
+                entries.append((value, object_id))
+                _sort(entries)
+            if len(entries) > capacity:
+                floor = max([floor] + [entry[0] for entry in entries[capacity:]])
+                entries = entries[:capacity]
+            cache.set(cache_key, dict(entries=entries, floor=floor), get_cache_timeout())
+        finally:
+            unlock(cache_key)
@@ -0,0 +1,160 @@
+"""
+Approximate discovery of similar users with MinHash and locality-sensitive
+hashing, for ``update_recommendations(approximate=True)``.
+
+Each user is sketched by the set of their ``(content_type, object_id, key,
+score)`` votes, so that two users who gave an object different scores share
+nothing on it. A MinHash signature of ``bands * rows`` values estimates the
+Jaccard similarity of two such sets. Signatures are cut into ``bands`` bands of
+``rows`` values, and two users sharing any band become candidates: a pair
+whose sets have a Jaccard similarity ``s`` is found with a probability of
+``1 - (1 - s ** rows) ** bands``. More bands raise the recall, more rows the
+precision. Only the candidates then have their agreements counted exactly.
+
+The index lives in the memory of the process running the rebuild. Each user
+takes an array of one machine integer per band; the buckets are then filled a
+band at a time, keeping only the ones shared by several users.
+"""
+import random
+from array import array
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+
+from models import SimilarUser
+from default_settings import RATINGS_LSH_BANDS, RATINGS_LSH_ROWS
+from similarity import iter_user_blocks, compute_similarities, _get_user_votes
+
+__all__ = ('MinHashIndex', 'build_index', 'compare_with_exact')
+
+# a Mersenne prime, so that (a * x + b) fits in 64 bits
+PRIME = (1 << 31) - 1
+
+class MinHashIndex(object):
+    def __init__(self, bands=None, rows=None, seed=0):
+        if bands is None:
+            bands = getattr(settings, 'RATINGS_LSH_BANDS', RATINGS_LSH_BANDS)
+        if rows is None:
+            rows = getattr(settings, 'RATINGS_LSH_ROWS', RATINGS_LSH_ROWS)
+        self.bands = bands
+        self.rows = rows
+        generator = random.Random(seed)
+        self.a = [generator.randint(1, PRIME - 1) for i in xrange(bands * rows)]
+        self.b = [generator.randint(0, PRIME - 1) for i in xrange(bands * rows)]
+        self.buckets = None
+        self.keys = {}
+
+    def signature(self, tokens):
+        """signature(tokens)
+
+        Returns the MinHash signature of a set of hashable tokens."""
+        values = [hash(token) % PRIME for token in tokens]
+        if numpy is not None:
+            x = numpy.array(values, dtype=numpy.int64)
+            a = numpy.array(self.a, dtype=numpy.int64)[:, numpy.newaxis]
+            b = numpy.array(self.b, dtype=numpy.int64)[:, numpy.newaxis]
+            return ((a * x + b) % PRIME).min(axis=1).tolist()
+        return [min([(a * x + b) % PRIME for x in values]) for a, b in zip(self.a, self.b)]
+
+    def add(self, user_id, tokens):
+        """add(user_id, tokens)
+
+        Keeps the bucket key of each band of a user's signature."""
+        signature = self.signature(tokens)
+        self.keys[user_id] = array('l', [hash((band,) + tuple(signature[band * self.rows:(band + 1) * self.rows]))
+                                         for band in xrange(self.bands)])
+        self.buckets = None
+
+    def fill_buckets(self):
+        """fill_buckets()
+
+        Files the users under their buckets, one band at a time, keeping only the
+        buckets shared by several users since the others yield no candidates."""
+        self.buckets = {}
+        for band in xrange(self.bands):
+            buckets = {}
+            for user_id, keys in self.keys.iteritems():
+                buckets.setdefault(keys[band], []).append(user_id)
+            for key, user_ids in buckets.iteritems():
+                if len(user_ids) > 1:
+                    self.buckets.setdefault(key, array('l')).extend(user_ids)
+
+    def candidates(self, user_id):
+        """candidates(user_id)
+
+        Returns the ids of the users sharing a bucket with ``user_id``."""
+        if self.buckets is None:
+            self.fill_buckets()
+        found = set()
+        for key in self.keys.get(user_id, ()):
+            found.update(self.buckets.get(key, ()))
+        found.discard(user_id)
+        return found
+
+def build_index(block_size=1000, bands=None, rows=None, seed=0):
+    """build_index(block_size=1000, bands=None, rows=None, seed=0)
+
+    Sketches every registered voter, loading the votes of ``block_size`` users
+    at a time, and returns the resulting ``MinHashIndex``. ``bands``
+    and ``rows`` default to ``RATINGS_LSH_BANDS`` and ``RATINGS_LSH_ROWS``."""
+    index = MinHashIndex(bands, rows, seed)
+    for user_ids in iter_user_blocks(block_size):
+        tokens = {}
+        for content_type, object_id, key, user_id, score in _get_user_votes(user_ids):
+            tokens.setdefault(user_id, []).append((content_type, object_id, key, score))
+        for user_id, user_tokens in tokens.iteritems():
+            index.add(user_id, user_tokens)
+    index.fill_buckets()
+    return index
+
+def compare_with_exact(block_size=1000, bands=None, rows=None, metric=None, min_agreement=None, min_similarity=None):
+    """compare_with_exact(block_size=1000, bands=None, rows=None, metric=None, min_agreement=None, min_similarity=None)
+
+    Finds the pairs of similar users both exactly and through a ``MinHashIndex``,
+    without writing them, and returns a dict of:
+
+    * ``similar`` - the number of similar pairs
+    * ``candidates`` - the number of candidate pairs
+    * ``found`` - the number of similar pairs among the candidates
+    * ``recall`` - the share of similar pairs which were found
+    * ``precision`` - the share of candidates which are similar
+    * ``exact_seconds`` and ``approximate_seconds`` - the time each method took
+
+    The thresholds default as in ``update_recommendations``."""
+    metric, min_agreement, min_similarity = SimilarUser.objects._get_thresholds(min_agreement, metric, min_similarity)
+
+    def get_similar(user_ids, candidates=None):
+        similarities = compute_similarities(user_ids, metric, candidates)
+        return set([(row.from_user_id, row.to_user_id) for row in
+                    SimilarUser.objects._get_rows(similarities, set(), 0, min_agreement, min_similarity)])
+
+    started = time.time()
+    exact = set()
+    for user_ids in iter_user_blocks(block_size):
+        exact.update(get_similar(user_ids))
+    exact_seconds = time.time() - started
+
+    started = time.time()
+    index = build_index(block_size, bands, rows)
+    approximate, candidates = set(), 0
+    for user_ids in iter_user_blocks(block_size):
+        block = dict([(user_id, index.candidates(user_id)) for user_id in user_ids])
+        candidates += sum([len(to_user_ids) for to_user_ids in block.itervalues()])
+        approximate.update(get_similar(user_ids, block))
+    approximate_seconds = time.time() - started
+
+    found = len(exact & approximate)
+    return dict(
+        similar             = len(exact),
+        candidates          = candidates,
+        found               = found,
+        recall              = exact and float(found) / len(exact) or 1.0,
+        precision           = candidates and float(found) / candidates or 1.0,
+        exact_seconds       = exact_seconds,
+        approximate_seconds = approximate_seconds,
+    )
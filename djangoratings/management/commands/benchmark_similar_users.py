@@ -0,0 +1,26 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from djangoratings.lsh import compare_with_exact
+
+class Command(NoArgsCommand):
+    help = ('Finds the pairs of similar users both exactly and with MinHash/LSH, without writing them, '
+            'and reports the recall and precision of the approximation.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--block-size', action='store', dest='block_size', type='int', default=1000,
+            help='Number of users processed at a time.'),
+        make_option('--bands', action='store', dest='bands', type='int', default=None,
+            help='Number of LSH bands, defaults to RATINGS_LSH_BANDS.'),
+        make_option('--rows', action='store', dest='rows', type='int', default=None,
+            help='Number of rows per LSH band, defaults to RATINGS_LSH_ROWS.'),
+    )
+
+    def handle_noargs(self, **options):
+        for name in ('block_size', 'bands', 'rows'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError('--%s must be a positive number' % (name.replace('_', '-'),))
+        results = compare_with_exact(options['block_size'], options['bands'], options['rows'])
+        self.stdout.write('exact: %(similar)d similar pairs in %(exact_seconds).2fs\n'
+                          'approximate: %(candidates)d candidate pairs, %(found)d similar in %(approximate_seconds).2fs\n'
+                          'recall: %(recall).3f, precision: %(precision).3f\n' % results)
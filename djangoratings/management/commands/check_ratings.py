@@ -0,0 +1,100 @@
+import itertools
+import multiprocessing
+import os
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import get_model
+
+from djangoratings.models import Score
+from djangoratings.management.commands.rebuild_ratings import get_rated_models, iter_chunks
+
+def check_chunk(task):
+    """check_chunk((label, object_ids, repair))
+
+    Checks a chunk of objects, repairing them when asked to, and returns their
+    mismatches. Runs in the worker processes, hence the picklable arguments."""
+    label, object_ids, repair = task
+    model = get_model(*label.split('.'))
+    mismatches = Score.objects.find_mismatches(model, object_ids)
+    if repair and mismatches:
+        with transaction.commit_on_success(using=Score.objects.db):
+            Score.objects.recalculate(model, [mismatch[0] for mismatch in mismatches])
+    return [(object_id, field.name, votes, score, columns) for object_id, field, votes, score, columns in mismatches]
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ('Compares the votes of every rated object with its Score rows and <field>_score/<field>_votes '
+            'columns, and reports (or repairs) the ones which disagree.')
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+            help='Number of objects checked per query.'),
+        make_option('--repair', action='store_true', dest='repair', default=False,
+            help='Recompute the mismatching objects from their votes.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=1,
+            help='Number of processes checking chunks in parallel.'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='File recording the progress, to resume an interrupted run from. It is removed once every model was checked.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size, workers = options['chunk_size'], options['workers']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be a positive number')
+        if workers < 1:
+            raise CommandError('--workers must be a positive number')
+        models = get_rated_models(args)
+
+        checkpoint = {}
+        if options['checkpoint'] and os.path.exists(options['checkpoint']):
+            with open(options['checkpoint']) as fp:
+                checkpoint = json.load(fp)
+
+        pool = None
+        if workers > 1:
+            # the workers must open their own database connections
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(workers)
+        try:
+            for model in models:
+                label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+                checked, found = 0, 0
+                chunks = iter_chunks(model, chunk_size, checkpoint.get(label))
+                while True:
+                    # keep a bounded number of chunks in flight
+                    tasks = [(label, object_ids, options['repair']) for object_ids in itertools.islice(chunks, workers * 2)]
+                    if not tasks:
+                        break
+                    if pool is not None:
+                        results = pool.map(check_chunk, tasks)
+                    else:
+                        results = map(check_chunk, tasks)
+                    for mismatches in results:
+                        for object_id, field_name, votes, score, columns in mismatches:
+                            self.stdout.write('%s #%s %s: votes %s, Score %s, columns %s\n' % (
+                                label, object_id, field_name, votes, score or 'missing', columns))
+                        found += len(mismatches)
+                    checked += sum([len(task[1]) for task in tasks])
+
+                    checkpoint[label] = tasks[-1][1][-1]
+                    if options['checkpoint']:
+                        with open(options['checkpoint'], 'w') as fp:
+                            json.dump(checkpoint, fp)
+                if verbosity:
+                    self.stdout.write('%s: %d objects checked, %d mismatches%s\n' % (
+                        label, checked, found, options['repair'] and ' repaired' or ''))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if options['checkpoint'] and os.path.exists(options['checkpoint']):
+            os.remove(options['checkpoint'])
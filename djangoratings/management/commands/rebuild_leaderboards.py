@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db.models import get_models
+
+from djangoratings.leaderboards import rebuild_leaderboard, ORDERS
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the leaderboards of the rating fields declared with leaderboard=True, e.g. after the cache was flushed.'
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in get_models():
+            for field in getattr(model, '_djangoratings', []):
+                if not field.leaderboard or field.model is not model:
+                    continue
+                for order in ORDERS:
+                    board = rebuild_leaderboard(field, order)
+                    if verbosity:
+                        self.stdout.write('%s.%s (%s): %d entries\n' % (model._meta.object_name, field.name, order, len(board['entries'])))
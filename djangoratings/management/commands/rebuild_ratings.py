@@ -0,0 +1,72 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model, get_models
+
+from djangoratings.models import Score
+
+def get_rated_models(labels):
+    """get_rated_models(labels)
+
+    Returns the models named by ``app_label.ModelName`` labels, or every model
+    with rating fields when no label is given."""
+    if not labels:
+        return [model for model in get_models() if getattr(model, '_djangoratings', None)]
+    models = []
+    for label in labels:
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('%r is not of the form app_label.ModelName' % (label,))
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % (label,))
+        if not getattr(model, '_djangoratings', None):
+            raise CommandError('%s has no rating fields' % (label,))
+        models.append(model)
+    return models
+
+def iter_chunks(model, chunk_size, last_pk=None):
+    """iter_chunks(model, chunk_size, last_pk=None)
+
+    Yields the pks of every ``model`` object after ``last_pk``, in lists of
+    ``chunk_size`` ordered by pk. Each chunk is read with an index range scan
+    starting after the previous one, so no result set stays open in between."""
+    while True:
+        qs = model._default_manager.order_by('pk')
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        object_ids = list(qs.values_list('pk', flat=True)[:chunk_size])
+        if not object_ids:
+            return
+        yield object_ids
+        last_pk = object_ids[-1]
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Recomputes the Score rows and the <field>_score/<field>_votes columns of every rated object from their votes.'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+            help='Number of objects recomputed per query.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be a positive number')
+
+        for model in get_rated_models(args):
+            self.rebuild(model, chunk_size, verbosity)
+
+    def rebuild(self, model, chunk_size, verbosity):
+        name = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        total = model._default_manager.count()
+        done = 0
+        for object_ids in iter_chunks(model, chunk_size):
+            with transaction.commit_on_success(using=Score.objects.db):
+                Score.objects.recalculate(model, object_ids)
+            done += len(object_ids)
+            if verbosity:
+                self.stdout.write('%s: %d/%d objects\n' % (name, done, total))
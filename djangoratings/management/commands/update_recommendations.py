@@ -1,7 +1,50 @@
+import time
+from optparse import make_option
+
 from django.core.management.base import NoArgsCommand, CommandError
 
 from djangoratings.models import SimilarUser
 
 class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--stale', action='store_true', dest='stale', default=False,
+            help='Only recompute the users queued by RATINGS_SIMILAR_USERS_UPDATE = "deferred".'),
+        make_option('--block-size', action='store', dest='block_size', type='int', default=1000,
+            help='Number of users per shard.'),
+        make_option('--workers', action='store', dest='workers', type='int', default=1,
+            help='Number of processes computing shards in parallel.'),
+        make_option('--approximate', action='store_true', dest='approximate', default=False,
+            help='Only compare the users found similar by MinHash/LSH.'),
+        make_option('--bands', action='store', dest='bands', type='int', default=None,
+            help='Number of LSH bands, defaults to RATINGS_LSH_BANDS.'),
+        make_option('--rows', action='store', dest='rows', type='int', default=None,
+            help='Number of rows per LSH band, defaults to RATINGS_LSH_ROWS.'),
+    )
+
     def handle_noargs(self, **options):
-        SimilarUser.objects.update_recommendations()
\ No newline at end of file
+        verbosity = int(options.get('verbosity', 1))
+        block_size, workers = options['block_size'], options['workers']
+        if block_size < 1:
+            raise CommandError('--block-size must be a positive number')
+        if workers < 1:
+            raise CommandError('--workers must be a positive number')
+
+        if options['stale']:
+            SimilarUser.objects.update_stale(block_size)
+            return
+
+        totals = dict(shards=0, users=0, rows=0)
+        def progress(shard, first_user_id, last_user_id, users, rows, seconds):
+            totals['shards'] += 1
+            totals['users'] += users
+            totals['rows'] += rows
+            if verbosity:
+                self.stdout.write('shard %d: users %s-%s, %d users, %d similar users in %.2fs\n' % (
+                    shard, first_user_id, last_user_id, users, rows, seconds))
+
+        started = time.time()
+        SimilarUser.objects.update_recommendations(block_size=block_size, workers=workers, progress=progress,
+            approximate=options['approximate'], bands=options['bands'], rows=options['rows'])
+        if verbosity:
+            self.stdout.write('%(shards)d shards, %(users)d users, %(rows)d similar users' % totals +
+                              ' in %.2fs\n' % (time.time() - started,))
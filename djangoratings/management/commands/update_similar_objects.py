@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from djangoratings.models import SimilarObject
+from djangoratings.management.commands.rebuild_ratings import get_rated_models
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = 'Rebuilds the objects most similar to every rated object, by the scores registered users gave them.'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=1000,
+            help='Number of objects compared at a time.'),
+        make_option('--max-votes', action='store', dest='max_votes', type='int', default=None,
+            help='Number of votes of their voters loaded at a time.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be a positive number')
+        max_votes = options.get('max_votes')
+        if max_votes is not None and max_votes < 1:
+            raise CommandError('--max-votes must be a positive number')
+
+        for model in get_rated_models(args):
+            for field in model._djangoratings:
+                SimilarObject.objects.rebuild(model, [field], chunk_size, max_votes=max_votes)
+                if verbosity:
+                    self.stdout.write('%s.%s.%s: %d similar objects\n' % (
+                        model._meta.app_label, model._meta.object_name, field.name,
+                        SimilarObject.objects.filter(content_type=field.get_content_type(model), key=field.key).count()))
@@ -1,33 +1,132 @@
-from django.db.models import Manager
+import multiprocessing
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connections, transaction, IntegrityError
+from django.db.models import Manager, F, Q, Sum, Count
 from django.db.models.query import QuerySet
 
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 import itertools
 
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.now
+
+from default_settings import RATINGS_VOTES_PER_IP, RATINGS_VOTES_PER_IP_CACHE, RATINGS_MIN_AGREEMENT, \
+                             RATINGS_SIMILAR_USERS_UPDATE, RATINGS_SIMILARITY_METRIC, RATINGS_MIN_SIMILARITY, \
+                             RATINGS_MATERIALIZED_RECOMMENDATIONS, RATINGS_RECOMMENDATIONS_SIZE, \
+                             RATINGS_SIMILAR_OBJECTS_SIZE
+from caching import cache, get_cache_key, get_cache_timeout, lock, unlock, get_generations, bump_generations
+from exceptions import *
+
+SIMILAR_USERS_GENERATION = 'similar_users'
+
+# objects recalculated per query when deleting votes in bulk
+RECALCULATE_CHUNK_SIZE = 500
+
+def _bulk_create(manager, objs):
+    """Inserts ``objs`` with as few queries as the running Django version allows."""
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(objs)
+    else:
+        for obj in objs:
+            obj.save(force_insert=True, using=manager.db)
+
+def _bulk_update(manager, rows, names):
+    """Writes the ``names`` columns of many rows, given as a dict of value tuples
+    keyed by primary key, with one ``UPDATE ... SET col = CASE pk WHEN ...``
+    statement per batch of rows rather than one per row."""
+    if not rows:
+        return
+    connection = connections[manager.db]
+    qn = connection.ops.quote_name
+    opts = manager.model._meta
+    fields = [opts.get_field(name) for name in names]
+    pk_column = qn(opts.pk.column)
+    # stay below the 999 parameters SQLite accepts in a statement
+    batch_size = max(1, 900 // (len(fields) * 2 + 1))
+    pks = sorted(rows)
+    cursor = connection.cursor()
+    for i in xrange(0, len(pks), batch_size):
+        batch = pks[i:i + batch_size]
+        assignments, params = [], []
+        for j, field in enumerate(fields):
+            column = qn(field.column)
+            assignments.append('%s = case %s %s else %s end' % (column, pk_column,
+                               ' '.join(['when %s then %s'] * len(batch)), column))
+            for pk in batch:
+                params.extend([pk, field.get_db_prep_save(rows[pk][j], connection=connection)])
+        params.extend(batch)
+        cursor.execute('update %s set %s where %s in (%s)' % (qn(opts.db_table), ', '.join(assignments),
+                       pk_column, ', '.join(['%s'] * len(batch))), params)
+    transaction.commit_unless_managed(using=manager.db)
+
+def build_shard(task):
+    """build_shard((shard, user_ids, generation, metric, min_agreement, min_similarity, excluded, candidates))
+
+    Computes and writes the ``SimilarUser`` rows of a block of users, see
+    ``SimilarUserManager.update_recommendations``. Returns the shard number,
+    its first and last user ids, its number of users and rows, and the seconds
+    it took."""
+    # XXX: circular import
+    from djangoratings.models import SimilarUser
+    from djangoratings.similarity import compute_similarities
+
+    shard, user_ids, generation, metric, min_agreement, min_similarity, excluded, candidates = task
+    started = time.time()
+    rows = SimilarUser.objects._get_rows(compute_similarities(user_ids, metric, candidates), set(excluded), generation,
+                                         min_agreement, min_similarity)
+    _bulk_create(SimilarUser.objects, rows)
+    return shard, user_ids[0], user_ids[-1], len(user_ids), len(rows), time.time() - started
+
+def _build_shard_in_transaction(task):
+    # XXX: circular import
+    from djangoratings.models import SimilarUser
+
+    with transaction.commit_on_success(using=SimilarUser.objects.db):
+        return build_shard(task)
+
 class VoteQuerySet(QuerySet):
     def delete(self, *args, **kwargs):
         """Handles updating the related `votes` and `score` fields attached to the model."""
         # XXX: circular import
-        from fields import RatingField
+        from djangoratings.models import Score, SimilarUser
+
+        affected = list(self.values_list('content_type', 'object_id', 'key').distinct().order_by())
+        voters = list(self.filter(user__isnull=False).values_list('user', flat=True).distinct().order_by())
+
+        if getattr(settings, 'RATINGS_VOTES_PER_IP_CACHE', RATINGS_VOTES_PER_IP_CACHE):
+            ip_counts = list(self.distinct().values_list('content_type', 'object_id', 'key', 'ip_address').order_by())
+        else:
+            ip_counts = []
+
+        # recalculate a content type and chunk of objects at a time, for all
+        # of their affected fields at once
+        to_update = {}
+        for content_type, object_id, key in affected:
+            object_ids, keys = to_update.setdefault(content_type, (set(), set()))
+            object_ids.add(object_id)
+            keys.add(key)
+
+        with transaction.commit_on_success(using=self.db):
+            retval = super(VoteQuerySet, self).delete(*args, **kwargs)
+            for content_type, (object_ids, keys) in to_update.iteritems():
+                model_class = ContentType.objects.get_for_id(content_type).model_class()
+                fields = [field for field in getattr(model_class, '_djangoratings', []) if field.key in keys]
+                if not fields:
+                    continue
+                object_ids = sorted(object_ids)
+                for i in xrange(0, len(object_ids), RECALCULATE_CHUNK_SIZE):
+                    Score.objects.recalculate(model_class, object_ids[i:i + RECALCULATE_CHUNK_SIZE], fields)
+            SimilarUser.objects.users_changed(voters)
+        self.model.objects.clear_counts_for_ip(ip_counts)
 
-        qs = self.distinct().values_list('content_type', 'object_id').order_by('content_type')
-    
-        to_update = []
-        for content_type, objects in itertools.groupby(qs, key=lambda x: x[0]):
-            model_class = ContentType.objects.get(pk=content_type).model_class()
-            if model_class:
-                to_update.extend(list(model_class.objects.filter(pk__in=list(objects)[0])))
-        
-        retval = super(VoteQuerySet, self).delete(*args, **kwargs)
-        
-        # TODO: this could be improved
-        for obj in to_update:
-            for field in getattr(obj, '_djangoratings', []):
-                getattr(obj, field.name)._update(commit=False)
-            obj.save()
-        
         return retval
-        
+
 class VoteManager(Manager):
     def get_query_set(self):
         return VoteQuerySet(self.model)
@@ -45,9 +144,714 @@ class VoteManager(Manager):
             vote_dict = {}
         return vote_dict
 
+    def get_for_voter_in_bulk(self, objects, field_names, user=None, ip_address=None, cookies={}):
+        """get_for_voter_in_bulk(objects, field_names, user=None, ip_address=None, cookies={})
+
+        Returns the votes cast by a user, or by an anonymous ``ip_address`` and
+        ``cookies``, on any number of ``objects`` (of any models) for one or more
+        rating fields, using one query per content type. The result maps
+        ``(object, field_name)`` to the ``Vote``; objects which were not voted on
+        are left out."""
+        # XXX: circular import
+        from fields import RatingField
+
+        if isinstance(field_names, basestring):
+            field_names = [field_names]
+        is_anonymous = (user is None or not user.is_authenticated())
+        if is_anonymous and not ip_address:
+            raise ValueError('``user`` or ``ip_address`` must be present.')
+
+        groups = {}
+        for obj in objects:
+            content_type = ContentType.objects.get_for_model(obj)
+            objs, fields = groups.setdefault(content_type, ({}, {}))
+            objs[obj.pk] = obj
+            for name in field_names:
+                field = getattr(obj.__class__, name, None)
+                if isinstance(field, RatingField):
+                    fields[field.key] = field
+
+        votes = {}
+        for content_type, (objs, fields) in groups.iteritems():
+            if not fields:
+                continue
+            qs = self.filter(content_type=content_type, object_id__in=objs.keys(), key__in=fields.keys())
+            if is_anonymous:
+                qs = qs.filter(user__isnull=True, ip_address=ip_address)
+            else:
+                qs = qs.filter(user=user)
+            for vote in qs:
+                field = fields[vote.key]
+                if field.allow_anonymous and field.use_cookies:
+                    if vote.cookie != (cookies.get(field.get_cookie_name(content_type, vote.object_id)) or None):
+                        continue
+                votes.setdefault((objs[vote.object_id], field.name), vote)
+        return votes
+
+    def count_for_ip(self, content_type, object_id, key, ip_address, limit=None):
+        """count_for_ip(content_type, object_id, key, ip_address, limit=None)
+
+        Returns the number of votes cast from ``ip_address`` on an object's rating
+        field. When ``RATINGS_VOTES_PER_IP_CACHE`` is set the count is kept in the
+        cache and the database is only queried on a miss, or in ``'strict'`` mode
+        when the cached count is below ``limit``."""
+        content_type_id = getattr(content_type, 'pk', content_type)
+        qs = self.filter(content_type=content_type_id, object_id=object_id, key=key, ip_address=ip_address)
+        mode = getattr(settings, 'RATINGS_VOTES_PER_IP_CACHE', RATINGS_VOTES_PER_IP_CACHE)
+        if not mode:
+            return qs.count()
+
+        cache_key = get_cache_key('ip', content_type_id, object_id, key, ip_address)
+        count = cache.get(cache_key)
+        if count is None:
+            count = qs.count()
+            # another process may have seeded, then incremented, the count since
+            # it was read; overwriting it would undercount
+            if not cache.add(cache_key, count, get_cache_timeout()):
+                count = max(count, cache.get(cache_key, count))
+        elif mode == 'strict' and limit is not None and count < limit:
+            # a count missing concurrent votes would let the IP go over its limit
+            count = qs.count()
+            cache.set(cache_key, count, get_cache_timeout())
+        return count
+
+    def adjust_count_for_ip(self, content_type, object_id, key, ip_address, delta):
+        """Keeps a cached ``count_for_ip`` in sync after a vote was added (``delta`` of 1)
+        or removed (``delta`` of -1)."""
+        if not getattr(settings, 'RATINGS_VOTES_PER_IP_CACHE', RATINGS_VOTES_PER_IP_CACHE):
+            return
+        cache_key = get_cache_key('ip', getattr(content_type, 'pk', content_type), object_id, key, ip_address)
+        try:
+            if delta > 0:
+                cache.incr(cache_key, delta)
+            else:
+                cache.decr(cache_key, -delta)
+        except ValueError:
+            # not cached, the next count_for_ip() reads it from the database
+            pass
+
+    def clear_counts_for_ip(self, votes):
+        """Drops the cached ``count_for_ip`` of each ``(content_type, object_id, key, ip_address)``
+        tuple in ``votes``."""
+        if not getattr(settings, 'RATINGS_VOTES_PER_IP_CACHE', RATINGS_VOTES_PER_IP_CACHE):
+            return
+        cache.delete_many([get_cache_key('ip', getattr(content_type, 'pk', content_type), object_id, key, ip_address)
+                           for content_type, object_id, key, ip_address in votes])
+
+    def bulk_add(self, votes, fail_silently=False, batch_size=500):
+        """bulk_add(votes, fail_silently=False, batch_size=500)
+
+        Records many votes at once. ``votes`` is an iterable of
+        ``(instance, field_name, user, ip_address, cookie, score)`` tuples, which
+        are checked with the same rules as ``RatingManager.add`` (a score of 0
+        deletes the vote). Each batch is written with a handful of queries, and
+        the ``Score`` rows and denormalized columns of every affected object are
+        then recalculated once.
+
+        Returns a dict holding the number of votes ``added``, ``changed`` and
+        ``deleted``. A vote breaking a rule raises the matching exception and
+        rolls back its batch, unless ``fail_silently`` is set, in which case it
+        is skipped and listed as a ``(vote, exception)`` pair under ``rejected``."""
+        result = dict(added=0, changed=0, deleted=0, rejected=[])
+        votes = iter(votes)
+        while True:
+            batch = list(itertools.islice(votes, batch_size))
+            if not batch:
+                break
+            with transaction.commit_on_success(using=self.db):
+                self._bulk_add_batch(batch, fail_silently, result)
+        return result
+
+    def _bulk_add_batch(self, batch, fail_silently, result):
+        # XXX: circular import
+        from fields import RatingField
+        from djangoratings.models import Score, SimilarUser
+
+        votes_per_ip = getattr(settings, 'RATINGS_VOTES_PER_IP', RATINGS_VOTES_PER_IP)
+
+        groups = {}
+        for item in batch:
+            instance, field_name, user, ip_address, cookie, score = item
+            field = getattr(instance.__class__, field_name, None)
+            if not isinstance(field, RatingField):
+                raise AttributeError("%r has no rating field %r" % (instance.__class__, field_name))
+            try:
+                score, user, delete = field.clean_vote(score, user)
+            except (InvalidRating, AuthRequired, CannotDeleteVote), e:
+                if not fail_silently:
+                    raise
+                result['rejected'].append((item, e))
+                continue
+            groups.setdefault((instance.__class__, field), []).append(
+                (item, instance.pk, user and user.pk, ip_address, cookie, score, delete))
+
+        for (model, field), items in groups.iteritems():
+            content_type = ContentType.objects.get_for_model(model)
+            use_cookies = (field.allow_anonymous and field.use_cookies)
+
+            def identity(object_id, user_id, ip_address, cookie):
+                return (object_id, user_id, user_id is None and ip_address or None, use_cookies and cookie or None)
+
+            # Load every vote these voters already cast on these objects, along
+            # with every vote from their IPs (needed for the IP limit)
+            lookup = Q(ip_address__in=set([i[3] for i in items]))
+            user_ids = set([i[2] for i in items if i[2]])
+            if user_ids:
+                lookup |= Q(user__in=user_ids)
+            existing = self.filter(
+                content_type    = content_type,
+                key             = field.key,
+                object_id__in   = set([i[1] for i in items]),
+            ).filter(lookup).values_list('pk', 'object_id', 'user', 'ip_address', 'cookie', 'score')
+
+            state = {}
+            ip_counts = {}
+            for pk, object_id, user_id, ip_address, cookie, score in existing:
+                state.setdefault(identity(object_id, user_id, ip_address, cookie), dict(
+                    pk=pk, object_id=object_id, user_id=user_id, ip_address=ip_address,
+                    cookie=cookie, score=score, original=score, deleted=False,
+                ))
+                ip_counts[(object_id, ip_address)] = ip_counts.get((object_id, ip_address), 0) + 1
+
+            touched = set()
+            for item, object_id, user_id, ip_address, cookie, score, delete in items:
+                key = identity(object_id, user_id, ip_address, cookie)
+                vote = state.get(key)
+                try:
+                    if vote is None or vote['deleted']:
+                        if delete:
+                            raise CannotDeleteVote("attempt to find and delete your vote for %s is failed" % (field.name,))
+                        if votes_per_ip and ip_counts.get((object_id, ip_address), 0) >= votes_per_ip:
+                            raise IPLimitReached()
+                    elif not field.can_change_vote:
+                        raise CannotChangeVote()
+                except (CannotDeleteVote, IPLimitReached, CannotChangeVote), e:
+                    if not fail_silently:
+                        raise
+                    result['rejected'].append((item, e))
+                    continue
+
+                if vote is None:
+                    vote = state[key] = dict(
+                        pk=None, object_id=object_id, user_id=user_id, ip_address=ip_address,
+                        cookie=cookie, score=score, original=None, deleted=False,
+                    )
+                    ip_counts[(object_id, ip_address)] = ip_counts.get((object_id, ip_address), 0) + 1
+                elif vote['deleted']:
+                    vote.update(score=score, deleted=False)
+                    ip_counts[(object_id, vote['ip_address'])] += 1
+                elif delete:
+                    vote['deleted'] = True
+                    ip_counts[(object_id, vote['ip_address'])] -= 1
+                else:
+                    vote['score'] = score
+                touched.add(object_id)
+
+            added, changed, deleted, voters = [], {}, [], set()
+            for vote in state.itervalues():
+                if vote['pk'] is None:
+                    if not vote['deleted']:
+                        voters.add(vote['user_id'])
+                        added.append(self.model(
+                            content_type    = content_type,
+                            object_id       = vote['object_id'],
+                            key             = field.key,
+                            user_id         = vote['user_id'],
+                            ip_address      = vote['ip_address'],
+                            cookie          = vote['cookie'],
+                            score           = vote['score'],
+                        ))
+                elif vote['deleted']:
+                    voters.add(vote['user_id'])
+                    deleted.append(vote['pk'])
+                elif vote['score'] != vote['original']:
+                    voters.add(vote['user_id'])
+                    changed.setdefault(vote['score'], []).append(vote['pk'])
+
+            _bulk_create(self, added)
+            for score, pks in changed.iteritems():
+                self.filter(pk__in=pks).update(score=score, date_changed=now())
+            if deleted:
+                # skip VoteQuerySet.delete, the aggregates are recalculated below
+                QuerySet.delete(self.filter(pk__in=deleted))
+
+            self.clear_counts_for_ip([(content_type, vote['object_id'], field.key, vote['ip_address'])
+                                      for vote in state.itervalues() if vote['pk'] is None or vote['deleted']])
+
+            result['added'] += len(added)
+            result['changed'] += sum([len(pks) for pks in changed.itervalues()])
+            result['deleted'] += len(deleted)
+
+            Score.objects.recalculate(model, touched, [field])
+            SimilarUser.objects.users_changed(voters)
+
+class RatedQuerySet(QuerySet):
+    """A QuerySet for models with rating fields, which orders and filters them by
+    rating in the database.
+
+    ``algorithm`` is one of ``'weighted'`` (``get_rating()``, which uses the
+    ``<field>_rating`` column of fields declared with ``store_rating=True``),
+    ``'average'`` (``get_real_rating()``) or ``'votes'``."""
+    operators = {
+        'exact': '=',
+        'gt': '>',
+        'gte': '>=',
+        'lt': '<',
+        'lte': '<=',
+    }
+
+    def _get_rating_lookup(self, field_name, algorithm):
+        """Returns a ``(column, sql)`` tuple, where only ``column`` is set when the
+        rating is stored on the model."""
+        field = getattr(self.model, field_name)
+        if algorithm == 'votes':
+            return field.votes_field_name, None
+        if algorithm in field.get_stored_rating_algorithms():
+            return field.get_stored_rating_algorithms()[algorithm], None
+
+        qn = connections[self.db].ops.quote_name
+        opts = self.model._meta
+        params = dict(
+            score='%s.%s' % (qn(opts.db_table), qn(opts.get_field(field.score_field_name).column)),
+            votes='%s.%s' % (qn(opts.db_table), qn(opts.get_field(field.votes_field_name).column)),
+            weight=field.weight,
+        )
+        if algorithm == 'weighted':
+            return None, 'CASE WHEN %(votes)s + %(weight)s > 0 THEN %(score)s * 1.0 / (%(votes)s + %(weight)s) ELSE 0 END' % params
+        if algorithm == 'average':
+            return None, 'CASE WHEN %(votes)s > 0 THEN %(score)s * 1.0 / %(votes)s ELSE 0 END' % params
+        raise ValueError("%r is not a valid rating algorithm for %s" % (algorithm, field_name))
+
+    def order_by_rating(self, field_name, algorithm='weighted', descending=True):
+        """order_by_rating(field_name, algorithm='weighted', descending=True)
+
+        Orders the objects by rating, best first unless ``descending`` is False."""
+        column, sql = self._get_rating_lookup(field_name, algorithm)
+        qs = self
+        if column is None:
+            column = '%s_%s' % (field_name, algorithm)
+            qs = qs.extra(select={column: sql})
+        return qs.order_by('%s%s' % (descending and '-' or '', column))
+
+    def filter_by_rating(self, field_name, algorithm='weighted', **lookups):
+        """filter_by_rating(field_name, algorithm='weighted', **lookups)
+
+        Filters the objects by rating, e.g. ``filter_by_rating('rating', gte=3)``."""
+        qs = self
+        column, sql = self._get_rating_lookup(field_name, algorithm)
+        for lookup, value in lookups.iteritems():
+            if lookup not in self.operators:
+                raise ValueError("%r is not a valid rating lookup" % (lookup,))
+            if column is None:
+                qs = qs.extra(where=['%s %s %%s' % (sql, self.operators[lookup])], params=[value])
+            else:
+                qs = qs.filter(**{'%s__%s' % (column, lookup): value})
+        return qs
+
+class RatedManager(Manager):
+    """A Manager for models with rating fields, see ``RatedQuerySet``."""
+    def get_query_set(self):
+        return RatedQuerySet(self.model, using=self._db)
+
+    def order_by_rating(self, *args, **kwargs):
+        return self.get_query_set().order_by_rating(*args, **kwargs)
+
+    def filter_by_rating(self, *args, **kwargs):
+        return self.get_query_set().filter_by_rating(*args, **kwargs)
+
+def _supports_upsert(connection):
+    """Whether ``connection`` can insert-or-update a row in a single statement."""
+    if connection.vendor == 'mysql':
+        return True
+    if connection.vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 24)
+    if connection.vendor == 'postgresql':
+        version = getattr(connection, 'pg_version', None)
+        if version is None:
+            return tuple(connection.ops.postgres_version[:2]) >= (9, 5)
+        return version >= 90500
+    return False
+
+def _increment(manager, lookups, deltas):
+    """Adds ``deltas``, a dict of column amounts, to the row of ``manager``'s model
+    matching the unique ``lookups``, creating the row when it does not exist yet."""
+    connection = connections[manager.db]
+    if _supports_upsert(connection):
+        _upsert(manager, connection, lookups, deltas)
+        return
+
+    expressions = dict([(name, F(name) + value) for name, value in deltas.iteritems()])
+    if manager.filter(**lookups).update(**expressions):
+        return
+    values = dict(lookups)
+    values.update(deltas)
+    sid = transaction.savepoint(using=manager.db)
+    try:
+        manager.create(**values)
+    except IntegrityError:
+        # someone else created the row in the meantime
+        transaction.savepoint_rollback(sid, using=manager.db)
+        manager.filter(**lookups).update(**expressions)
+    else:
+        transaction.savepoint_commit(sid, using=manager.db)
+
+def _upsert(manager, connection, lookups, deltas):
+    qn = connection.ops.quote_name
+    opts = manager.model._meta
+    # the other columns are inserted with their defaults
+    defaults = [(field.column, field.get_db_prep_save(field.get_default(), connection=connection))
+                for field in opts.local_fields if not field.primary_key and field.name not in lookups and field.name not in deltas]
+    lookups, deltas = lookups.items(), deltas.items()
+    table = qn(opts.db_table)
+    unique = [qn(opts.get_field(name).column) for name, value in lookups]
+    columns = [qn(opts.get_field(name).column) for name, value in deltas]
+    inserted = unique + columns + [qn(column) for column, value in defaults]
+    sql = """insert into %s
+      (%s)
+      values (%s)""" % (table, ', '.join(inserted), ', '.join(['%s'] * len(inserted)))
+    if connection.vendor == 'mysql':
+        sql += """
+      on duplicate key update %s""" % (', '.join(['%s = %s + values(%s)' % (c, c, c) for c in columns]),)
+    else:
+        sql += """
+      on conflict (%s)
+      do update set %s""" % (', '.join(unique), ', '.join(['%s = %s.%s + excluded.%s' % (c, table, c, c) for c in columns]))
+    params = [getattr(value, 'pk', value) for name, value in lookups] + [value for name, value in deltas] + \
+        [value for column, value in defaults]
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed(using=manager.db)
+
+class ScoreManager(Manager):
+    def increment(self, content_type, object_id, key, score, votes):
+        """Adds ``score`` and ``votes`` to a Score row in the database, creating
+        the row when it does not exist yet."""
+        _increment(self, dict(
+            content_type    = content_type,
+            object_id       = object_id,
+            key             = key,
+        ), dict(
+            score           = score,
+            votes           = votes,
+        ))
+
+    def get_prior(self, content_type, key):
+        """get_prior(content_type, key)
+
+        Returns the mean rating of all votes on the objects of ``content_type`` for a
+        rating field, and the mean number of votes per rated object, as a
+        ``(mean, weight)`` tuple. Both are cached for ``RATINGS_CACHE_TIMEOUT``."""
+        cache_key = get_cache_key('prior', content_type.pk, key)
+        prior = cache.get(cache_key)
+        if prior is None:
+            totals = self.filter(content_type=content_type, key=key, votes__gt=0).aggregate(
+                total_score=Sum('score'), total_votes=Sum('votes'), objects=Count('id'))
+            if totals['total_votes']:
+                prior = (float(totals['total_score']) / totals['total_votes'],
+                         float(totals['total_votes']) / totals['objects'])
+            else:
+                prior = (0, 0)
+            cache.set(cache_key, prior, get_cache_timeout())
+        return prior
+
+    def _get_tallies_cache_key(self, content_type, object_id, key):
+        return get_cache_key('score', content_type.pk, key, object_id)
+
+    def set_cached(self, content_type, object_id, key, score, votes):
+        """set_cached(content_type, object_id, key, score, votes)
+
+        Writes the tallies of an object to the cache."""
+        self.set_cached_in_bulk(content_type, key, {object_id: (score, votes)})
+
+    def set_cached_in_bulk(self, content_type, key, tallies):
+        """set_cached_in_bulk(content_type, key, tallies)
+
+        Writes the ``(score, votes)`` tallies of several objects, keyed by object
+        id, to the cache."""
+        timeout = get_cache_timeout()
+        expires = time.time() + timeout
+        # kept for twice as long as they are fresh, so stale tallies can be
+        # served while a single reader refreshes them
+        cache.set_many(dict([(self._get_tallies_cache_key(content_type, object_id, key), (score, votes, expires))
+                             for object_id, (score, votes) in tallies.iteritems()]), timeout * 2)
+
+    def invalidate_cached(self, content_type, object_id, key):
+        """invalidate_cached(content_type, object_id, key)
+
+        Drops the cached tallies of an object."""
+        cache.delete(self._get_tallies_cache_key(content_type, object_id, key))
+
+    def get_cached(self, model, object_id, field_name):
+        """get_cached(model, object_id, field_name)
+
+        Returns the ``(score, votes)`` tallies of a rating field for an object,
+        from the cache when possible. The object itself is not loaded."""
+        return self.get_cached_in_bulk(model, [object_id], field_name)[object_id]
+
+    def get_cached_in_bulk(self, model, object_ids, field_name):
+        """get_cached_in_bulk(model, object_ids, field_name)
+
+        Returns the ``(score, votes)`` tallies of a rating field for any number of
+        objects of ``model``, as a dict keyed by object id. Tallies missing from
+        the cache are read with a single query. Only one reader refreshes expired
+        tallies, the others being served the stale ones meanwhile, and readers
+        missing tallies which are being loaded wait a little for them."""
+        field = getattr(model, field_name)
+        content_type = field.get_content_type(model)
+        cache_keys = dict([(self._get_tallies_cache_key(content_type, object_id, field.key), object_id)
+                           for object_id in object_ids])
+
+        tallies, locked, waiting = {}, [], []
+        cached = cache.get_many(cache_keys.keys())
+        for cache_key, object_id in cache_keys.iteritems():
+            value = cached.get(cache_key)
+            if value is not None:
+                tallies[object_id] = value[:2]
+                if value[2] > time.time() or not lock(cache_key, attempts=1):
+                    # fresh, or being refreshed by someone else
+                    continue
+                locked.append(cache_key)
+            elif lock(cache_key, attempts=1):
+                locked.append(cache_key)
+            else:
+                waiting.append(cache_key)
+
+        for i in xrange(5):
+            if not waiting:
+                break
+            time.sleep(0.01)
+            cached = cache.get_many(waiting)
+            for cache_key, value in cached.iteritems():
+                tallies[cache_keys[cache_key]] = value[:2]
+            waiting = [cache_key for cache_key in waiting if cache_key not in cached]
+
+        to_load = [cache_keys[cache_key] for cache_key in locked + waiting]
+        if to_load:
+            try:
+                loaded = dict([(object_id, (0, 0)) for object_id in to_load])
+                rows = self.filter(
+                    content_type    = content_type,
+                    object_id__in   = to_load,
+                    key             = field.key,
+                ).values_list('object_id', 'score', 'votes')
+                for object_id, score, votes in rows:
+                    loaded[object_id] = (score, votes)
+                self.set_cached_in_bulk(content_type, field.key, loaded)
+                tallies.update(loaded)
+            finally:
+                for cache_key in locked:
+                    unlock(cache_key)
+        return tallies
+
+    def _get_vote_totals(self, content_type, object_ids, keys):
+        """Returns the ``(score, votes)`` tallies of the given objects and rating field
+        keys computed from their votes, keyed by ``(object_id, key)``."""
+        # XXX: circular import
+        from djangoratings.models import Vote
+
+        totals = dict([((object_id, key), (0, 0)) for object_id in object_ids for key in keys])
+        rows = Vote.objects.filter(
+            content_type    = content_type,
+            object_id__in   = object_ids,
+            key__in         = list(keys),
+        ).values('object_id', 'key').annotate(total_score=Sum('score'), total_votes=Count('id')).order_by()
+        for row in rows:
+            totals[(row['object_id'], row['key'])] = (row['total_score'], row['total_votes'])
+        return totals
+
+    def find_mismatches(self, model, object_ids, fields=None):
+        """find_mismatches(model, object_ids, fields=None)
+
+        Compares the tallies of the given ``model`` objects computed from their
+        votes with their Score rows and ``<field>_score``/``<field>_votes`` columns,
+        using one query for each. Returns a list of ``(object_id, field, votes,
+        score, columns)`` tuples for the tallies which disagree, each source being
+        a ``(score, votes)`` tuple, or ``None`` for a missing Score row."""
+        if fields is None:
+            fields = getattr(model, '_djangoratings', [])
+        object_ids = set(object_ids)
+        if not (fields and object_ids):
+            return []
+        content_type = ContentType.objects.get_for_model(model)
+        keys = dict([(field.key, field) for field in fields])
+        totals = self._get_vote_totals(content_type, object_ids, keys)
+
+        scores = dict([((object_id, key), (score, votes)) for object_id, key, score, votes in self.filter(
+            content_type    = content_type,
+            object_id__in   = object_ids,
+            key__in         = keys.keys(),
+        ).values_list('object_id', 'key', 'score', 'votes')])
+
+        names = []
+        for field in fields:
+            names.extend([field.score_field_name, field.votes_field_name])
+        columns = dict([(row[0], row[1:]) for row in
+                        model._default_manager.filter(pk__in=object_ids).values_list('pk', *names)])
+
+        mismatches = []
+        for object_id in sorted(columns):
+            for i, field in enumerate(fields):
+                expected = totals[(object_id, field.key)]
+                score = scores.get((object_id, field.key))
+                stored = tuple(columns[object_id][i * 2:i * 2 + 2])
+                # objects which were never voted on have no Score row
+                if (score or (0, 0)) != expected or stored != expected:
+                    mismatches.append((object_id, field, expected, score, stored))
+        return mismatches
+
+    def recalculate(self, model, object_ids, fields=None):
+        """recalculate(model, object_ids, fields=None)
+
+        Recomputes the Score rows and the ``<field>_score``/``<field>_votes`` columns
+        of the given ``model`` objects from their votes, using a single grouped
+        query. ``fields`` defaults to every rating field on ``model``."""
+        # XXX: circular import
+        from djangoratings.models import ScoreHistogram
+
+        if fields is None:
+            fields = getattr(model, '_djangoratings', [])
+        object_ids = set(object_ids)
+        if not (fields and object_ids):
+            return
+        content_type = ContentType.objects.get_for_model(model)
+        keys = dict([(field.key, field) for field in fields])
+        totals = self._get_vote_totals(content_type, object_ids, keys)
+
+        # objects which were never voted on get no Score row
+        missing = set([score_key for score_key, (score, votes) in totals.iteritems() if votes])
+        updated = {}
+        scores = self.filter(
+            content_type    = content_type,
+            object_id__in   = object_ids,
+            key__in         = keys.keys(),
+        ).values_list('pk', 'object_id', 'key', 'score', 'votes')
+        for pk, object_id, key, score, votes in scores:
+            missing.discard((object_id, key))
+            if (score, votes) != totals[(object_id, key)]:
+                updated[pk] = totals[(object_id, key)]
+        _bulk_update(self, updated, ['score', 'votes'])
+        _bulk_create(self, [self.model(
+            content_type    = content_type,
+            object_id       = object_id,
+            key             = key,
+            score           = totals[(object_id, key)][0],
+            votes           = totals[(object_id, key)][1],
+        ) for object_id, key in missing])
+
+        names = []
+        for field in keys.itervalues():
+            names.extend([field.score_field_name, field.votes_field_name] + field.get_stored_rating_names())
+        current = dict([(row[0], row[1:]) for row in
+                        model._default_manager.filter(pk__in=object_ids).values_list('pk', *names)])
+        updated = {}
+        for object_id in current:
+            columns = {}
+            for key, field in keys.iteritems():
+                score, votes = columns[field.score_field_name], columns[field.votes_field_name] = totals[(object_id, key)]
+                columns.update(field.get_stored_ratings(content_type, score, votes))
+            # only write the objects which are out of date
+            values = tuple([columns[name] for name in names])
+            if current[object_id] != values:
+                updated[object_id] = values
+        _bulk_update(model._default_manager, updated, names)
+        for key, field in keys.iteritems():
+            field.tallies_updated_in_bulk(dict([(object_id, totals[(object_id, key)]) for object_id in object_ids]))
+
+        histogram_keys = [key for key, field in keys.iteritems() if field.histogram]
+        if histogram_keys:
+            ScoreHistogram.objects.recalculate(content_type, object_ids, histogram_keys)
+
+class ScoreHistogramManager(Manager):
+    def adjust(self, content_type, object_id, key, old_score=None, new_score=None):
+        """adjust(content_type, object_id, key, old_score=None, new_score=None)
+
+        Moves a vote from the ``old_score`` bucket to the ``new_score`` one. Either
+        is ``None`` when the vote was just added, or deleted."""
+        if old_score == new_score:
+            return
+        kwargs = dict(
+            content_type    = content_type,
+            object_id       = object_id,
+            key             = key,
+        )
+        if old_score is not None:
+            self.filter(score=old_score, **kwargs).update(count=F('count') - 1)
+        if new_score is not None:
+            kwargs['score'] = new_score
+            _increment(self, kwargs, dict(count=1))
+
+    def recalculate(self, content_type, object_ids, keys):
+        """recalculate(content_type, object_ids, keys)
+
+        Rebuilds the histograms of the given objects from their votes, using a
+        single grouped query."""
+        # XXX: circular import
+        from djangoratings.models import Vote
+
+        kwargs = dict(
+            content_type    = content_type,
+            object_id__in   = list(object_ids),
+            key__in         = list(keys),
+        )
+        rows = Vote.objects.filter(**kwargs).values('object_id', 'key', 'score').annotate(total=Count('id')).order_by()
+        rows = list(rows)
+        self.filter(**kwargs).delete()
+        _bulk_create(self, [self.model(
+            content_type    = content_type,
+            object_id       = row['object_id'],
+            key             = row['key'],
+            score           = row['score'],
+            count           = row['total'],
+        ) for row in rows])
+
+    def get_distributions(self, objects, field_name):
+        """get_distributions(objects, field_name)
+
+        Returns the number of votes at each score for a rating field on any number
+        of ``objects`` of the same model, using a single query, as a dict mapping
+        object pks to ``{score: count}`` dicts. Fields declared without
+        ``histogram=True`` are counted from their votes instead."""
+        # XXX: circular import
+        from djangoratings.models import Vote
+
+        objects = list(objects)
+        if not objects:
+            return {}
+        field = getattr(objects[0].__class__, field_name)
+        object_ids = [obj.pk for obj in objects]
+        kwargs = dict(
+            content_type    = field.get_content_type(objects[0].__class__),
+            object_id__in   = object_ids,
+            key             = field.key,
+        )
+        if field.histogram:
+            rows = self.filter(count__gt=0, **kwargs).values_list('object_id', 'score', 'count')
+        else:
+            rows = Vote.objects.filter(**kwargs).values('object_id', 'score').annotate(total=Count('id')).order_by()
+            rows = [(row['object_id'], row['score'], row['total']) for row in rows]
+
+        distributions = dict([(object_id, dict.fromkeys(range(1, field.range + 1), 0)) for object_id in object_ids])
+        for object_id, score, count in rows:
+            distributions[object_id][score] = count
+        return distributions
+
 class SimilarUserManager(Manager):
-    def get_recommendations(self, user, model_class, min_score=1):
-        from djangoratings.models import Vote, IgnoredObject
+    def get_recommendations(self, user, model_class, min_score=1, order_by_similarity=False):
+        """get_recommendations(user, model_class, min_score=1, order_by_similarity=False)
+
+        Returns the objects of ``model_class`` which users similar to ``user``
+        rated at least ``min_score``, and which ``user`` neither rated nor
+        ignored. With ``order_by_similarity``, the objects come ordered by the
+        total similarity of these users (see ``RATINGS_SIMILARITY_METRIC``) with
+        ``user``, best first, and carry it as ``similarity``.
+
+        With ``RATINGS_MATERIALIZED_RECOMMENDATIONS``, the objects are read from
+        the ``Recommendation`` table instead, see ``RecommendationManager``."""
+        from djangoratings.models import Vote, IgnoredObject, Recommendation
+
+        if getattr(settings, 'RATINGS_MATERIALIZED_RECOMMENDATIONS', RATINGS_MATERIALIZED_RECOMMENDATIONS):
+            return Recommendation.objects.get_recommendations(user, model_class)
         
         content_type = ContentType.objects.get_for_model(model_class)
         
@@ -58,20 +862,39 @@ class SimilarUserManager(Manager):
             io=IgnoredObject._meta.db_table,
         )
         
+        similar = 'from_user_id = %s and exclude = %s and generation = %s'
+        similar_params = [user.id, False, self.get_generation()]
+        if getattr(settings, 'RATINGS_SIMILAR_USERS_UPDATE', RATINGS_SIMILAR_USERS_UPDATE):
+            # every pair of co-voters is kept, see update_recommendations
+            if getattr(settings, 'RATINGS_SIMILARITY_METRIC', RATINGS_SIMILARITY_METRIC):
+                similar += ' and similarity >= %s'
+                similar_params.append(getattr(settings, 'RATINGS_MIN_SIMILARITY', RATINGS_MIN_SIMILARITY))
+            else:
+                similar += ' and agrees / (disagrees + 0.0001) > %s'
+                similar_params.append(getattr(settings, 'RATINGS_MIN_AGREEMENT', RATINGS_MIN_AGREEMENT))
+
         objects = model_class._default_manager.extra(
             tables=[params['v']],
             where=[
                 '%(v)s.object_id = %(m)s.id and %(v)s.content_type_id = %%s' % params,
-                '%(v)s.user_id IN (select to_user_id from %(sm)s where from_user_id = %%s and exclude = 0)' % params,
+                '%(v)s.user_id IN (select to_user_id from %(sm)s where ' % params + similar + ')',
                 '%(v)s.score >= %%s' % params,
                 # Exclude already rated maps
                 '%(v)s.object_id NOT IN (select object_id from %(v)s where content_type_id = %(v)s.content_type_id and user_id = %%s)' % params,
                 # IgnoredObject exclusions
                 '%(v)s.object_id NOT IN (select object_id from %(io)s where content_type_id = %(v)s.content_type_id and user_id = %%s)' % params,
             ],
-            params=[content_type.id, user.id, min_score, user.id, user.id]
+            params=[content_type.id] + similar_params + [min_score, user.id, user.id]
         ).distinct()
 
+        if order_by_similarity:
+            # without a metric, the share of agreements
+            objects = objects.extra(select={
+                'similarity': """select sum(coalesce(%(sm)s.similarity, %(sm)s.agrees / (%(sm)s.agrees + %(sm)s.disagrees + 0.0001)))
+                  from %(sm)s inner join %(v)s as rv on rv.user_id = %(sm)s.to_user_id
+                  where rv.content_type_id = %%s and rv.object_id = %(m)s.id and rv.score >= %%s and """ % params + similar,
+            }, select_params=[content_type.id, min_score] + similar_params).order_by('-similarity')
+
         # objects = model_class._default_manager.filter(pk__in=content_type.votes.extra(
         #     where=['user_id IN (select to_user_id from %s where from_user_id = %d and exclude = 0)' % (self.model._meta.db_table, user.pk)],
         # ).filter(score__gte=min_score).exclude(
@@ -82,33 +905,550 @@ class SimilarUserManager(Manager):
         
         return objects
     
-    def update_recommendations(self):
-        # TODO: this is mysql only atm
-        # TODO: this doesnt handle scores that have multiple values (e.g. 10 points, 5 stars)
-        # due to it calling an agreement as score = score. We need to loop each rating instance
-        # and express the condition based on the range.
-        from djangoratings.models import Vote
-        from django.db import connection
-        cursor = connection.cursor()
-        cursor.execute('begin')
-        cursor.execute('truncate table %s' % (self.model._meta.db_table,))
-        cursor.execute("""insert into %(t1)s
-          (to_user_id, from_user_id, agrees, disagrees, exclude)
-          select v1.user_id, v2.user_id,
-                 sum(if(v2.score = v1.score, 1, 0)) as agrees,
-                 sum(if(v2.score != v1.score, 1, 0)) as disagrees, 0
-            from %(t2)s as v1
-              inner join %(t2)s as v2
-                on v1.user_id != v2.user_id
-                and v1.object_id = v2.object_id
-                and v1.content_type_id = v2.content_type_id
-            where v1.user_id is not null
-              and v2.user_id is not null
-            group by v1.user_id, v2.user_id
-            having agrees / (disagrees + 0.0001) > 3
-          on duplicate key update agrees = values(agrees), disagrees = values(disagrees);""" % dict(
-            t1=self.model._meta.db_table,
-            t2=Vote._meta.db_table,
-        ))
-        cursor.execute('commit')
-        cursor.close()
\ No newline at end of file
+    def get_generation(self):
+        """get_generation()
+
+        Returns the generation of the rows which readers use, see
+        ``update_recommendations``."""
+        # XXX: circular import
+        from djangoratings.models import Generation
+
+        return Generation.objects.get_value(SIMILAR_USERS_GENERATION)
+
+    def _get_generation_keys(self, user_ids):
+        return [get_cache_key('generation', 'recommendations')] + \
+               [get_cache_key('generation', 'recommendations', user_id) for user_id in user_ids]
+
+    def get_cached_recommendations(self, user, model_class, min_score=1, order_by_similarity=False):
+        """get_cached_recommendations(user, model_class, min_score=1, order_by_similarity=False)
+
+        Returns the objects of ``get_recommendations`` as a list, keeping their
+        ids in the cache so that only a ``pk__in`` query loads them while they
+        are valid. They are invalidated when ``user`` votes or ignores an object,
+        when their similar users are recomputed, and when ``SimilarUser`` or
+        ``Recommendation`` are rebuilt, but not when similar users vote.
+
+        The ``similarity`` and ``recommendation_score`` of the objects are cached
+        along with their ids."""
+        content_type = ContentType.objects.get_for_model(model_class)
+        cache_key = get_cache_key('recommendations', user.pk, content_type.pk, min_score, int(order_by_similarity),
+                                  *get_generations(self._get_generation_keys([user.pk])))
+        recommended = cache.get(cache_key)
+        if recommended is None:
+            recommended = [(obj.pk, dict([(name, getattr(obj, name)) for name in ('similarity', 'recommendation_score')
+                                          if hasattr(obj, name)]))
+                           for obj in self.get_recommendations(user, model_class, min_score, order_by_similarity)]
+            cache.set(cache_key, recommended, get_cache_timeout())
+        objects = model_class._default_manager.in_bulk([object_id for object_id, attributes in recommended])
+        result = []
+        for object_id, attributes in recommended:
+            if object_id in objects:
+                obj = objects[object_id]
+                obj.__dict__.update(attributes)
+                result.append(obj)
+        return result
+
+    def invalidate_recommendations(self, user_ids=None):
+        """invalidate_recommendations(user_ids=None)
+
+        Invalidates the cached recommendations of the given users, or of every
+        user, by bumping their generation counters."""
+        if user_ids is None:
+            bump_generations(self._get_generation_keys([]))
+        else:
+            bump_generations(self._get_generation_keys(set(user_ids))[1:])
+
+    def _get_rows(self, similarities, excluded, generation, min_agreement=None, min_similarity=None):
+        """Returns SimilarUser objects of ``generation`` for the ``(agrees,
+        disagrees, similarity)`` of pairs of users, skipping the pairs which do
+        not agree more than ``min_agreement`` to one, or are less similar than
+        ``min_similarity``, unless these are ``None``."""
+        return [self.model(
+            generation      = generation,
+            from_user_id    = from_user_id,
+            to_user_id      = to_user_id,
+            agrees          = agrees,
+            disagrees       = disagrees,
+            similarity      = similarity,
+            exclude         = (from_user_id, to_user_id) in excluded,
+        ) for (from_user_id, to_user_id), (agrees, disagrees, similarity) in similarities.iteritems()
+          if (min_agreement is None or agrees / (disagrees + 0.0001) > min_agreement)
+          and (min_similarity is None or similarity >= min_similarity)]
+
+    def _get_thresholds(self, min_agreement=None, metric=None, min_similarity=None):
+        """Returns the ``(metric, min_agreement, min_similarity)`` deciding which
+        users are similar, the threshold which does not apply being ``None``."""
+        if metric is None:
+            metric = getattr(settings, 'RATINGS_SIMILARITY_METRIC', RATINGS_SIMILARITY_METRIC)
+        if metric is not None:
+            if min_similarity is None:
+                min_similarity = getattr(settings, 'RATINGS_MIN_SIMILARITY', RATINGS_MIN_SIMILARITY)
+            return metric, None, min_similarity
+        if min_agreement is None:
+            min_agreement = getattr(settings, 'RATINGS_MIN_AGREEMENT', RATINGS_MIN_AGREEMENT)
+        return metric, min_agreement, None
+
+    def update_recommendations(self, min_agreement=None, block_size=1000, metric=None, min_similarity=None,
+                               workers=1, progress=None, approximate=False, bands=None, rows=None):
+        """update_recommendations(min_agreement=None, block_size=1000, metric=None, min_similarity=None, workers=1, progress=None, approximate=False, bands=None, rows=None)
+
+        Rebuilds the similarities between users from their votes. Two users are
+        similar when the objects on which they gave the same score outnumber the
+        ones on which they did not by more than ``min_agreement`` (defaults to
+        ``RATINGS_MIN_AGREEMENT``) to one. Voters are processed ``block_size``
+        at a time, see ``djangoratings.similarity``; pairs marked with
+        ``exclude`` keep it.
+
+        With a ``metric`` (defaults to ``RATINGS_SIMILARITY_METRIC``), two users
+        are similar when the similarity of their scores is at least
+        ``min_similarity`` (defaults to ``RATINGS_MIN_SIMILARITY``) instead.
+
+        The ``Recommendation`` table is rebuilt as well when
+        ``RATINGS_MATERIALIZED_RECOMMENDATIONS`` is set.
+
+        The rows are written as a new generation, which readers only switch to
+        once it is complete, so they neither wait for the rebuild nor see a
+        partial table. Exclusions are carried over, including the ones made
+        while rebuilding; other changes made to the current generation in the
+        meantime are not. The previous generations are then deleted.
+
+        When ``RATINGS_SIMILAR_USERS_UPDATE`` is set, every pair of co-voters is
+        kept so that votes can adjust them, and the thresholds are only applied
+        by ``get_recommendations``.
+
+        Each block of users is a shard, whose rows only depend on its own users,
+        written in its own transaction. With ``workers`` above 1, the shards are
+        computed and written by as many processes. ``progress`` is called after
+        each shard with its number, first and last user ids, number of users and
+        rows, and the seconds it took.
+
+        With ``approximate``, only the pairs of users found by a MinHash index of
+        ``bands`` bands of ``rows`` rows are compared, see ``djangoratings.lsh``."""
+        # XXX: circular import
+        from djangoratings.models import StaleSimilarUser, Recommendation, Generation
+        from djangoratings.similarity import iter_user_blocks
+        from djangoratings.lsh import build_index
+
+        metric, min_agreement, min_similarity = self._get_thresholds(min_agreement, metric, min_similarity)
+        if getattr(settings, 'RATINGS_SIMILAR_USERS_UPDATE', RATINGS_SIMILAR_USERS_UPDATE):
+            min_agreement = min_similarity = None
+        if workers < 1:
+            raise ValueError("workers must be a positive number")
+        with transaction.commit_on_success(using=self.db):
+            # every rebuild gets a generation of its own
+            generation = Generation.objects.increment(SIMILAR_USERS_GENERATION + '.last')
+            excluded = self._get_excluded(self.get_generation())
+            StaleSimilarUser.objects.all().delete()
+
+        index = None
+        if approximate:
+            index = build_index(block_size, bands, rows)
+
+        excluded_by_user = {}
+        for from_user_id, to_user_id in excluded:
+            excluded_by_user.setdefault(from_user_id, []).append((from_user_id, to_user_id))
+        tasks = ((shard, user_ids, generation, metric, min_agreement, min_similarity,
+                  [pair for user_id in user_ids for pair in excluded_by_user.get(user_id, ())],
+                  index and dict([(user_id, index.candidates(user_id)) for user_id in user_ids]))
+                 for shard, user_ids in enumerate(iter_user_blocks(block_size), 1))
+        if workers == 1:
+            self._build_shards(tasks, lambda batch: map(_build_shard_in_transaction, batch), progress)
+        else:
+            # the workers must open their own database connections
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                self._build_shards(tasks, lambda batch: pool.map(_build_shard_in_transaction, batch),
+                                   progress, workers * 2)
+            finally:
+                pool.close()
+                pool.join()
+        self._switch_generation(generation, excluded)
+        if getattr(settings, 'RATINGS_MATERIALIZED_RECOMMENDATIONS', RATINGS_MATERIALIZED_RECOMMENDATIONS):
+            Recommendation.objects.rebuild(block_size=block_size)
+
+    def _get_excluded(self, generation):
+        return set(self.filter(generation=generation, exclude=True).values_list('from_user', 'to_user'))
+
+    def _switch_generation(self, generation, excluded):
+        """Makes readers use a complete ``generation``, unless a newer one was
+        switched to in the meantime, and deletes the generations they no longer
+        use. ``excluded`` are the pairs excluded when it was built."""
+        # XXX: circular import
+        from djangoratings.models import Generation
+
+        connection = connections[self.db]
+        with transaction.commit_on_success(using=self.db):
+            current = self.get_generation()
+            if generation > current:
+                # exclusions changed while rebuilding
+                for pair in excluded ^ self._get_excluded(current):
+                    self.filter(generation=generation, from_user=pair[0], to_user=pair[1]).update(exclude=pair not in excluded)
+                Generation.objects.set_value(SIMILAR_USERS_GENERATION, generation)
+                where = 'generation < %s'
+            else:
+                where = 'generation = %s'
+            connection.cursor().execute('delete from %s where %s' % (
+                connection.ops.quote_name(self.model._meta.db_table), where), [generation])
+        if generation > current:
+            self.invalidate_recommendations()
+
+    def _build_shards(self, tasks, run, progress=None, batch_size=1):
+        """Passes ``tasks`` to ``run``, ``batch_size`` at a time so that only a
+        bounded number of shards are in flight."""
+        while True:
+            batch = list(itertools.islice(tasks, batch_size))
+            if not batch:
+                return
+            for result in run(batch):
+                if progress is not None:
+                    progress(*result)
+
+    def recompute_users(self, user_ids, block_size=1000):
+        """recompute_users(user_ids, block_size=1000)
+
+        Recomputes the similarities of the given users with every other voter,
+        keeping every pair of co-voters (see ``RATINGS_SIMILAR_USERS_UPDATE``)."""
+        # XXX: circular import
+        from djangoratings.similarity import compute_similarities
+
+        metric = getattr(settings, 'RATINGS_SIMILARITY_METRIC', RATINGS_SIMILARITY_METRIC)
+        generation = self.get_generation()
+        user_ids = sorted(set(user_ids))
+        for i in xrange(0, len(user_ids), block_size):
+            block = user_ids[i:i + block_size]
+            similarities = {}
+            for (from_user_id, to_user_id), similarity in compute_similarities(block, metric).iteritems():
+                similarities[(from_user_id, to_user_id)] = similarities[(to_user_id, from_user_id)] = similarity
+            qs = self.filter(Q(from_user__in=block) | Q(to_user__in=block), generation=generation)
+            excluded = set(qs.filter(exclude=True).values_list('from_user', 'to_user'))
+            changed = set(block)
+            changed.update([pair[0] for pair in qs.values_list('from_user', 'to_user')])
+            changed.update([from_user_id for from_user_id, to_user_id in similarities])
+            qs.delete()
+            _bulk_create(self, self._get_rows(similarities, excluded, generation))
+            self.invalidate_recommendations(changed)
+
+    def vote_changed(self, user, content_type, object_id, key, old_score=None, new_score=None):
+        """vote_changed(user, content_type, object_id, key, old_score=None, new_score=None)
+
+        Keeps the similarities of a user up to date after their vote on an object
+        moved from ``old_score`` to ``new_score``, either being ``None`` when the
+        vote was added or deleted. Depending on ``RATINGS_SIMILAR_USERS_UPDATE``,
+        the counts shared with each user who voted on the same object are
+        adjusted, or the user is queued for ``update_stale``. The cached
+        recommendations of the users whose similarities changed are invalidated."""
+        # XXX: circular import
+        from djangoratings.models import Vote, StaleSimilarUser
+
+        if user is None or old_score == new_score:
+            return
+        self.invalidate_recommendations([user.pk])
+        mode = getattr(settings, 'RATINGS_SIMILAR_USERS_UPDATE', RATINGS_SIMILAR_USERS_UPDATE)
+        if not mode:
+            return
+        if mode == 'deferred':
+            StaleSimilarUser.objects.mark(user)
+            return
+        if getattr(settings, 'RATINGS_SIMILARITY_METRIC', RATINGS_SIMILARITY_METRIC):
+            # similarities can't be adjusted by a single vote
+            self.recompute_users([user.pk])
+            return
+
+        co_voters = Vote.objects.filter(
+            content_type    = content_type,
+            object_id       = object_id,
+            key             = key,
+            user__isnull    = False,
+        ).exclude(user=user).values_list('user', 'score')
+        generation = self.get_generation()
+        changed = []
+        for to_user_id, score in co_voters:
+            deltas = dict(agrees=0, disagrees=0)
+            if old_score is not None:
+                deltas[old_score == score and 'agrees' or 'disagrees'] -= 1
+            if new_score is not None:
+                deltas[new_score == score and 'agrees' or 'disagrees'] += 1
+            if not (deltas['agrees'] or deltas['disagrees']):
+                continue
+            to_user = User(pk=to_user_id)
+            changed.append(to_user_id)
+            for lookups in (dict(generation=generation, from_user=user, to_user=to_user),
+                            dict(generation=generation, from_user=to_user, to_user=user)):
+                self._adjust_counts(lookups, deltas)
+        if new_score is None:
+            # drop the users who no longer share any vote
+            self.filter(Q(from_user=user) | Q(to_user=user), generation=generation, agrees=0, disagrees=0).delete()
+        # their similarity with the user changed
+        self.invalidate_recommendations(changed)
+
+    def _adjust_counts(self, lookups, deltas):
+        """Applies the ``agrees``/``disagrees`` ``deltas`` to the pair of users
+        matching ``lookups``. Only the increments may create the row: the counts
+        are positive, so decrements only apply to rows which already exist."""
+        decrements = dict([(name, -value) for name, value in deltas.iteritems() if value < 0])
+        increments = dict([(name, value) for name, value in deltas.iteritems() if value > 0])
+        if decrements:
+            qs = self.filter(**lookups).filter(**dict([('%s__gte' % (name,), value)
+                                                       for name, value in decrements.iteritems()]))
+            qs.update(**dict([(name, F(name) - value) for name, value in decrements.iteritems()]))
+        if increments:
+            _increment(self, lookups, increments)
+
+    def users_changed(self, user_ids):
+        """users_changed(user_ids)
+
+        Keeps the similarities of users up to date after votes were written in
+        bulk, recomputing them or queuing them for ``update_stale`` depending on
+        ``RATINGS_SIMILAR_USERS_UPDATE``, and invalidates their cached
+        recommendations."""
+        # XXX: circular import
+        from djangoratings.models import StaleSimilarUser
+
+        mode = getattr(settings, 'RATINGS_SIMILAR_USERS_UPDATE', RATINGS_SIMILAR_USERS_UPDATE)
+        user_ids = set(user_ids)
+        user_ids.discard(None)
+        if not user_ids:
+            return
+        self.invalidate_recommendations(user_ids)
+        if not mode:
+            return
+        if mode == 'deferred':
+            for user_id in user_ids:
+                StaleSimilarUser.objects.mark(User(pk=user_id))
+        else:
+            self.recompute_users(user_ids)
+
+    def update_stale(self, block_size=1000):
+        """update_stale(block_size=1000)
+
+        Recomputes the similarities of the users queued since the last run, and
+        returns their number. Their recommendations are rebuilt as well when
+        ``RATINGS_MATERIALIZED_RECOMMENDATIONS`` is set."""
+        # XXX: circular import
+        from djangoratings.models import StaleSimilarUser, Recommendation
+
+        done = 0
+        while True:
+            user_ids = list(StaleSimilarUser.objects.order_by('pk').values_list('user', flat=True)[:block_size])
+            if not user_ids:
+                return done
+            with transaction.commit_on_success(using=self.db):
+                # users voting again from now on are queued again
+                StaleSimilarUser.objects.filter(user__in=user_ids).delete()
+                self.recompute_users(user_ids, block_size)
+            if getattr(settings, 'RATINGS_MATERIALIZED_RECOMMENDATIONS', RATINGS_MATERIALIZED_RECOMMENDATIONS):
+                Recommendation.objects.rebuild(user_ids, block_size)
+            done += len(user_ids)
+
+class StaleSimilarUserManager(Manager):
+    def mark(self, user):
+        """mark(user)
+
+        Queues a user whose similarities must be recomputed."""
+        _increment(self, dict(user=user), dict(changes=1))
+
+class RecommendationManager(Manager):
+    def get_recommendations(self, user, model_class):
+        """get_recommendations(user, model_class)
+
+        Returns the objects of ``model_class`` recommended to ``user``, best
+        first, each carrying its score as ``recommendation_score``. Objects which
+        ``user`` rated or ignored since the table was built are left out."""
+        from djangoratings.models import Vote, IgnoredObject
+
+        content_type = ContentType.objects.get_for_model(model_class)
+        params = dict(
+            r=self.model._meta.db_table,
+            v=Vote._meta.db_table,
+            m=model_class._meta.db_table,
+            io=IgnoredObject._meta.db_table,
+        )
+        return model_class._default_manager.extra(
+            tables=[params['r']],
+            select={'recommendation_score': '%(r)s.score' % params},
+            where=[
+                '%(r)s.object_id = %(m)s.id and %(r)s.user_id = %%s and %(r)s.content_type_id = %%s' % params,
+                '%(r)s.object_id NOT IN (select object_id from %(v)s where content_type_id = %%s and user_id = %%s)' % params,
+                '%(r)s.object_id NOT IN (select object_id from %(io)s where content_type_id = %%s and user_id = %%s)' % params,
+            ],
+            params=[user.id, content_type.id, content_type.id, user.id, content_type.id, user.id],
+        ).order_by('-recommendation_score')
+
+    def rebuild(self, user_ids=None, block_size=1000, size=None):
+        """rebuild(user_ids=None, block_size=1000, size=None)
+
+        Recomputes the recommendations of the given users, or of every user,
+        from the ``SimilarUser`` table, ``block_size`` users at a time, keeping
+        the ``size`` (defaults to ``RATINGS_RECOMMENDATIONS_SIZE``) best objects
+        for each user and content type."""
+        # XXX: circular import
+        from djangoratings.models import SimilarUser
+        from djangoratings.similarity import iter_user_blocks, compute_recommendations
+
+        if size is None:
+            size = getattr(settings, 'RATINGS_RECOMMENDATIONS_SIZE', RATINGS_RECOMMENDATIONS_SIZE)
+        with transaction.commit_on_success(using=self.db):
+            if user_ids is None:
+                connection = connections[self.db]
+                connection.cursor().execute('delete from %s' % (connection.ops.quote_name(self.model._meta.db_table),))
+                blocks = iter_user_blocks(block_size)
+            else:
+                user_ids = sorted(set(user_ids))
+                blocks = [user_ids[i:i + block_size] for i in xrange(0, len(user_ids), block_size)]
+            for block in blocks:
+                if user_ids is not None:
+                    self.filter(user__in=block).delete()
+                _bulk_create(self, [self.model(
+                    user_id         = user_id,
+                    content_type_id = content_type_id,
+                    object_id       = object_id,
+                    score           = score,
+                ) for user_id, content_type_id, object_id, score in compute_recommendations(block, size)])
+        SimilarUser.objects.invalidate_recommendations(user_ids)
+
+class GenerationManager(Manager):
+    def get_value(self, name):
+        """get_value(name)
+
+        Returns the current value of a generation counter, 0 until it is set."""
+        values = list(self.filter(name=name).values_list('value', flat=True))
+        return values and values[0] or 0
+
+    def increment(self, name):
+        """increment(name)
+
+        Increments a generation counter, and returns its new value."""
+        _increment(self, dict(name=name), dict(value=1))
+        return self.get_value(name)
+
+    def set_value(self, name, value):
+        """set_value(name, value)
+
+        Sets a generation counter to ``value``."""
+        if not self.filter(name=name).update(value=value):
+            _increment(self, dict(name=name), dict(value=value))
+
+class SimilarObjectManager(Manager):
+    def _get_query_set(self, model_class, field_name, object_ids):
+        field = getattr(model_class, field_name)
+        qn = connections[self.db].ops.quote_name
+        params = dict(
+            so=qn(self.model._meta.db_table),
+            m=qn(model_class._meta.db_table),
+            pk=qn(model_class._meta.pk.column),
+            ids=', '.join(['%s'] * len(object_ids)),
+        )
+        return model_class._default_manager.extra(
+            tables=[self.model._meta.db_table],
+            select={
+                'similar_to': '%(so)s.object_id' % params,
+                'similarity': '%(so)s.similarity' % params,
+            },
+            where=[
+                '%(so)s.to_object_id = %(m)s.%(pk)s and %(so)s.content_type_id = %%s and %(so)s.key = %%s' % params,
+                '%(so)s.object_id IN (%(ids)s)' % params,
+            ],
+            params=[field.get_content_type(model_class).pk, field.key] + list(object_ids),
+        ).order_by('-similarity')
+
+    def get_similar_objects(self, instance, field_name):
+        """get_similar_objects(instance, field_name)
+
+        Returns the objects most similar to ``instance`` for a rating field, best
+        first, each carrying its cosine similarity as ``similarity``."""
+        return self._get_query_set(instance.__class__, field_name, [instance.pk])
+
+    def get_similar_objects_in_bulk(self, objects, field_name):
+        """get_similar_objects_in_bulk(objects, field_name)
+
+        Returns the objects most similar to any number of ``objects`` of the same
+        model for a rating field, using a single query, as a dict mapping object
+        pks to lists of objects, best first."""
+        objects = list(objects)
+        if not objects:
+            return {}
+        similar = dict([(obj.pk, []) for obj in objects])
+        for obj in self._get_query_set(objects[0].__class__, field_name, similar.keys()):
+            similar[obj.similar_to].append(obj)
+        return similar
+
+    def rebuild(self, model, fields=None, chunk_size=1000, size=None, max_votes=None):
+        """rebuild(model, fields=None, chunk_size=1000, size=None, max_votes=None)
+
+        Recomputes the objects most similar to every ``model`` object for the
+        given rating fields, defaulting to all of them, keeping the ``size``
+        (defaults to ``RATINGS_SIMILAR_OBJECTS_SIZE``) best ones. The votes are
+        read, and the rows replaced, ``chunk_size`` objects at a time, and the
+        votes of their voters ``max_votes`` at a time; see
+        ``djangoratings.similarity``."""
+        # XXX: circular import
+        from djangoratings.similarity import iter_object_chunks, get_object_norms, compute_object_similarities
+
+        if fields is None:
+            fields = getattr(model, '_djangoratings', [])
+        if size is None:
+            size = getattr(settings, 'RATINGS_SIMILAR_OBJECTS_SIZE', RATINGS_SIMILAR_OBJECTS_SIZE)
+        for field in fields:
+            content_type = field.get_content_type(model)
+            qs = self.filter(content_type=content_type, key=field.key)
+            norms = get_object_norms(content_type, field.key, chunk_size)
+            last_object_id = None
+            for object_ids in iter_object_chunks(content_type, field.key, chunk_size):
+                neighbors = compute_object_similarities(content_type, field.key, object_ids, norms, size, max_votes)
+                with transaction.commit_on_success(using=self.db):
+                    # objects no longer voted on since the last chunk lose their rows too
+                    stale = qs.filter(object_id__lte=object_ids[-1])
+                    if last_object_id is not None:
+                        stale = stale.filter(object_id__gt=last_object_id)
+                    stale.delete()
+                    _bulk_create(self, [self.model(
+                        content_type    = content_type,
+                        key             = field.key,
+                        object_id       = object_id,
+                        to_object_id    = to_object_id,
+                        similarity      = similarity,
+                    ) for object_id in object_ids for to_object_id, similarity in neighbors.get(object_id, ())])
+                last_object_id = object_ids[-1]
+            if last_object_id is not None:
+                qs = qs.filter(object_id__gt=last_object_id)
+            qs.delete()
+
+class IgnoredObjectQuerySet(QuerySet):
+    """Invalidates the cached recommendations of the users whose ignored objects
+    are deleted or updated in bulk."""
+    def _get_user_ids(self):
+        return set(self.values_list('user', flat=True).distinct().order_by())
+
+    def _invalidate(self, user_ids):
+        # XXX: circular import
+        from djangoratings.models import SimilarUser
+
+        if user_ids:
+            SimilarUser.objects.invalidate_recommendations(user_ids)
+
+    def delete(self, *args, **kwargs):
+        user_ids = self._get_user_ids()
+        retval = super(IgnoredObjectQuerySet, self).delete(*args, **kwargs)
+        self._invalidate(user_ids)
+        return retval
+
+    def update(self, **kwargs):
+        user_ids = self._get_user_ids()
+        retval = super(IgnoredObjectQuerySet, self).update(**kwargs)
+        # the objects may now be ignored by another user
+        for name in ('user', 'user_id'):
+            if kwargs.get(name) is not None:
+                user_ids.add(getattr(kwargs[name], 'pk', kwargs[name]))
+        self._invalidate(user_ids)
+        return retval
+
+    def bulk_create(self, objs, *args, **kwargs):
+        retval = super(IgnoredObjectQuerySet, self).bulk_create(objs, *args, **kwargs)
+        self._invalidate(set([obj.user_id for obj in objs]))
+        return retval
+
+class IgnoredObjectManager(Manager):
+    def get_query_set(self):
+        return IgnoredObjectQuerySet(self.model, using=self._db)
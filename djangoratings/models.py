@@ -10,7 +10,8 @@ try:
 except ImportError:
     now = datetime.now
 
-from managers import VoteManager, SimilarUserManager
+from managers import VoteManager, ScoreManager, ScoreHistogramManager, SimilarUserManager, StaleSimilarUserManager, \
+                     RecommendationManager, GenerationManager, SimilarObjectManager, IgnoredObjectManager
 
 class Vote(models.Model):
     content_type    = models.ForeignKey(ContentType, related_name="votes")
@@ -56,6 +57,8 @@ class Score(models.Model):
     score           = models.IntegerField()
     votes           = models.PositiveIntegerField()
     
+    objects         = ScoreManager()
+
     content_object  = generic.GenericForeignKey()
 
     class Meta:
@@ -64,30 +67,110 @@ class Score(models.Model):
     def __unicode__(self):
         return u"%s scored %s with %s votes" % (self.content_object, self.score, self.votes)
 
+class ScoreHistogram(models.Model):
+    content_type    = models.ForeignKey(ContentType)
+    object_id       = models.PositiveIntegerField()
+    key             = models.CharField(max_length=32)
+    score           = models.IntegerField()
+    count           = models.PositiveIntegerField(default=0)
+
+    objects         = ScoreHistogramManager()
+
+    content_object  = generic.GenericForeignKey()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'key', 'score'),)
+
+    def __unicode__(self):
+        return u"%s has %s votes of %s" % (self.content_object, self.count, self.score)
+
 class SimilarUser(models.Model):
     from_user       = models.ForeignKey(User, related_name="similar_users")
     to_user         = models.ForeignKey(User, related_name="similar_users_from")
     agrees          = models.PositiveIntegerField(default=0)
     disagrees       = models.PositiveIntegerField(default=0)
+    similarity      = models.FloatField(blank=True, null=True)
     exclude         = models.BooleanField(default=False)
+    generation      = models.PositiveIntegerField(default=0)
     
     objects         = SimilarUserManager()
     
     class Meta:
-        unique_together = (('from_user', 'to_user'),)
+        unique_together = (('generation', 'from_user', 'to_user'),)
 
     def __unicode__(self):
         print u"%s %s similar to %s" % (self.from_user, self.exclude and 'is not' or 'is', self.to_user)
 
+class Generation(models.Model):
+    name            = models.CharField(max_length=32, unique=True)
+    value           = models.PositiveIntegerField(default=0)
+
+    objects         = GenerationManager()
+
+    def __unicode__(self):
+        return u"%s is at generation %s" % (self.name, self.value)
+
+class StaleSimilarUser(models.Model):
+    user            = models.ForeignKey(User, unique=True)
+    changes         = models.PositiveIntegerField(default=0)
+
+    objects         = StaleSimilarUserManager()
+
+    def __unicode__(self):
+        return u"%s changed %s votes" % (self.user, self.changes)
+
+class Recommendation(models.Model):
+    user            = models.ForeignKey(User, related_name="recommendations")
+    content_type    = models.ForeignKey(ContentType)
+    object_id       = models.PositiveIntegerField()
+    score           = models.FloatField()
+
+    objects         = RecommendationManager()
+
+    content_object  = generic.GenericForeignKey()
+
+    class Meta:
+        unique_together = (('user', 'content_type', 'object_id'),)
+
+    def __unicode__(self):
+        return u"%s is recommended %s (%s)" % (self.user, self.content_object, self.score)
+
+class SimilarObject(models.Model):
+    content_type    = models.ForeignKey(ContentType)
+    key             = models.CharField(max_length=32)
+    object_id       = models.PositiveIntegerField()
+    to_object_id    = models.PositiveIntegerField()
+    similarity      = models.FloatField()
+
+    objects         = SimilarObjectManager()
+
+    content_object  = generic.GenericForeignKey()
+
+    class Meta:
+        unique_together = (('content_type', 'key', 'object_id', 'to_object_id'),)
+
+    def __unicode__(self):
+        return u"%s is %s similar to #%s" % (self.content_object, self.similarity, self.to_object_id)
+
 class IgnoredObject(models.Model):
     user            = models.ForeignKey(User)
     content_type    = models.ForeignKey(ContentType)
     object_id       = models.PositiveIntegerField()
     
     content_object  = generic.GenericForeignKey()
+
+    objects         = IgnoredObjectManager()
     
     class Meta:
         unique_together = (('content_type', 'object_id'),)
     
     def __unicode__(self):
-        return self.content_object
\ No newline at end of file
+        return self.content_object
+
+    def save(self, *args, **kwargs):
+        super(IgnoredObject, self).save(*args, **kwargs)
+        SimilarUser.objects.invalidate_recommendations([self.user_id])
+
+    def delete(self, *args, **kwargs):
+        super(IgnoredObject, self).delete(*args, **kwargs)
+        SimilarUser.objects.invalidate_recommendations([self.user_id])
\ No newline at end of file
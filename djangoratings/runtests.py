@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import sys
+import tempfile
 
-from os.path import dirname, abspath
+from os.path import dirname, abspath, join
 
 from django.conf import settings
 
 if not settings.configured:
     settings.configure(
         DATABASE_ENGINE='sqlite3',
+        # a file, so that the processes started with ``workers`` share it
+        TEST_DATABASE_NAME=join(tempfile.mkdtemp(), 'djangoratings.db'),
         INSTALLED_APPS=[
             'django.contrib.auth',
             'django.contrib.contenttypes',
@@ -0,0 +1,496 @@
+"""
+Similarity between the users who vote on the same objects, used to build
+``SimilarUser``.
+
+Users are processed in blocks: the votes of a block's users are loaded, then
+every vote cast by a registered user on the same objects, and the similarities
+of the block's users with every other voter are computed, so memory stays
+bounded by the size of a block. Computations use NumPy and SciPy sparse
+matrices when they are installed, and plain Python otherwise.
+
+Besides counting the objects two users gave the same score (``agrees``) and a
+different one (``disagrees``), a similarity can be measured over the scores
+they both gave, each score being scaled by the ``range`` of its field:
+
+* ``'distance'`` - 1 minus the root mean square difference of the scores
+  scaled to [0, 1]
+* ``'pearson'`` - the Pearson correlation of the scores
+* ``'cosine'`` - the cosine similarity of the scores scaled to (0, 1]
+
+The objects recommended to a user are then scored by the votes of the users
+similar to them, see ``compute_recommendations``.
+
+Objects are compared the same way, a chunk of objects at a time, by the cosine
+similarity of the scores registered users gave them, see
+``compute_object_similarities``.
+"""
+import heapq
+import math
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from django.conf import settings
+from django.db.models import get_models, Count
+
+from models import Vote, SimilarUser, IgnoredObject
+from default_settings import RATINGS_MIN_AGREEMENT, RATINGS_SIMILAR_USERS_UPDATE, RATINGS_SIMILARITY_METRIC, \
+                             RATINGS_MIN_SIMILARITY
+
+__all__ = ('METRICS', 'iter_user_blocks', 'compute_similarities', 'compute_recommendations',
+           'iter_object_chunks', 'get_object_norms', 'compute_object_similarities')
+
+METRICS = ('distance', 'pearson', 'cosine')
+
+# most votes of co-voters loaded at a time by compute_object_similarities
+MAX_VOTES = 100000
+
+def iter_user_blocks(block_size):
+    """iter_user_blocks(block_size)
+
+    Yields the ids of every registered voter, in lists of ``block_size``."""
+    last_user_id = None
+    while True:
+        qs = Vote.objects.filter(user__isnull=False)
+        if last_user_id is not None:
+            qs = qs.filter(user__gt=last_user_id)
+        user_ids = list(qs.order_by('user').values_list('user', flat=True).distinct()[:block_size])
+        if not user_ids:
+            return
+        yield user_ids
+        last_user_id = user_ids[-1]
+
+def _get_votes(user_ids, chunk_size=500):
+    """Returns the ``(content_type, object_id, key, user_id, score)`` votes of
+    registered users on the objects which ``user_ids`` voted on."""
+    objects = {}
+    for content_type, key, object_id in Vote.objects.filter(user__in=user_ids).values_list(
+            'content_type', 'key', 'object_id').order_by():
+        objects.setdefault((content_type, key), set()).add(object_id)
+
+    votes = []
+    for (content_type, key), object_ids in objects.iteritems():
+        object_ids = sorted(object_ids)
+        for i in xrange(0, len(object_ids), chunk_size):
+            votes.extend(Vote.objects.filter(
+                content_type    = content_type,
+                key             = key,
+                object_id__in   = object_ids[i:i + chunk_size],
+                user__isnull    = False,
+            ).values_list('content_type', 'object_id', 'key', 'user', 'score').order_by())
+    return votes
+
+def _get_user_votes(user_ids, chunk_size=500):
+    """Returns the ``(content_type, object_id, key, user_id, score)`` votes of ``user_ids``."""
+    user_ids = sorted(user_ids)
+    votes = []
+    for i in xrange(0, len(user_ids), chunk_size):
+        votes.extend(Vote.objects.filter(user__in=user_ids[i:i + chunk_size]).values_list(
+            'content_type', 'object_id', 'key', 'user', 'score').order_by())
+    return votes
+
+def _get_candidate_votes(user_ids, others, chunk_size=500):
+    """Returns the ``(content_type, object_id, key, user_id, score)`` votes of
+    ``user_ids``, and those of ``others`` on the objects which ``user_ids`` voted
+    on."""
+    votes = list(Vote.objects.filter(user__in=user_ids).values_list(
+        'content_type', 'object_id', 'key', 'user', 'score').order_by())
+    groups = set([(content_type, key) for content_type, object_id, key, user_id, score in votes])
+    others = sorted(set(others).difference(user_ids))
+    for content_type, key in groups:
+        voted = Vote.objects.filter(content_type=content_type, key=key, user__in=user_ids).values('object_id')
+        for i in xrange(0, len(others), chunk_size):
+            votes.extend(Vote.objects.filter(
+                content_type    = content_type,
+                key             = key,
+                object_id__in   = voted,
+                user__in        = others[i:i + chunk_size],
+            ).values_list('content_type', 'object_id', 'key', 'user', 'score').order_by())
+    return votes
+
+def _get_ranges():
+    """Returns the ``range`` of every rating field, keyed by field key."""
+    ranges = {}
+    for model in get_models():
+        for field in getattr(model, '_djangoratings', []):
+            ranges[field.key] = field.range
+    return ranges
+
+def _scale(metric, score, range):
+    if metric == 'cosine':
+        return float(score) / range
+    return float(score - 1) / max(range - 1, 1)
+
+def compute_similarities(user_ids, metric=None, candidates=None):
+    """compute_similarities(user_ids, metric=None, candidates=None)
+
+    Returns the number of objects on which each of ``user_ids`` gave the same
+    score as, and a different score than, every other registered voter, along
+    with their similarity by ``metric`` (``None`` unless one of ``METRICS``), as
+    a ``{(from_user_id, to_user_id): (agrees, disagrees, similarity)}`` dict.
+
+    ``candidates`` restricts the other voters to a ``{from_user_id:
+    set(to_user_ids)}`` dict, see ``djangoratings.lsh``: only their votes on the
+    objects ``user_ids`` voted on are loaded, and only the candidate pairs are
+    compared."""
+    if metric is not None and metric not in METRICS:
+        raise ValueError("%r is not a valid similarity metric" % (metric,))
+    if candidates is None:
+        votes = _get_votes(user_ids)
+    else:
+        others = set()
+        for to_user_ids in candidates.itervalues():
+            others.update(to_user_ids)
+        votes = _get_candidate_votes(user_ids, others)
+    values = None
+    if metric is not None:
+        ranges = _get_ranges()
+        # votes on fields which no longer exist can't be scaled
+        votes = [vote for vote in votes if vote[2] in ranges]
+        values = [_scale(metric, vote[4], ranges[vote[2]]) for vote in votes]
+    if numpy is not None:
+        return _compute_with_numpy(set(user_ids), votes, metric, values, candidates)
+    return _compute_with_python(set(user_ids), votes, metric, values, candidates)
+
+def _get_similarity(metric, n, sx, sy, sxx, syy, sxy):
+    if metric == 'distance':
+        return 1 - math.sqrt(max(sxx + syy - 2 * sxy, 0) / n)
+    if metric == 'pearson':
+        variance = (sxx - sx * sx / n) * (syy - sy * sy / n)
+        return variance > 1e-12 and (sxy - sx * sy / n) / math.sqrt(variance) or 0.0
+    return sxx * syy > 0 and sxy / math.sqrt(sxx * syy) or 0.0
+
+def _compute_with_python(user_ids, votes, metric, values, candidates):
+    voters = {}
+    for i, (content_type, object_id, key, user_id, score) in enumerate(votes):
+        voters.setdefault((content_type, object_id, key), []).append((user_id, score, values and values[i]))
+
+    def iter_pairs(object_voters):
+        if candidates is None:
+            for from_user_id, from_score, x in object_voters:
+                if from_user_id in user_ids:
+                    for to_user_id, to_score, y in object_voters:
+                        if to_user_id != from_user_id:
+                            yield from_user_id, from_score, x, to_user_id, to_score, y
+            return
+        # only look up the candidates of each voter
+        by_user = dict([(user_id, (score, value)) for user_id, score, value in object_voters])
+        for from_user_id, from_score, x in object_voters:
+            if from_user_id in user_ids:
+                for to_user_id in candidates.get(from_user_id, ()):
+                    if to_user_id in by_user and to_user_id != from_user_id:
+                        yield (from_user_id, from_score, x, to_user_id) + by_user[to_user_id]
+
+    stats = {}
+    for object_voters in voters.itervalues():
+        for from_user_id, from_score, x, to_user_id, to_score, y in iter_pairs(object_voters):
+                # agrees, disagrees, n, sum x, sum y, sum x^2, sum y^2, sum xy
+                pair = stats.setdefault((from_user_id, to_user_id), [0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0])
+                pair[from_score != to_score] += 1
+                if metric is not None:
+                    pair[2] += 1
+                    pair[3] += x
+                    pair[4] += y
+                    pair[5] += x * x
+                    pair[6] += y * y
+                    pair[7] += x * y
+
+    similarities = {}
+    for key, pair in stats.iteritems():
+        similarity = None
+        if metric is not None:
+            similarity = _get_similarity(metric, *pair[2:])
+        similarities[key] = (pair[0], pair[1], similarity)
+    return similarities
+
+def _compute_with_numpy(user_ids, votes, metric, values, candidates):
+    if not votes:
+        return {}
+
+    def index(keys):
+        indexes = {}
+        return numpy.array([indexes.setdefault(key, len(indexes)) for key in keys]), len(indexes)
+
+    users, num_users = index([vote[3] for vote in votes])
+    objects, num_objects = index([vote[:3] for vote in votes])
+    answers, num_answers = index([vote[:3] + (vote[4],) for vote in votes])
+    user_ids_by_index = numpy.zeros(num_users, dtype=int)
+    user_ids_by_index[users] = [vote[3] for vote in votes]
+    ones = numpy.ones(len(votes), dtype=int)
+
+    def matrix(data, columns, num_columns):
+        return sparse.csr_matrix((data, (users, columns)), shape=(num_users, num_columns))
+
+    # voters x objects, and voters x (object, score) incidence matrices
+    voted = matrix(ones, objects, num_objects)
+    answered = matrix(ones, answers, num_answers)
+    block = numpy.array([i for i, user_id in enumerate(user_ids_by_index) if user_id in user_ids])
+
+    if candidates is None:
+        # objects voted on by both users, for the block against every voter
+        common = (voted[block] * voted.T).tocoo()
+        rows, columns, n = block[common.row], common.col, common.data.astype(float)
+
+        def dot(a, b):
+            return numpy.asarray((a[block] * b.T)[common.row, common.col]).ravel()
+    else:
+        # only the candidate pairs, one row of each at a time
+        position = dict([(user_id, i) for i, user_id in enumerate(user_ids_by_index)])
+        pairs = [(i, position[to_user_id]) for i in block
+                 for to_user_id in candidates.get(int(user_ids_by_index[i]), ())
+                 if to_user_id in position and position[to_user_id] != i]
+        if not pairs:
+            return {}
+        rows, columns = numpy.array([pair[0] for pair in pairs]), numpy.array([pair[1] for pair in pairs])
+
+        def dot(a, b):
+            return numpy.asarray(a[rows].multiply(b[columns]).sum(axis=1)).ravel()
+        n = dot(voted, voted).astype(float)
+        shared = n > 0
+        rows, columns, n = rows[shared], columns[shared], n[shared]
+
+    # objects they gave the same score
+    agrees = dot(answered, answered).astype(int)
+
+    similarity = None
+    if metric is not None:
+        scores = matrix(numpy.array(values), objects, num_objects)
+        squares = matrix(numpy.array(values) ** 2, objects, num_objects)
+        sx = dot(scores, voted)
+        sy = dot(voted, scores)
+        sxx = dot(squares, voted)
+        syy = dot(voted, squares)
+        sxy = dot(scores, scores)
+        if metric == 'distance':
+            similarity = 1 - numpy.sqrt(numpy.maximum(sxx + syy - 2 * sxy, 0) / n)
+        else:
+            if metric == 'pearson':
+                numerator = sxy - sx * sy / n
+                denominator = (sxx - sx * sx / n) * (syy - sy * sy / n)
+            else:
+                numerator, denominator = sxy, sxx * syy
+            positive = denominator > 1e-12
+            similarity = numpy.zeros(len(n))
+            similarity[positive] = numerator[positive] / numpy.sqrt(denominator[positive])
+
+    similarities = {}
+    from_user_ids, to_user_ids = user_ids_by_index[rows], user_ids_by_index[columns]
+    for i in xrange(len(n)):
+        from_user_id, to_user_id = int(from_user_ids[i]), int(to_user_ids[i])
+        if from_user_id == to_user_id:
+            continue
+        value = None
+        if similarity is not None:
+            value = float(similarity[i])
+        similarities[(from_user_id, to_user_id)] = (int(agrees[i]), int(n[i]) - int(agrees[i]), value)
+    return similarities
+
+def _get_similar_users(user_ids):
+    """Returns the users similar to each of ``user_ids`` along with the weight
+    of their votes, as a ``{from_user_id: [(to_user_id, weight)]}`` dict."""
+    # every pair of co-voters is kept when SimilarUser is updated incrementally
+    incremental = getattr(settings, 'RATINGS_SIMILAR_USERS_UPDATE', RATINGS_SIMILAR_USERS_UPDATE)
+    metric = getattr(settings, 'RATINGS_SIMILARITY_METRIC', RATINGS_SIMILARITY_METRIC)
+    min_agreement = getattr(settings, 'RATINGS_MIN_AGREEMENT', RATINGS_MIN_AGREEMENT)
+    min_similarity = getattr(settings, 'RATINGS_MIN_SIMILARITY', RATINGS_MIN_SIMILARITY)
+
+    similar = {}
+    for from_user_id, to_user_id, agrees, disagrees, similarity in SimilarUser.objects.filter(
+            from_user__in=user_ids, exclude=False, generation=SimilarUser.objects.get_generation()).values_list(
+            'from_user', 'to_user', 'agrees', 'disagrees', 'similarity').order_by():
+        if incremental:
+            if metric and (similarity is None or similarity < min_similarity):
+                continue
+            if not metric and agrees / (disagrees + 0.0001) <= min_agreement:
+                continue
+        # without a metric, the share of agreements
+        weight = similarity
+        if weight is None:
+            weight = agrees / (agrees + disagrees + 0.0001)
+        if weight > 0:
+            similar.setdefault(from_user_id, []).append((to_user_id, weight))
+    return similar
+
+def compute_recommendations(user_ids, size, min_score=1, chunk_size=500):
+    """compute_recommendations(user_ids, size, min_score=1, chunk_size=500)
+
+    Scores the objects which users similar to each of ``user_ids`` rated at
+    least ``min_score``, and which the user neither rated nor ignored. Each vote
+    adds its score, scaled by the ``range`` of its field, times the similarity
+    of its voter with the user (or the share of objects they agree on, without
+    ``RATINGS_SIMILARITY_METRIC``). Returns the ``size`` best objects of every
+    user and content type as ``(user_id, content_type_id, object_id, score)``
+    tuples."""
+    similar = _get_similar_users(user_ids)
+    ranges = _get_ranges()
+
+    to_user_ids = set()
+    for users in similar.itervalues():
+        to_user_ids.update([to_user_id for to_user_id, weight in users])
+    to_user_ids = sorted(to_user_ids)
+    votes = {}
+    for i in xrange(0, len(to_user_ids), chunk_size):
+        for user_id, content_type, object_id, key, score in Vote.objects.filter(
+                user__in        = to_user_ids[i:i + chunk_size],
+                score__gte      = min_score,
+            ).values_list('user', 'content_type', 'object_id', 'key', 'score').order_by():
+            # votes on fields which no longer exist can't be scaled
+            if key in ranges:
+                votes.setdefault(user_id, []).append((content_type, object_id, float(score) / ranges[key]))
+
+    seen = set(Vote.objects.filter(user__in=user_ids).values_list('user', 'content_type', 'object_id').order_by())
+    seen.update(IgnoredObject.objects.filter(user__in=user_ids).values_list('user', 'content_type', 'object_id').order_by())
+
+    recommendations = []
+    for from_user_id, users in similar.iteritems():
+        scores = {}
+        for to_user_id, weight in users:
+            for content_type, object_id, value in votes.get(to_user_id, ()):
+                if (from_user_id, content_type, object_id) not in seen:
+                    scores[(content_type, object_id)] = scores.get((content_type, object_id), 0) + weight * value
+        by_content_type = {}
+        for (content_type, object_id), score in scores.iteritems():
+            by_content_type.setdefault(content_type, []).append((score, -object_id))
+        for content_type, candidates in by_content_type.iteritems():
+            recommendations.extend([(from_user_id, content_type, -object_id, score)
+                                    for score, object_id in heapq.nlargest(size, candidates)])
+    return recommendations
+
+def iter_object_chunks(content_type, key, chunk_size):
+    """iter_object_chunks(content_type, key, chunk_size)
+
+    Yields the ids of every object registered users voted on for a rating
+    field, in lists of ``chunk_size``."""
+    last_object_id = None
+    while True:
+        qs = Vote.objects.filter(content_type=content_type, key=key, user__isnull=False)
+        if last_object_id is not None:
+            qs = qs.filter(object_id__gt=last_object_id)
+        object_ids = list(qs.order_by('object_id').values_list('object_id', flat=True).distinct()[:chunk_size])
+        if not object_ids:
+            return
+        yield object_ids
+        last_object_id = object_ids[-1]
+
+def _get_object_votes(content_type, key, lookup, values, chunk_size=500):
+    """Returns the votes of registered users for a rating field whose ``lookup``
+    (``'object_id'`` or ``'user'``) is one of ``values``, as ``(object_id,
+    user_id, score)`` tuples."""
+    values = sorted(values)
+    votes = []
+    for i in xrange(0, len(values), chunk_size):
+        votes.extend(Vote.objects.filter(**{
+            'content_type': content_type,
+            'key': key,
+            'user__isnull': False,
+            '%s__in' % lookup: values[i:i + chunk_size],
+        }).values_list('object_id', 'user', 'score').order_by())
+    return votes
+
+def _iter_votes_of_users(content_type, key, user_ids, max_votes, chunk_size=500):
+    """Yields the votes of ``user_ids`` for a rating field, as lists of
+    ``(object_id, user_id, score)`` tuples of at most ``max_votes`` votes unless
+    a single user cast more."""
+    user_ids = sorted(user_ids)
+    counts = []
+    for i in xrange(0, len(user_ids), chunk_size):
+        counts.extend(Vote.objects.filter(content_type=content_type, key=key, user__in=user_ids[i:i + chunk_size],
+                                          ).values_list('user').annotate(votes=Count('id')).order_by('user'))
+    batch, total = [], 0
+    for user_id, votes in counts:
+        if batch and total + votes > max_votes:
+            yield _get_object_votes(content_type, key, 'user', batch)
+            batch, total = [], 0
+        batch.append(user_id)
+        total += votes
+    if batch:
+        yield _get_object_votes(content_type, key, 'user', batch)
+
+def get_object_norms(content_type, key, chunk_size=1000):
+    """get_object_norms(content_type, key, chunk_size=1000)
+
+    Returns the euclidean norm of the scores of every object voted on for a
+    rating field, reading the votes of ``chunk_size`` objects at a time."""
+    norms = {}
+    for object_ids in iter_object_chunks(content_type, key, chunk_size):
+        for object_id, user_id, score in _get_object_votes(content_type, key, 'object_id', object_ids):
+            norms[object_id] = norms.get(object_id, 0) + score * score
+    return dict([(object_id, math.sqrt(total)) for object_id, total in norms.iteritems()])
+
+def compute_object_similarities(content_type, key, object_ids, norms, size, max_votes=None):
+    """compute_object_similarities(content_type, key, object_ids, norms, size, max_votes=None)
+
+    Returns the ``size`` objects most similar to each of ``object_ids`` for a
+    rating field, by the cosine similarity of the scores they were given by
+    the same registered users, as a ``{object_id: [(to_object_id,
+    similarity)]}`` dict, best first. ``norms`` are the ones returned by
+    ``get_object_norms``.
+
+    The votes of the users who voted on ``object_ids`` are loaded ``max_votes``
+    (defaults to ``MAX_VOTES``) at a time, and their dot products summed."""
+    if max_votes is None:
+        max_votes = MAX_VOTES
+    user_ids = set([user_id for object_id, user_id, score in
+                    _get_object_votes(content_type, key, 'object_id', object_ids)])
+    dots = {}
+    for votes in _iter_votes_of_users(content_type, key, user_ids, max_votes):
+        if numpy is not None:
+            batch = _dot_objects_with_numpy(set(object_ids), votes)
+        else:
+            batch = _dot_objects_with_python(set(object_ids), votes)
+        for object_id, products in batch.iteritems():
+            totals = dots.setdefault(object_id, {})
+            for to_object_id, product in products.iteritems():
+                totals[to_object_id] = totals.get(to_object_id, 0) + product
+
+    neighbors = {}
+    for object_id, products in dots.iteritems():
+        candidates = [(product / (norms[object_id] * norms[to_object_id]), -to_object_id)
+                      for to_object_id, product in products.iteritems()
+                      if to_object_id != object_id and product > 0]
+        neighbors[object_id] = [(-to_object_id, similarity)
+                                for similarity, to_object_id in heapq.nlargest(size, candidates)]
+    return neighbors
+
+def _dot_objects_with_python(object_ids, votes):
+    by_user = {}
+    for object_id, user_id, score in votes:
+        by_user.setdefault(user_id, []).append((object_id, score))
+
+    dots = {}
+    for user_votes in by_user.itervalues():
+        for object_id, score in user_votes:
+            if object_id not in object_ids:
+                continue
+            products = dots.setdefault(object_id, {})
+            for to_object_id, to_score in user_votes:
+                products[to_object_id] = products.get(to_object_id, 0) + score * to_score
+    return dots
+
+def _dot_objects_with_numpy(object_ids, votes):
+    if not votes:
+        return {}
+
+    def index(keys):
+        indexes = {}
+        return numpy.array([indexes.setdefault(key, len(indexes)) for key in keys]), len(indexes)
+
+    users, num_users = index([vote[1] for vote in votes])
+    objects, num_objects = index([vote[0] for vote in votes])
+    object_ids_by_index = numpy.zeros(num_objects, dtype=int)
+    object_ids_by_index[objects] = [vote[0] for vote in votes]
+    scores = sparse.csc_matrix((numpy.array([vote[2] for vote in votes], dtype=float), (users, objects)),
+                               shape=(num_users, num_objects))
+
+    # objects x objects dot products of the chunk's objects with every other one
+    chunk = numpy.array([i for i, object_id in enumerate(object_ids_by_index) if object_id in object_ids])
+    products = (scores[:, chunk].T * scores).tocsr()
+    dots = {}
+    for row, i in enumerate(chunk):
+        start, end = products.indptr[row], products.indptr[row + 1]
+        dots[int(object_ids_by_index[i])] = dict(zip([int(object_id) for object_id in object_ids_by_index[products.indices[start:end]]],
+                                                     products.data[start:end].tolist()))
+    return dots
@@ -11,6 +11,18 @@ from djangoratings.models import Vote
 
 register = template.Library()
 
+# Context variable holding the votes fetched by the ``ratings_by_*`` tags, which
+# the single object tags reuse
+VOTES_CACHE_VAR = '_djangoratings_votes'
+
+def get_cached_vote(context, voter, obj, field_name):
+    """Returns a ``(found, vote)`` tuple for a vote already fetched by a ``ratings_by_*`` tag."""
+    key = (voter, obj.__class__, obj.pk, field_name)
+    votes = context.get(VOTES_CACHE_VAR) or {}
+    if key in votes:
+        return True, votes[key]
+    return False, None
+
 class RatingByRequestNode(template.Node):
     def __init__(self, request, obj, context_var):
         self.request = request
@@ -24,6 +36,10 @@ class RatingByRequestNode(template.Node):
             field = getattr(obj, self.field_name)
         except (template.VariableDoesNotExist, AttributeError):
             return ''
+        found, vote = get_cached_vote(context, request, obj, self.field_name)
+        if found:
+            context[self.context_var] = vote
+            return ''
         try:
             vote = field.get_rating_for_user(request.user, request.META['REMOTE_ADDR'], request.COOKIES)
             context[self.context_var] = vote
@@ -60,6 +76,10 @@ class RatingByUserNode(RatingByRequestNode):
             field = getattr(obj, self.field_name)
         except template.VariableDoesNotExist:
             return ''
+        found, vote = get_cached_vote(context, user, obj, self.field_name)
+        if found:
+            context[self.context_var] = vote
+            return ''
         try:
             vote = field.get_rating_for_user(user)
             context[self.context_var] = vote
@@ -87,3 +107,83 @@ def do_rating_by_user(parser, token):
         raise template.TemplateSyntaxError("fourth argument to '%s' tag must be 'as'" % bits[0])
     return RatingByUserNode(bits[1], bits[3], bits[5])
 register.tag('rating_by_user', do_rating_by_user)
+
+class RatingsByRequestNode(template.Node):
+    def __init__(self, voter, object_list, context_var):
+        self.voter = voter
+        self.object_list, self.field_name = object_list.rsplit('.', 1)
+        self.context_var = context_var
+
+    def get_votes(self, request, objects):
+        return Vote.objects.get_for_voter_in_bulk(objects, self.field_name, request.user,
+                                                  request.META['REMOTE_ADDR'], request.COOKIES)
+
+    def render(self, context):
+        try:
+            voter = template.resolve_variable(self.voter, context)
+            objects = list(template.resolve_variable(self.object_list, context))
+            votes = self.get_votes(voter, objects)
+        except (template.VariableDoesNotExist, AttributeError, TypeError):
+            return ''
+
+        scores = {}
+        cache = dict(context.get(VOTES_CACHE_VAR) or {})
+        for obj in objects:
+            vote = votes.get((obj, self.field_name))
+            score = vote and vote.score or None
+            cache[(voter, obj.__class__, obj.pk, self.field_name)] = score
+            if score is not None:
+                scores[obj.pk] = score
+        context[VOTES_CACHE_VAR] = cache
+        context[self.context_var] = scores
+        return ''
+
+def do_ratings_by_request(parser, token):
+    """
+    Retrieves the scores of the ``Vote`` objects cast by a user on a list of
+    objects with a single query, and stores them in a context variable as a
+    dict keyed by object pk. Objects the user has not voted on are left out.
+    ``rating_by_request`` tags used later on for the same objects reuse these
+    votes.
+    
+    Example usage::
+    
+        {% ratings_by_request request for object_list.rating as votes %}
+    """
+    
+    bits = token.contents.split()
+    if len(bits) != 6:
+        raise template.TemplateSyntaxError("'%s' tag takes exactly five arguments" % bits[0])
+    if bits[2] != 'for':
+        raise template.TemplateSyntaxError("second argument to '%s' tag must be 'for'" % bits[0])
+    if bits[4] != 'as':
+        raise template.TemplateSyntaxError("fourth argument to '%s' tag must be 'as'" % bits[0])
+    return RatingsByRequestNode(bits[1], bits[3], bits[5])
+register.tag('ratings_by_request', do_ratings_by_request)
+
+class RatingsByUserNode(RatingsByRequestNode):
+    def get_votes(self, user, objects):
+        return Vote.objects.get_for_voter_in_bulk(objects, self.field_name, user)
+
+def do_ratings_by_user(parser, token):
+    """
+    Retrieves the scores of the ``Vote`` objects cast by a user on a list of
+    objects with a single query, and stores them in a context variable as a
+    dict keyed by object pk. Objects the user has not voted on are left out.
+    ``rating_by_user`` tags used later on for the same objects reuse these
+    votes.
+    
+    Example usage::
+    
+        {% ratings_by_user user for object_list.rating as votes %}
+    """
+    
+    bits = token.contents.split()
+    if len(bits) != 6:
+        raise template.TemplateSyntaxError("'%s' tag takes exactly five arguments" % bits[0])
+    if bits[2] != 'for':
+        raise template.TemplateSyntaxError("second argument to '%s' tag must be 'for'" % bits[0])
+    if bits[4] != 'as':
+        raise template.TemplateSyntaxError("fourth argument to '%s' tag must be 'as'" % bits[0])
+    return RatingsByUserNode(bits[1], bits[3], bits[5])
+register.tag('ratings_by_user', do_ratings_by_user)
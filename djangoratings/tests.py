@@ -1,24 +1,49 @@
 import unittest
 import random
+import os
+import tempfile
+from StringIO import StringIO
 
-from django.db import models
+from django.db import models, connection, DatabaseError
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.test import TestCase
+from django.core.management import call_command
 
 from exceptions import *
-from models import Vote, SimilarUser, IgnoredObject
+from models import Vote, Score, ScoreHistogram, SimilarUser, IgnoredObject, Recommendation, SimilarObject
+from managers import RatedManager
 from fields import AnonymousRatingField, RatingField
+from buffer import VoteBuffer, vote_buffer
+from caching import cache, get_cache_key
+from lsh import compare_with_exact
+from similarity import compute_similarities, _get_candidate_votes
 
 settings.RATINGS_VOTES_PER_IP = 1
+settings.RATINGS_BUFFER_INTERVAL = 0
 
 class RatingTestModel(models.Model):
     rating = AnonymousRatingField(range=2, can_change_vote=True)
     rating2 = RatingField(range=2, can_change_vote=False)
+    rating3 = AnonymousRatingField(range=5, can_change_vote=True, allow_delete=True, atomic_updates=True)
+    rating4 = AnonymousRatingField(range=5, can_change_vote=True, buffered=True)
+    rating5 = AnonymousRatingField(range=5, can_change_vote=True, allow_delete=True, atomic_updates=True, histogram=True)
     
     def __unicode__(self):
         return unicode(self.pk)
 
+class CookieRatingTestModel(models.Model):
+    rating = AnonymousRatingField(range=5, use_cookies=True)
+
+class RankedTestModel(models.Model):
+    rating = AnonymousRatingField(range=5, can_change_vote=True, weight=2, store_rating=True)
+    rating2 = AnonymousRatingField(range=5, atomic_updates=True, store_rating=True, leaderboard=True)
+    rating3 = AnonymousRatingField(range=5, weight=2)
+    rating4 = AnonymousRatingField(range=2, store_bayesian=True, store_wilson=True)
+
+    objects = RatedManager()
+
 class RatingTestCase(unittest.TestCase):
     def testRatings(self):
         instance = RatingTestModel.objects.create()
@@ -62,6 +87,538 @@ class RatingTestCase(unittest.TestCase):
         self.assertEquals(instance.rating2.score, 0)
         self.assertEquals(instance.rating2.votes, 0)
 
+class RatingManagerCacheTestCase(unittest.TestCase):
+    def testCachedManager(self):
+        instance = RatingTestModel.objects.create()
+        self.assertTrue(instance.rating.instance is instance)
+        self.assertTrue(instance.rating2.field is RatingTestModel.rating2)
+        self.assertRaises(AttributeError, setattr, instance.rating, 'foo', 'bar')
+
+        instance.rating.add(score=2, user=None, ip_address='127.0.6.1')
+        self.assertEquals(instance.rating.get_real_rating(), 2)
+
+        # Copies of an instance do not share its manager
+        import copy
+        copied = copy.copy(instance)
+        self.assertTrue(copied.rating.instance is copied)
+
+        import pickle
+        for protocol in (0, pickle.HIGHEST_PROTOCOL):
+            self.assertEquals(pickle.loads(pickle.dumps(instance, protocol)).rating.get_real_rating(), 2)
+
+    def testInstanceCollected(self):
+        import gc
+        import weakref
+        instance = RatingTestModel.objects.create()
+        instance.rating.add(score=2, user=None, ip_address='127.0.30.1')
+        self.assertEquals(instance.rating.votes, 1)
+        ref = weakref.ref(instance)
+        # freed by reference counting, without waiting for the cyclic collector
+        gc.disable()
+        try:
+            del instance
+            self.assertTrue(ref() is None)
+        finally:
+            gc.enable()
+
+class BulkVoterLookupTestCase(unittest.TestCase):
+    def testVotesInBulk(self):
+        instance = RatingTestModel.objects.create()
+        instance2 = RatingTestModel.objects.create()
+        other = CookieRatingTestModel.objects.create()
+        user = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        instance.rating.add(score=1, user=None, ip_address='127.0.7.1')
+        instance.rating2.add(score=2, user=user, ip_address='127.0.7.1')
+        instance2.rating.add(score=2, user=user, ip_address='127.0.7.2')
+        adds = other.rating.add(score=4, user=None, ip_address='127.0.7.1')
+        cookies = {adds['cookie_name']: adds['cookie']}
+
+        objects = [instance, instance2, other]
+        votes = Vote.objects.get_for_voter_in_bulk(objects, ['rating', 'rating2'], user=user)
+        self.assertEquals(sorted([(obj.pk, name, vote.score) for (obj, name), vote in votes.items()]),
+                          sorted([(instance.pk, 'rating2', 2), (instance2.pk, 'rating', 2)]))
+
+        votes = Vote.objects.get_for_voter_in_bulk(objects, 'rating', ip_address='127.0.7.1', cookies=cookies)
+        self.assertEquals(len(votes), 2)
+        self.assertEquals(votes[(instance, 'rating')].score, 1)
+        self.assertEquals(votes[(other, 'rating')].score, 4)
+
+        # Without its cookie, the anonymous vote on ``other`` is someone else's
+        votes = Vote.objects.get_for_voter_in_bulk(objects, 'rating', ip_address='127.0.7.1')
+        self.assertEquals(votes.keys(), [(instance, 'rating')])
+
+class TemplateTagsTestCase(TestCase):
+    def testRatingsByRequest(self):
+        from django.contrib.auth.models import AnonymousUser
+        from django.http import HttpRequest
+        from django.template import Template, Context
+
+        objects = [RatingTestModel.objects.create() for i in range(3)]
+        objects[0].rating.add(score=1, user=None, ip_address='127.0.8.1')
+        objects[2].rating.add(score=2, user=None, ip_address='127.0.8.1')
+        objects[1].rating.add(score=2, user=None, ip_address='127.0.8.2')
+        ContentType.objects.get_for_model(RatingTestModel)
+
+        request = HttpRequest()
+        request.META['REMOTE_ADDR'] = '127.0.8.1'
+        request.user = AnonymousUser()
+
+        template = Template(
+            "{% load ratings %}"
+            "{% ratings_by_request request for objects.rating as votes %}"
+            "{% for obj in objects %}{% rating_by_request request on obj.rating as vote %}{{ vote }},{% endfor %}"
+        )
+        context = Context({'request': request, 'objects': objects})
+        self.assertNumQueries(1, template.render, context)
+        self.assertEquals(template.render(context), '1,None,2,')
+        self.assertEquals(context['votes'], {objects[0].pk: 1, objects[2].pk: 2})
+
+        # objects without the rating field render nothing
+        template = Template("{% load ratings %}{% ratings_by_request request for objects.rating as votes %}")
+        self.assertEquals(template.render(Context({'request': request, 'objects': [request.user]})), '')
+
+class AtomicRatingTestCase(unittest.TestCase):
+    def testConcurrentVotes(self):
+        instance = RatingTestModel.objects.create()
+
+        # Two copies of the same row, as seen by two concurrent requests
+        first = RatingTestModel.objects.get(pk=instance.pk)
+        second = RatingTestModel.objects.get(pk=instance.pk)
+
+        first.rating.add(score=1, user=None, ip_address='127.0.1.1')
+        first.rating3.add(score=3, user=None, ip_address='127.0.1.1')
+        second.rating3.add(score=5, user=None, ip_address='127.0.1.2')
+
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals(instance.rating3.score, 8)
+        self.assertEquals(instance.rating3.votes, 2)
+        # Only the rating3 columns were written by the stale copy
+        self.assertEquals(instance.rating.score, 1)
+        self.assertEquals(instance.rating.votes, 1)
+
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        score = Score.objects.get(content_type=ct, object_id=instance.pk, key=instance.rating3.field.key)
+        self.assertEquals((score.score, score.votes), (8, 2))
+
+        # Test changing and deleting of votes
+        first.rating3.add(score=1, user=None, ip_address='127.0.1.1')
+        second.rating3.delete(user=None, ip_address='127.0.1.2')
+
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals(instance.rating3.score, 1)
+        self.assertEquals(instance.rating3.votes, 1)
+
+        score = Score.objects.get(pk=score.pk)
+        self.assertEquals((score.score, score.votes), (1, 1))
+
+class HistogramTestCase(unittest.TestCase):
+    def testDistribution(self):
+        instance = RatingTestModel.objects.create()
+        other = RatingTestModel.objects.create()
+
+        instance.rating5.add(score=5, user=None, ip_address='127.0.13.1')
+        instance.rating5.add(score=5, user=None, ip_address='127.0.13.2')
+        instance.rating5.add(score=2, user=None, ip_address='127.0.13.3')
+        self.assertEquals(instance.rating5.get_distribution(), {1: 0, 2: 1, 3: 0, 4: 0, 5: 2})
+
+        # Changed votes move between buckets, deleted votes leave theirs
+        instance.rating5.add(score=4, user=None, ip_address='127.0.13.2')
+        instance.rating5.delete(user=None, ip_address='127.0.13.3')
+        self.assertEquals(instance.rating5.get_distribution(), {1: 0, 2: 0, 3: 0, 4: 1, 5: 1})
+
+        other.rating5.add(score=1, user=None, ip_address='127.0.13.1')
+        other.rating3.add(score=3, user=None, ip_address='127.0.13.1')
+        distributions = ScoreHistogram.objects.get_distributions([instance, other], 'rating5')
+        self.assertEquals(distributions[other.pk], {1: 1, 2: 0, 3: 0, 4: 0, 5: 0})
+        # Fields without a histogram are counted from their votes
+        self.assertEquals(other.rating3.get_distribution(), {1: 0, 2: 0, 3: 1, 4: 0, 5: 0})
+
+        # Histograms are rebuilt along with the tallies
+        Vote.objects.filter(object_id=instance.pk, ip_address='127.0.13.1').delete()
+        self.assertEquals(instance.rating5.get_distribution(), {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+class VoteQueriesTestCase(TestCase):
+    def testQueriesPerVote(self):
+        instance = RatingTestModel.objects.create()
+        ContentType.objects.get_for_model(instance)
+
+        # Vote lookup (including the IP limit), vote insert, tally increment, Score upsert
+        self.assertNumQueries(4, instance.rating3.add, score=3, user=None, ip_address='127.0.2.1')
+        self.assertNumQueries(4, instance.rating3.add, score=4, user=None, ip_address='127.0.2.2')
+        # Changing a vote costs the same
+        self.assertNumQueries(4, instance.rating3.add, score=1, user=None, ip_address='127.0.2.1')
+        self.assertRaises(IPLimitReached, instance.rating3.add, score=1, user=User.objects.create(username='voter'), ip_address='127.0.2.2')
+
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals(instance.rating3.score, 5)
+        self.assertEquals(instance.rating3.votes, 2)
+
+class CachedScoreTestCase(TestCase):
+    def testCachedTallies(self):
+        instance = RatingTestModel.objects.create()
+        other = RatingTestModel.objects.create()
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        key = instance.rating.field.key
+
+        # Written through by add()
+        instance.rating.add(score=2, user=None, ip_address='127.0.14.1')
+        self.assertNumQueries(0, Score.objects.get_cached, RatingTestModel, instance.pk, 'rating')
+        self.assertEquals(Score.objects.get_cached(RatingTestModel, instance.pk, 'rating'), (2, 1))
+
+        # Incremented tallies are invalidated, and read again once
+        instance.rating3.add(score=4, user=None, ip_address='127.0.14.1')
+        self.assertNumQueries(1, Score.objects.get_cached_in_bulk, RatingTestModel, [instance.pk, other.pk], 'rating3')
+        self.assertEquals(Score.objects.get_cached_in_bulk(RatingTestModel, [instance.pk, other.pk], 'rating3'),
+                          {instance.pk: (4, 1), other.pk: (0, 0)})
+
+        # Expired tallies are served while someone else refreshes them
+        cache_key = get_cache_key('score', ct.pk, key, instance.pk)
+        cache.set(cache_key, (1, 1, 0))
+        cache.add(cache_key + ':lock', 1)
+        self.assertEquals(Score.objects.get_cached(RatingTestModel, instance.pk, 'rating'), (1, 1))
+        cache.delete(cache_key + ':lock')
+        self.assertEquals(Score.objects.get_cached(RatingTestModel, instance.pk, 'rating'), (2, 1))
+
+        # Rebuilt tallies are written through as well
+        Vote.objects.filter(object_id=instance.pk, key=key).delete()
+        self.assertEquals(Score.objects.get_cached(RatingTestModel, instance.pk, 'rating'), (0, 0))
+
+class BulkAddTestCase(unittest.TestCase):
+    def testBulkAdd(self):
+        instance = RatingTestModel.objects.create()
+        instance2 = RatingTestModel.objects.create()
+        user = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        instance.rating.add(score=1, user=None, ip_address='127.0.3.1')
+
+        result = Vote.objects.bulk_add([
+            (instance, 'rating', None, '127.0.3.1', None, 2), # changes the existing vote
+            (instance, 'rating', None, '127.0.3.2', None, 2),
+            (instance2, 'rating', None, '127.0.3.2', None, 1),
+            (instance2, 'rating2', user, '127.0.3.3', None, 2),
+            (instance2, 'rating2', user, '127.0.3.3', None, 1), # cannot change rating2 votes
+            (instance2, 'rating2', None, '127.0.3.4', None, 1), # rating2 is not anonymous
+            (instance2, 'rating', None, '127.0.3.2', None, 3), # out of range
+        ], fail_silently=True)
+
+        self.assertEquals(result['added'], 3)
+        self.assertEquals(result['changed'], 1)
+        self.assertEquals(result['deleted'], 0)
+        self.assertEquals([e.__class__ for item, e in result['rejected']], [AuthRequired, InvalidRating, CannotChangeVote])
+
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals(instance.rating.score, 4)
+        self.assertEquals(instance.rating.votes, 2)
+
+        instance2 = RatingTestModel.objects.get(pk=instance2.pk)
+        self.assertEquals(instance2.rating.score, 1)
+        self.assertEquals(instance2.rating.votes, 1)
+        self.assertEquals(instance2.rating2.score, 2)
+        self.assertEquals(instance2.rating2.votes, 1)
+
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        score = Score.objects.get(content_type=ct, object_id=instance2.pk, key=instance2.rating2.field.key)
+        self.assertEquals((score.score, score.votes), (2, 1))
+
+        user2 = User.objects.create(username=str(random.randint(0, 100000000)))
+        self.assertRaises(IPLimitReached, Vote.objects.bulk_add, [
+            (instance2, 'rating2', user2, '127.0.3.3', None, 1),
+        ])
+
+class VoteDeletionTestCase(unittest.TestCase):
+    def testDeleteRecalculatesAffectedObjects(self):
+        first = RatingTestModel.objects.create()
+        second = RatingTestModel.objects.create()
+        ranked = RankedTestModel.objects.create()
+        for instance in (first, second):
+            instance.rating.add(score=2, user=None, ip_address='127.0.16.1')
+            instance.rating3.add(score=4, user=None, ip_address='127.0.16.1')
+            instance.rating3.add(score=5, user=None, ip_address='127.0.16.2')
+        ranked.rating.add(score=3, user=None, ip_address='127.0.16.1')
+
+        # Purge the votes cast from one IP, on several objects, models and fields
+        Vote.objects.filter(ip_address='127.0.16.1').delete()
+
+        for instance in (first, second):
+            instance = RatingTestModel.objects.get(pk=instance.pk)
+            self.assertEquals((instance.rating.score, instance.rating.votes), (0, 0))
+            self.assertEquals((instance.rating3.score, instance.rating3.votes), (5, 1))
+        ranked = RankedTestModel.objects.get(pk=ranked.pk)
+        self.assertEquals((ranked.rating.score, ranked.rating.votes, ranked.rating_rating), (0, 0, 0))
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        score = Score.objects.get(content_type=ct, object_id=second.pk, key=second.rating3.field.key)
+        self.assertEquals((score.score, score.votes), (5, 1))
+
+    def testDeleteUpdatesInBulk(self):
+        instances = [RatingTestModel.objects.create() for i in xrange(5)]
+        for instance in instances:
+            instance.rating.add(score=2, user=None, ip_address='127.0.26.1')
+            instance.rating3.add(score=4, user=None, ip_address='127.0.26.1')
+
+        debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            Vote.objects.filter(ip_address='127.0.26.1').delete()
+            table = connection.ops.quote_name(RatingTestModel._meta.db_table)
+            updates = [query for query in connection.queries if query['sql'].startswith('UPDATE %s' % (table,))
+                       or query['sql'].startswith('update %s' % (table,))]
+        finally:
+            settings.DEBUG = debug
+        # a single statement for all of the objects and fields
+        self.assertEquals(len(updates), 1)
+        for instance in instances:
+            instance = RatingTestModel.objects.get(pk=instance.pk)
+            self.assertEquals((instance.rating.votes, instance.rating3.votes), (0, 0))
+
+class RebuildRatingsTestCase(unittest.TestCase):
+    def testRebuild(self):
+        instances = [RatingTestModel.objects.create() for i in xrange(3)]
+        for i, instance in enumerate(instances):
+            instance.rating3.add(score=i + 1, user=None, ip_address='127.0.15.1')
+            instance.rating3.add(score=5, user=None, ip_address='127.0.15.2')
+
+        # Tallies and Score rows gone out of sync
+        RatingTestModel.objects.filter(pk__in=[obj.pk for obj in instances]).update(rating3_score=0, rating3_votes=0)
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        Score.objects.filter(content_type=ct, object_id=instances[0].pk).delete()
+        Score.objects.filter(content_type=ct, object_id=instances[1].pk).update(score=1, votes=9)
+
+        call_command('rebuild_ratings', 'djangoratings.RatingTestModel', chunk_size=2, verbosity=0)
+        for i, instance in enumerate(instances):
+            instance = RatingTestModel.objects.get(pk=instance.pk)
+            self.assertEquals((instance.rating3.score, instance.rating3.votes), (i + 6, 2))
+            score = Score.objects.get(content_type=ct, object_id=instance.pk, key=instance.rating3.field.key)
+            self.assertEquals((score.score, score.votes), (i + 6, 2))
+
+    def testNeverVoted(self):
+        instance = RatingTestModel.objects.create()
+        call_command('rebuild_ratings', 'djangoratings.RatingTestModel', chunk_size=2, verbosity=0)
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        self.assertFalse(Score.objects.filter(content_type=ct, object_id=instance.pk).exists())
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals((instance.rating3.score, instance.rating3.votes), (0, 0))
+
+class CheckRatingsTestCase(unittest.TestCase):
+    def testCheckAndRepair(self):
+        RankedTestModel.objects.all().delete()
+        first = RankedTestModel.objects.create()
+        second = RankedTestModel.objects.create()
+        first.rating3.add(score=4, user=None, ip_address='127.0.17.1')
+        second.rating3.add(score=2, user=None, ip_address='127.0.17.1')
+        RankedTestModel.objects.filter(pk=second.pk).update(rating3_votes=5)
+
+        def check(*args, **options):
+            output = StringIO()
+            call_command('check_ratings', 'djangoratings.RankedTestModel', stdout=output, **options)
+            return output.getvalue()
+
+        output = check(verbosity=0)
+        self.assertEquals(output.count('\n'), 1)
+        self.assertTrue(output.startswith('djangoratings.RankedTestModel #%s rating3: votes (2, 1), Score (2, 1), columns (2, 5)' % (second.pk,)))
+
+        # Resuming from a checkpoint skips the objects already checked
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        open(checkpoint, 'w').write('{"djangoratings.RankedTestModel": %d}' % (second.pk,))
+        self.assertEquals(check(verbosity=0, checkpoint=checkpoint), '')
+        self.assertFalse(os.path.exists(checkpoint))
+
+        output = check(chunk_size=1, repair=True)
+        self.assertTrue(output.endswith('djangoratings.RankedTestModel: 2 objects checked, 1 mismatches repaired\n'))
+        self.assertEquals(RankedTestModel.objects.get(pk=second.pk).rating3.votes, 1)
+        self.assertEquals(check(), 'djangoratings.RankedTestModel: 2 objects checked, 0 mismatches\n')
+
+class VoteBufferTestCase(unittest.TestCase):
+    def testBufferedVotes(self):
+        instance = RatingTestModel.objects.create()
+
+        instance.rating4.add(score=1, user=None, ip_address='127.0.4.1')
+        instance.rating4.add(score=5, user=None, ip_address='127.0.4.1')
+        instance.rating4.add(score=2, user=None, ip_address='127.0.4.2')
+        self.assertEquals(vote_buffer.stats()['backlog'], 2)
+        self.assertEquals(instance.rating4.get_ratings().count(), 0)
+
+        vote_buffer.flush()
+        stats = vote_buffer.stats()
+        self.assertEquals(stats['backlog'], 0)
+        self.assertEquals(stats['flushed'], 2)
+        self.assertEquals(stats['rejected'], 0)
+
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals(instance.rating4.score, 7)
+        self.assertEquals(instance.rating4.votes, 2)
+
+    def testFailedFlush(self):
+        instance = RatingTestModel.objects.create()
+        buffer = VoteBuffer(max_size=2, interval=0)
+        calls = []
+        def bulk_add(votes, fail_silently=False):
+            calls.append(len(votes))
+            raise DatabaseError('unavailable')
+        Vote.objects.bulk_add = bulk_add
+        try:
+            buffer.put(instance, 'rating4', None, '127.0.27.1', None, 1)
+            buffer.put(instance, 'rating4', None, '127.0.27.2', None, 2)
+            self.assertEquals(calls, [2])
+            # a full buffer does not flush again right after a failure
+            buffer.put(instance, 'rating4', None, '127.0.27.3', None, 3)
+            self.assertEquals(calls, [2])
+            stats = buffer.stats()
+            self.assertEquals((stats['errors'], stats['dropped'], stats['backlog']), (1, 1, 2))
+        finally:
+            del Vote.objects.bulk_add
+
+        buffer.flush()
+        stats = buffer.stats()
+        self.assertEquals((stats['flushed'], stats['backlog']), (2, 0))
+        instance = RatingTestModel.objects.get(pk=instance.pk)
+        self.assertEquals((instance.rating4.score, instance.rating4.votes), (3, 2))
+
+class IPCountCacheTestCase(unittest.TestCase):
+    def tearDown(self):
+        settings.RATINGS_VOTES_PER_IP_CACHE = None
+
+    def testCachedCounts(self):
+        settings.RATINGS_VOTES_PER_IP_CACHE = 'fast'
+
+        instance = RatingTestModel.objects.create()
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+        key = instance.rating2.field.key
+        user = User.objects.create(username=str(random.randint(0, 100000000)))
+        user2 = User.objects.create(username=str(random.randint(0, 100000000)))
+        cache_key = get_cache_key('ip', ct.pk, instance.pk, key, '127.0.5.1')
+
+        self.assertEquals(Vote.objects.count_for_ip(ct, instance.pk, key, '127.0.5.1'), 0)
+        instance.rating2.add(score=1, user=user, ip_address='127.0.5.1')
+        self.assertEquals(cache.get(cache_key), 1)
+        self.assertRaises(IPLimitReached, instance.rating2.add, score=1, user=user2, ip_address='127.0.5.1')
+
+        Vote.objects.filter(ip_address='127.0.5.1').delete()
+        self.assertEquals(cache.get(cache_key), None)
+        instance.rating2.add(score=1, user=user2, ip_address='127.0.5.1')
+
+        # A stale count is trusted in fast mode ...
+        cache.set(cache_key, 5)
+        self.assertEquals(Vote.objects.count_for_ip(ct, instance.pk, key, '127.0.5.1', 1), 5)
+
+        cache.set(cache_key, 0)
+        self.assertEquals(Vote.objects.count_for_ip(ct, instance.pk, key, '127.0.5.1', 1), 0)
+
+        # ... but checked against the database before accepting a vote in strict mode
+        settings.RATINGS_VOTES_PER_IP_CACHE = 'strict'
+        self.assertEquals(Vote.objects.count_for_ip(ct, instance.pk, key, '127.0.5.1', 1), 1)
+        self.assertEquals(cache.get(cache_key), 1)
+        self.assertRaises(IPLimitReached, instance.rating2.add, score=1, user=user, ip_address='127.0.5.1')
+
+        # A count seeded and incremented meanwhile is not overwritten by a
+        # count read before
+        cache.delete(cache_key)
+        add = cache.add
+        def seeded(*args, **kwargs):
+            add(*args, **kwargs)
+            cache.incr(cache_key)
+            return add(*args, **kwargs)
+        cache.add = seeded
+        try:
+            self.assertEquals(Vote.objects.count_for_ip(ct, instance.pk, key, '127.0.5.1'), 2)
+        finally:
+            del cache.add
+        self.assertEquals(cache.get(cache_key), 2)
+
+class RatingOrderingTestCase(unittest.TestCase):
+    def testOrdering(self):
+        RankedTestModel.objects.all().delete()
+        first = RankedTestModel.objects.create()
+        second = RankedTestModel.objects.create()
+        third = RankedTestModel.objects.create()
+
+        for instance, scores in ((first, [5, 5]), (second, [4, 4, 4, 4, 4, 4]), (third, [1])):
+            for i, score in enumerate(scores):
+                for name in ('rating', 'rating2', 'rating3'):
+                    getattr(instance, name).add(score=score, user=None, ip_address='127.0.9.%d' % (i,))
+
+        second = RankedTestModel.objects.get(pk=second.pk)
+        self.assertEquals(second.rating_rating, 3.0)
+        self.assertEquals(second.rating2_rating, 4.0)
+
+        # weighted: 2.5, 3.0, 0.33 - average: 5, 4, 1
+        def pks(qs):
+            return [obj.pk for obj in qs]
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating')), [second.pk, first.pk, third.pk])
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating3')), [second.pk, first.pk, third.pk])
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating', 'average')), [first.pk, second.pk, third.pk])
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating2', 'votes', descending=False)), [third.pk, first.pk, second.pk])
+
+        self.assertEquals(pks(RankedTestModel.objects.filter_by_rating('rating', gte=2.5).order_by('pk')), [first.pk, second.pk])
+        self.assertEquals(pks(RankedTestModel.objects.filter_by_rating('rating3', gte=2.5).order_by('pk')), [first.pk, second.pk])
+        self.assertEquals(pks(RankedTestModel.objects.filter_by_rating('rating3', 'average', gt=1, lt=5)), [second.pk])
+
+        # Stored ratings follow deletions
+        Vote.objects.filter(object_id=second.pk, ip_address='127.0.9.0').delete()
+        second = RankedTestModel.objects.get(pk=second.pk)
+        self.assertEquals(second.rating_rating, second.rating.get_rating())
+
+class ConfidenceRankingTestCase(unittest.TestCase):
+    def testRankings(self):
+        RankedTestModel.objects.all().delete()
+        popular = RankedTestModel.objects.create()
+        lucky = RankedTestModel.objects.create()
+        bad = RankedTestModel.objects.create()
+
+        for instance, scores in ((popular, [2] * 20 + [1] * 2), (lucky, [2]), (bad, [1] * 10)):
+            for i, score in enumerate(scores):
+                instance.rating4.add(score=score, user=None, ip_address='127.0.10.%d' % (i,))
+
+        # Refresh the stored Bayesian averages against the final mean (1.64 over 11 votes per object)
+        ct = ContentType.objects.get_for_model(RankedTestModel)
+        cache.delete(get_cache_key('prior', ct.pk, popular.rating4.field.key))
+        Score.objects.recalculate(RankedTestModel, [popular.pk, lucky.pk, bad.pk])
+
+        popular = RankedTestModel.objects.get(pk=popular.pk)
+        self.assertAlmostEquals(popular.rating4_bayesian, 60 / 33.0)
+        self.assertAlmostEquals(popular.rating4_bayesian, popular.rating4.get_bayesian_rating())
+        self.assertAlmostEquals(popular.rating4_wilson, popular.rating4.get_wilson_score())
+        self.assertEquals(RankedTestModel.objects.get(pk=bad.pk).rating4_wilson, 0)
+
+        def pks(qs):
+            return [obj.pk for obj in qs]
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating4', 'average')), [lucky.pk, popular.pk, bad.pk])
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating4', 'bayesian')), [popular.pk, lucky.pk, bad.pk])
+        self.assertEquals(pks(RankedTestModel.objects.order_by_rating('rating4', 'wilson')), [popular.pk, lucky.pk, bad.pk])
+        self.assertRaises(ValueError, RankedTestModel.objects.order_by_rating, 'rating', 'wilson')
+
+class LeaderboardTestCase(unittest.TestCase):
+    def testLeaderboard(self):
+        settings.RATINGS_LEADERBOARD_SIZE = 1
+        try:
+            RankedTestModel.objects.all().delete()
+            instances = [RankedTestModel.objects.create() for i in xrange(4)]
+            field = RankedTestModel.rating2
+            for order in ('weighted', 'votes'):
+                cache.delete(get_cache_key('leaderboard', field.get_content_type(RankedTestModel).pk, field.key, order))
+
+            def check():
+                for order, column in (('weighted', 'rating2_rating'), ('votes', 'rating2_votes')):
+                    expected = list(RankedTestModel.objects.filter(rating2_votes__gt=0).order_by('-' + column, 'pk'))
+                    self.assertEquals(field.get_leaderboard(order, limit=2), expected[:2])
+                    self.assertEquals(field.get_leaderboard(order, limit=4), expected)
+
+            for i, (instance, scores) in enumerate(zip(instances, ([3], [5, 4], [2, 2, 2], [1]))):
+                for j, score in enumerate(scores):
+                    instance.rating2.add(score=score, user=None, ip_address='127.0.12.%d' % (i * 10 + j,))
+                check()
+
+            # pushing a new object to the top moves the floor
+            instances[3].rating2.add(score=5, user=None, ip_address='127.0.12.100')
+            instances[3].rating2.add(score=5, user=None, ip_address='127.0.12.101')
+            instances[3].rating2.add(score=5, user=None, ip_address='127.0.12.102')
+            self.assertEquals(field.get_leaderboard('votes', limit=1), [instances[3]])
+            check()
+
+            self.assertRaises(TypeError, RankedTestModel.rating.get_leaderboard)
+        finally:
+            del settings.RATINGS_LEADERBOARD_SIZE
+
 class RecommendationsTestCase(unittest.TestCase):
     def setUp(self):
         self.instance = RatingTestModel.objects.create()
@@ -146,4 +703,342 @@ class RecommendationsTestCase(unittest.TestCase):
         self.assertEquals(SimilarUser.objects.count(), 2)
 
         recs = list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel))
-        self.assertEquals(len(recs), 0)
\ No newline at end of file
+        self.assertEquals(len(recs), 0)
+
+    def testMinAgreement(self):
+        Vote.objects.all().delete()
+
+        for instance in (self.instance, self.instance2, self.instance3):
+            instance.rating.add(score=1, user=self.user, ip_address='127.0.0.1')
+            instance.rating.add(score=1, user=self.user2, ip_address='127.0.0.2')
+        self.instance4.rating.add(score=1, user=self.user, ip_address='127.0.0.1')
+        self.instance4.rating.add(score=2, user=self.user2, ip_address='127.0.0.2')
+
+        # 3 agreements for 1 disagreement is not more than 3 to 1
+        SimilarUser.objects.update_recommendations()
+        self.assertEquals(SimilarUser.objects.count(), 0)
+
+        SimilarUser.objects.update_recommendations(min_agreement=2, block_size=1)
+        similar = SimilarUser.objects.get(from_user=self.user, to_user=self.user2)
+        self.assertEquals((similar.agrees, similar.disagrees), (3, 1))
+        self.assertEquals(SimilarUser.objects.count(), 2)
+
+        # Exclusions survive a rebuild
+        SimilarUser.objects.filter(pk=similar.pk).update(exclude=True)
+        SimilarUser.objects.update_recommendations(min_agreement=2)
+        self.assertEquals(SimilarUser.objects.get(from_user=self.user, to_user=self.user2).exclude, True)
+
+    def testShardedRebuild(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        for instance in (self.instance, self.instance2, self.instance3, self.instance4):
+            for user in (self.user, self.user2, user3):
+                instance.rating.add(score=1, user=user, ip_address='127.0.21.%d' % (user.pk % 250,))
+        SimilarUser.objects.update_recommendations()
+        expected = sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees'))
+        SimilarUser.objects.filter(from_user=user3, to_user=self.user).update(exclude=True)
+
+        output = StringIO()
+        call_command('update_recommendations', block_size=2, stdout=output)
+        self.assertEquals(sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees')), expected)
+        self.assertEquals(SimilarUser.objects.get(from_user=user3, to_user=self.user).exclude, True)
+        lines = output.getvalue().splitlines()
+        self.assertEquals([line.split(':')[0] for line in lines[:-1]], ['shard 1', 'shard 2'])
+        self.assertTrue(lines[-1].startswith('2 shards, 3 users, 6 similar users'))
+
+    def testWorkers(self):
+        if connection.creation._get_test_db_name() == ':memory:':
+            self.skipTest('worker processes cannot share an in-memory database')
+        Vote.objects.all().delete()
+        users = [User.objects.create(username=str(random.randint(0, 100000000))) for i in range(4)]
+        instances = (self.instance, self.instance2, self.instance3, self.instance4, self.instance5)
+        for i, user in enumerate(users):
+            for j, instance in enumerate(instances):
+                instance.rating3.add(score=(i * j) % 3 + 1, user=user, ip_address='127.0.31.%d' % (user.pk % 250,))
+
+        def rows(**kwargs):
+            SimilarUser.objects.update_recommendations(min_agreement=0, block_size=1, **kwargs)
+            return sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees', 'exclude'))
+
+        expected = rows()
+        self.assertTrue(expected)
+        # the shards are pickled to, computed and written by other processes
+        self.assertEquals(rows(workers=2), expected)
+        self.assertEquals(SimilarUser.objects.values('generation').distinct().count(), 1)
+
+        RatingTestModel.objects.filter(pk=self.instance.pk).update(rating3_votes=0)
+        output = StringIO()
+        call_command('check_ratings', 'djangoratings.RatingTestModel', workers=2, chunk_size=2, stdout=output)
+        self.assertTrue('#%s rating3' % (self.instance.pk,) in output.getvalue())
+        RatingTestModel.objects.filter(pk=self.instance.pk).update(rating3_votes=4)
+
+    def testGenerations(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        for instance in (self.instance, self.instance2, self.instance3, self.instance4):
+            for user in (self.user, self.user2, user3):
+                instance.rating.add(score=1, user=user, ip_address='127.0.22.%d' % (user.pk % 250,))
+        self.instance5.rating.add(score=1, user=self.user, ip_address='127.0.22.%d' % (self.user.pk % 250,))
+        SimilarUser.objects.update_recommendations()
+        generation = SimilarUser.objects.get_generation()
+
+        def progress(shard, *args):
+            # readers keep using the previous generation while rebuilding
+            self.assertEquals(SimilarUser.objects.get_generation(), generation)
+            if shard == 1:
+                self.assertEquals(list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel)),
+                                  [self.instance5])
+                SimilarUser.objects.filter(generation=generation, from_user=self.user2).update(exclude=True)
+
+        SimilarUser.objects.update_recommendations(block_size=1, progress=progress)
+        self.assertEquals(SimilarUser.objects.get_generation(), generation + 1)
+        self.assertEquals(SimilarUser.objects.count(), 6)
+        # Exclusions made while rebuilding are carried over
+        self.assertEquals(SimilarUser.objects.filter(from_user=self.user2, exclude=True).count(), 2)
+        self.assertEquals(list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel)), [])
+
+    def testApproximateSimilarities(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        def vote(instance, user, score):
+            instance.rating3.add(score=score, user=user, ip_address='127.0.23.%d' % (user.pk % 250,))
+
+        for instance in (self.instance, self.instance2, self.instance3, self.instance4):
+            vote(instance, self.user, 4)
+            vote(instance, self.user2, 4)
+        # user3 disagrees on every object
+        vote(self.instance, user3, 1)
+        vote(self.instance2, user3, 1)
+
+        SimilarUser.objects.update_recommendations(min_agreement=0)
+        exact = sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees'))
+        SimilarUser.objects.update_recommendations(min_agreement=0, approximate=True)
+        # users sharing no score are never candidates
+        self.assertEquals(sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees')),
+                          [row for row in exact if user3.pk not in row[:2]])
+
+        results = compare_with_exact()
+        self.assertEquals((results['similar'], results['found'], results['recall']), (2, 2, 1.0))
+
+    def testCandidateSimilarities(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        def vote(instance, user, score):
+            instance.rating3.add(score=score, user=user, ip_address='127.0.28.%d' % (user.pk % 250,))
+
+        for instance in (self.instance, self.instance2):
+            vote(instance, self.user, 4)
+            vote(instance, self.user2, 4)
+            vote(instance, user3, 1)
+        for instance in (self.instance3, self.instance4, self.instance5):
+            vote(instance, self.user2, 2)
+
+        exact = compute_similarities([self.user.pk])
+        self.assertEquals(sorted(exact), [(self.user.pk, self.user2.pk), (self.user.pk, user3.pk)])
+        # the candidate's votes on objects the block did not vote on are left out
+        votes = _get_candidate_votes([self.user.pk], [self.user2.pk])
+        self.assertEquals(len(votes), 4)
+        self.assertEquals(compute_similarities([self.user.pk], candidates={self.user.pk: set([self.user2.pk])}),
+                          {(self.user.pk, self.user2.pk): exact[(self.user.pk, self.user2.pk)]})
+
+    def testIncrementalUpdates(self):
+        Vote.objects.all().delete()
+        SimilarUser.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        def rebuilt():
+            current = sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees'))
+            SimilarUser.objects.update_recommendations()
+            return current, sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees'))
+
+        for mode in ('inline', 'deferred'):
+            settings.RATINGS_SIMILAR_USERS_UPDATE = mode
+            try:
+                SimilarUser.objects.update_recommendations()
+                self.instance.rating3.add(score=1, user=self.user, ip_address='127.0.0.1')
+                self.instance.rating3.add(score=1, user=self.user2, ip_address='127.0.0.2')
+                self.instance.rating3.add(score=2, user=user3, ip_address='127.0.0.3')
+                self.instance2.rating3.add(score=2, user=self.user, ip_address='127.0.0.1')
+                self.instance2.rating3.add(score=2, user=self.user2, ip_address='127.0.0.2')
+                # Changed and deleted votes
+                self.instance.rating3.add(score=2, user=self.user2, ip_address='127.0.0.2')
+                self.instance2.rating3.delete(user=self.user, ip_address='127.0.0.1')
+                Vote.objects.filter(user=user3).delete()
+                if mode == 'deferred':
+                    SimilarUser.objects.update_stale()
+
+                current, expected = rebuilt()
+                self.assertEquals(current, expected)
+                self.assertEquals(SimilarUser.objects.get(from_user=self.user, to_user=self.user2).disagrees, 1)
+                Vote.objects.all().delete()
+            finally:
+                del settings.RATINGS_SIMILAR_USERS_UPDATE
+
+    def testIncrementalUpdatesWithoutRows(self):
+        Vote.objects.all().delete()
+        SimilarUser.objects.all().delete()
+        self.instance.rating3.add(score=1, user=self.user, ip_address='127.0.29.1')
+        self.instance.rating3.add(score=1, user=self.user2, ip_address='127.0.29.2')
+        self.instance2.rating3.add(score=2, user=self.user, ip_address='127.0.29.1')
+        self.instance2.rating3.add(score=2, user=self.user2, ip_address='127.0.29.2')
+
+        # inline updates turned on before SimilarUser was ever built
+        settings.RATINGS_SIMILAR_USERS_UPDATE = 'inline'
+        try:
+            self.instance.rating3.add(score=2, user=self.user2, ip_address='127.0.29.2')
+            self.instance2.rating3.delete(user=self.user, ip_address='127.0.29.1')
+        finally:
+            del settings.RATINGS_SIMILAR_USERS_UPDATE
+        # the decrements had no row to apply to, only the increments were counted
+        self.assertEquals(sorted(SimilarUser.objects.values_list('from_user', 'to_user', 'agrees', 'disagrees')),
+                          sorted([(self.user.pk, self.user2.pk, 0, 1), (self.user2.pk, self.user.pk, 0, 1)]))
+
+    def testSimilarityMetrics(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        instances = (self.instance, self.instance2, self.instance3)
+        for user, scores in ((self.user, (5, 4, 1)), (self.user2, (4, 5, 1)), (user3, (3, 4, 2))):
+            for instance, score in zip(instances, scores):
+                instance.rating3.add(score=score, user=user, ip_address='127.0.18.%d' % (user.pk % 250,))
+        self.instance4.rating3.add(score=5, user=self.user, ip_address='127.0.18.%d' % (self.user.pk % 250,))
+        self.instance5.rating3.add(score=5, user=user3, ip_address='127.0.18.%d' % (user3.pk % 250,))
+
+        # 4 and 5 stars are a disagreement
+        SimilarUser.objects.update_recommendations()
+        self.assertFalse(SimilarUser.objects.filter(from_user=self.user2).exists())
+
+        for metric, expected in (('distance', 1 - (0.125 / 3) ** 0.5), ('pearson', 0.46 / 0.52), ('cosine', 1.64 / 1.68)):
+            SimilarUser.objects.update_recommendations(metric=metric)
+            similar = SimilarUser.objects.get(from_user=self.user2, to_user=self.user)
+            self.assertAlmostEquals(similar.similarity, expected)
+
+        SimilarUser.objects.update_recommendations(metric='distance')
+        recs = list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel, order_by_similarity=True))
+        self.assertEquals(recs, [self.instance4, self.instance5])
+        self.assertAlmostEquals(recs[1].similarity, 0.75)
+
+    def testMaterializedRecommendations(self):
+        Vote.objects.all().delete()
+        user3 = User.objects.create(username=str(random.randint(0, 100000000)))
+
+        def vote(instance, user, score):
+            instance.rating3.add(score=score, user=user, ip_address='127.0.20.%d' % (user.pk % 250,))
+
+        for instance in (self.instance, self.instance2, self.instance3):
+            for user in (self.user, self.user2, user3):
+                vote(instance, user, 5)
+        vote(self.instance4, self.user, 5)
+        vote(self.instance4, user3, 5)
+        vote(self.instance5, user3, 2)
+
+        settings.RATINGS_MATERIALIZED_RECOMMENDATIONS = True
+        try:
+            SimilarUser.objects.update_recommendations()
+            recs = list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel))
+            self.assertEquals(recs, [self.instance4, self.instance5])
+            self.assertAlmostEquals(recs[0].recommendation_score, 2, 3)
+            self.assertAlmostEquals(recs[1].recommendation_score, 0.4, 3)
+
+            # Only the best objects are kept
+            Recommendation.objects.rebuild([self.user2.pk], size=1)
+            self.assertEquals(list(Recommendation.objects.filter(user=self.user2).values_list('object_id', flat=True)),
+                              [self.instance4.pk])
+            Recommendation.objects.rebuild([self.user2.pk])
+
+            # Objects rated or ignored since the rebuild are left out
+            vote(self.instance4, self.user2, 4)
+            ct = ContentType.objects.get_for_model(RatingTestModel)
+            IgnoredObject.objects.create(user=self.user2, content_type=ct, object_id=self.instance5.pk)
+            self.assertEquals(list(SimilarUser.objects.get_recommendations(self.user2, RatingTestModel)), [])
+        finally:
+            del settings.RATINGS_MATERIALIZED_RECOMMENDATIONS
+
+class CachedRecommendationsTestCase(TestCase):
+    def testCachedRecommendations(self):
+        instances = [RatingTestModel.objects.create() for i in range(6)]
+        user = User.objects.create(username=str(random.randint(0, 100000000)))
+        user2 = User.objects.create(username=str(random.randint(0, 100000000)))
+        ct = ContentType.objects.get_for_model(RatingTestModel)
+
+        for instance in instances[:5]:
+            instance.rating.add(score=1, user=user, ip_address='127.0.25.1')
+        instances[0].rating.add(score=1, user=user2, ip_address='127.0.25.2')
+        SimilarUser.objects.update_recommendations()
+
+        def recommended():
+            return sorted([obj.pk for obj in SimilarUser.objects.get_cached_recommendations(user2, RatingTestModel)])
+
+        self.assertEquals(recommended(), [instance.pk for instance in instances[1:5]])
+        # only the objects are loaded
+        self.assertNumQueries(1, SimilarUser.objects.get_cached_recommendations, user2, RatingTestModel)
+
+        # ignoring or rating an object invalidates the user's recommendations
+        IgnoredObject.objects.create(user=user2, content_type=ct, object_id=instances[1].pk)
+        self.assertEquals(recommended(), [instance.pk for instance in instances[2:5]])
+        instances[2].rating.add(score=1, user=user2, ip_address='127.0.25.2')
+        self.assertEquals(recommended(), [instance.pk for instance in instances[3:5]])
+
+        # votes of similar users only show up once SimilarUser is rebuilt
+        instances[5].rating.add(score=1, user=user, ip_address='127.0.25.1')
+        self.assertEquals(recommended(), [instance.pk for instance in instances[3:5]])
+        SimilarUser.objects.update_recommendations()
+        self.assertEquals(recommended(), [instance.pk for instance in instances[3:6]])
+
+        # as does ignoring objects in bulk
+        IgnoredObject.objects.filter(user=user2).delete()
+        self.assertEquals(recommended(), [instances[1].pk] + [instance.pk for instance in instances[3:6]])
+        IgnoredObject.objects.create(user=user, content_type=ct, object_id=instances[3].pk)
+        IgnoredObject.objects.filter(object_id=instances[3].pk).update(user=user2)
+        self.assertEquals(recommended(), [instances[1].pk] + [instance.pk for instance in instances[4:6]])
+
+        # cached objects keep their similarity
+        ranked = SimilarUser.objects.get_cached_recommendations(user2, RatingTestModel, order_by_similarity=True)
+        cached = SimilarUser.objects.get_cached_recommendations(user2, RatingTestModel, order_by_similarity=True)
+        self.assertTrue(ranked[0].similarity > 0)
+        self.assertEquals([obj.similarity for obj in cached], [obj.similarity for obj in ranked])
+
+class SimilarObjectsTestCase(unittest.TestCase):
+    def testSimilarObjects(self):
+        Vote.objects.all().delete()
+        SimilarObject.objects.all().delete()
+        instances = [RatingTestModel.objects.create() for i in range(4)]
+        users = [User.objects.create(username=str(random.randint(0, 100000000))) for i in range(3)]
+
+        # scores by user, per object
+        for instance, scores in zip(instances, ((5, 4, 1), (5, 4, None), (1, None, 5))):
+            for user, score in zip(users, scores):
+                if score is not None:
+                    instance.rating3.add(score=score, user=user, ip_address='127.0.24.%d' % (user.pk % 250,))
+        instances[3].rating3.add(score=3, user=None, ip_address='127.0.24.1')
+
+        field = RatingTestModel.rating3
+        SimilarObject.objects.rebuild(RatingTestModel, [field], chunk_size=1)
+        similar = list(SimilarObject.objects.get_similar_objects(instances[0], 'rating3'))
+        self.assertEquals(similar, [instances[1], instances[2]])
+        self.assertAlmostEquals(similar[0].similarity, 41 / 1722 ** 0.5)
+        self.assertAlmostEquals(similar[1].similarity, 10 / 1092 ** 0.5)
+
+        # Loading the votes of a single user at a time gives the same result
+        rows = sorted(SimilarObject.objects.values_list('object_id', 'to_object_id', 'similarity'))
+        SimilarObject.objects.rebuild(RatingTestModel, [field], chunk_size=1, max_votes=1)
+        self.assertEquals(sorted(SimilarObject.objects.values_list('object_id', 'to_object_id', 'similarity')), rows)
+
+        similar = SimilarObject.objects.get_similar_objects_in_bulk(instances, 'rating3')
+        self.assertEquals(similar, {
+            instances[0].pk: [instances[1], instances[2]],
+            instances[1].pk: [instances[0], instances[2]],
+            instances[2].pk: [instances[0], instances[1]],
+            # anonymous votes are not compared
+            instances[3].pk: [],
+        })
+
+        # Only the best objects are kept, and objects no longer voted on lose theirs
+        Vote.objects.filter(object_id=instances[2].pk).delete()
+        SimilarObject.objects.rebuild(RatingTestModel, [field], size=1)
+        self.assertEquals(sorted(SimilarObject.objects.filter(key=field.key).values_list('object_id', 'to_object_id')),
+                          sorted([(instances[0].pk, instances[1].pk), (instances[1].pk, instances[0].pk)]))
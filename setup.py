@@ -18,7 +18,11 @@ setup(
         'django',
     ],
     tests_require=tests_require,
-    extras_require={'test': tests_require},
+    extras_require={
+        'test': tests_require,
+        # vectorised similarities, see djangoratings.similarity and djangoratings.lsh
+        'fast': ['numpy', 'scipy'],
+    },
     test_suite='djangoratings.runtests.runtests',
     packages=find_packages(),
     include_package_data=True,